@@ -51,7 +51,7 @@ CHUNK_SIZE = 512 * 1024
 FileInfo = collections.namedtuple('FileInfo', ['size'])
 
 
-def list_files(bucket, subdir=None, batch_size=100):
+def list_files(bucket, subdir=None, batch_size=100, marker=None):
   """Yields filenames and stats of files inside subdirectory of a bucket.
 
   It always lists directories recursively.
@@ -59,6 +59,8 @@ def list_files(bucket, subdir=None, batch_size=100):
   Arguments:
     bucket: a bucket to list.
     subdir: subdirectory to list files from or None for an entire bucket.
+    batch_size: number of files listed per request.
+    marker: filename (relative to the bucket root) to resume the listing after.
 
   Yields:
     Tuples of (filename, stats), where filename is relative to the bucket root
@@ -67,7 +69,8 @@ def list_files(bucket, subdir=None, batch_size=100):
   # When listing an entire bucket, gcs expects /<bucket> without ending '/'.
   path_prefix = '/%s/%s' % (bucket, subdir) if subdir else '/%s' % bucket
   bucket_prefix = '/%s/' % bucket
-  marker = None
+  if marker:
+    marker = bucket_prefix + marker
   retry_params = _make_retry_params()
   while True:
     files_stats = cloudstorage.listbucket(
@@ -94,6 +97,18 @@ def list_files(bucket, subdir=None, batch_size=100):
       break
 
 
+def list_directories(bucket):
+  """Yields the names of the top level directories of a bucket."""
+  bucket_prefix = '/%s/' % bucket
+  for stat in cloudstorage.listbucket(
+      path_prefix='/%s' % bucket,
+      delimiter='/',
+      retry_params=_make_retry_params()):
+    if stat.is_dir:
+      assert stat.filename.startswith(bucket_prefix)
+      yield stat.filename[len(bucket_prefix):].rstrip('/')
+
+
 def delete_files(bucket, filenames, ignore_missing=False):
   """Deletes multiple files stored in GS.
 
@@ -180,7 +180,8 @@ class MainTest(test_case.TestCase):
         '/internal/cron/cleanup/trigger/old', headers=headers)
     self.assertEqual(200, resp.status_code)
     self.assertEqual([None], r.json)
-    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(
+        1 + handlers_backend.CLEANUP_SHARDS, self.execute_tasks())
     self.assertEqual(1, len(list(model.ContentEntry.query())))
     self.assertEqual('bar', model.ContentEntry.query().get().content)
 
@@ -191,10 +192,11 @@ class MainTest(test_case.TestCase):
         '/internal/cron/cleanup/trigger/old', headers=headers)
     self.assertEqual(200, resp.status_code)
     self.assertEqual([None], r.json)
-    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(
+        1 + handlers_backend.CLEANUP_SHARDS, self.execute_tasks())
     self.assertEqual(0, len(list(model.ContentEntry.query())))
 
-    # Advance time and force cleanup.
+    # Advance time and force cleanup. There's nothing left to shard.
     now += datetime.timedelta(seconds=2*expiration)
     headers = {'X-AppEngine-Cron': 'true'}
     resp = self.app_backend.get(
@@ -210,6 +212,34 @@ class MainTest(test_case.TestCase):
     expected = sorted('default/' + hash_item(i) for i in items)
     self.assertEqual(expected, sorted(deleted))
 
+  def test_cleanup_old_in_flight(self):
+    self.mock_delete_files()
+    now = datetime.datetime(2020, 1, 2, 3, 4, 5, 6)
+    self.mock(utils, 'utcnow', lambda: now)
+    key = model.entry_key('default', '0' * 40)
+    model.ContentEntry(
+        key=key, expiration_ts=now - datetime.timedelta(days=1)).put()
+    # A shard of a previous run still covers the expired entry.
+    handlers_backend.lease_cleanup_shard(
+        'old', '0/1', end=utils.datetime_to_timestamp(now)).put()
+
+    headers = {'X-AppEngine-Cron': 'true'}
+    resp = self.app_backend.get(
+        '/internal/cron/cleanup/trigger/old', headers=headers)
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual(1, self.execute_tasks())
+    self.assertTrue(key.get())
+
+    # Once its lease expired, the range is sharded again.
+    now += datetime.timedelta(seconds=handlers_backend.CLEANUP_LEASE)
+    resp = self.app_backend.get(
+        '/internal/cron/cleanup/trigger/old', headers=headers)
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual(
+        1 + handlers_backend.CLEANUP_SHARDS, self.execute_tasks())
+    self.assertEqual(None, key.get())
+    self.assertEqual([], model.CleanupShard.query().fetch())
+
   def test_trim_missing(self):
     deleted = self.mock_delete_files()
     def gen_file(i, t=0):
@@ -222,15 +252,31 @@ class MainTest(test_case.TestCase):
         # Too recent.
         gen_file('d/' + '2' * 40, time.time() - 60),
     ]
-    self.mock(gcs, 'list_files', lambda _: mock_files)
+    self.mock(gcs, 'list_directories', lambda _: ['d'])
+    self.mock(
+        gcs, 'list_files',
+        lambda _, subdir, marker: [
+          f for f in mock_files if f[0].startswith(subdir)
+        ])
 
     model.ContentEntry(key=model.entry_key('d', '0' * 40)).put()
     headers = {'X-AppEngine-Cron': 'true'}
     resp = self.app_backend.get(
         '/internal/cron/cleanup/trigger/trim_lost', headers=headers)
     self.assertEqual(200, resp.status_code)
-    self.assertEqual(1, self.execute_tasks())
+    # One shard per hex digit.
+    self.assertEqual(1 + 16, self.execute_tasks())
     self.assertEqual(['d/' + '1' * 40], deleted)
+    self.assertEqual([], model.CleanupShard.query().fetch())
+
+    # A subdirectory still enumerated by a previous run is skipped.
+    del deleted[:]
+    handlers_backend.lease_cleanup_shard('trim_lost', 'd/1').put()
+    resp = self.app_backend.get(
+        '/internal/cron/cleanup/trigger/trim_lost', headers=headers)
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual(1 + 15, self.execute_tasks())
+    self.assertEqual([], deleted)
 
   def test_verify(self):
     # Upload a file larger than MIN_SIZE_FOR_DIRECT_GS and ensure the verify
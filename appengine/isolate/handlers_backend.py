@@ -5,6 +5,10 @@
 """This module defines Isolate Server backend url handlers."""
 
 import binascii
+import collections
+import datetime
+import itertools
+import json
 import logging
 import time
 import zlib
@@ -13,6 +17,7 @@ import webapp2
 from google.appengine import runtime
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 import config
@@ -29,6 +34,32 @@ from components import utils
 ITEMS_TO_DELETE_ASYNC = 100
 
 
+# The number of task queue workers the expired entries cleanup is split over,
+# and for how long (in seconds) a cleanup worker runs before handing the rest of
+# its shard to a new task.
+CLEANUP_SHARDS = 16
+CLEANUP_DURATION = 8*60
+
+
+# For how long (in seconds) a cleanup shard is considered in flight after its
+# last task started. The cron jobs don't trigger a shard again while it is.
+CLEANUP_LEASE = CLEANUP_DURATION + 5*60
+
+
+# Lease duration and maximum number of tasks leased at once from the verify pull
+# queue, and for how long (in seconds) a single request keeps verifying.
+VERIFY_LEASE_SECONDS = 5*60
+VERIFY_LEASE_MAX_TASKS = 100
+VERIFY_BATCH_DURATION = 60
+
+
+# Lease duration and maximum number of tasks leased at once from the tag pull
+# queue, and for how long (in seconds) a single cron run keeps flushing it.
+TAG_LEASE_SECONDS = 5*60
+TAG_LEASE_MAX_TASKS = 1000
+TAG_FLUSH_DURATION = 50
+
+
 ### Utility
 
 
@@ -80,6 +111,170 @@ def payload_to_hashes(request, namespace):
       model.MAX_KEYS_PER_DB_OPS)
 
 
+def tag_entries(namespace, digests, now):
+  """Extends the expiration of the ContentEntry whose next_tag_ts has passed.
+
+  Arguments:
+  - namespace: namespace of the entries.
+  - digests: iterable of binary digests.
+  - now: timestamp to tag the entries with.
+
+  Returns the number of entries tagged.
+  """
+  expiration = config.settings().default_expiration
+  keys = [model.entry_key(namespace, binascii.hexlify(d)) for d in digests]
+  tagged = 0
+  for i in xrange(0, len(keys), model.MAX_KEYS_PER_DB_OPS):
+    # Requests all the entities of a batch at once.
+    futures = ndb.get_multi_async(keys[i:i+model.MAX_KEYS_PER_DB_OPS])
+    to_save = []
+    while futures:
+      # Return opportunistically the first entity that can be retrieved.
+      future = ndb.Future.wait_any(futures)
+      futures.remove(future)
+      item = future.get_result()
+      if item and item.next_tag_ts < now:
+        # Update the timestamp. Add a bit of pseudo randomness.
+        item.expiration_ts, item.next_tag_ts = model.expiration_jitter(
+            now, expiration)
+        to_save.append(item)
+    if to_save:
+      ndb.put_multi(to_save)
+    tagged += len(to_save)
+  return tagged
+
+
+def purge_entry(entry, message, *args):
+  """Logs error message, deletes |entry| from datastore and GS."""
+  logging.error(
+      'Verification failed for %s: %s', entry.key.id(), message % args)
+  model.delete_entry_and_gs_entry([entry.key])
+
+
+def verify_entry(entry):
+  """Verifies that the content in GS of a ContentEntry matches its digest.
+
+  The entry is deleted if it doesn't, or marked as verified if it does.
+
+  Returns False if the verification failed for an external reason and must be
+  retried later.
+  """
+  namespace, hash_key = entry.key.id().rsplit('/', 1)
+  if entry.is_verified:
+    logging.warning('Was already verified')
+    return True
+  if entry.content is not None:
+    logging.error('Should not be called with inline content')
+    return True
+
+  # Get GS file size.
+  gs_bucket = config.settings().gs_bucket
+  gs_file_info = gcs.get_file_info(gs_bucket, entry.key.id())
+
+  # It's None if file is missing.
+  if not gs_file_info:
+    # According to the docs, GS is read-after-write consistent, so a file is
+    # missing only if it wasn't stored at all or it was deleted, in any case
+    # it's not a valid ContentEntry.
+    purge_entry(entry, 'No such GS file')
+    return True
+
+  # Expected stored length and actual length should match.
+  if gs_file_info.size != entry.compressed_size:
+    purge_entry(entry,
+        'Bad GS file: expected size is %d, actual size is %d',
+        entry.compressed_size, gs_file_info.size)
+    return True
+
+  save_to_memcache = (
+      entry.compressed_size <= model.MAX_MEMCACHE_ISOLATED and
+      entry.is_isolated)
+  expanded_size = 0
+  digest = model.get_hash_algo(namespace)
+  data = None
+
+  try:
+    # Start a loop where it reads the data in block.
+    stream = gcs.read_file(gs_bucket, entry.key.id())
+    if save_to_memcache:
+      # Wraps stream with a generator that accumulates the data.
+      stream = Accumulator(stream)
+
+    for data in model.expand_content(namespace, stream):
+      expanded_size += len(data)
+      digest.update(data)
+      # Make sure the data is GC'ed.
+      del data
+
+    # Hashes should match.
+    if digest.hexdigest() != hash_key:
+      purge_entry(entry,
+          'SHA-1 do not match data (%d bytes, %d bytes expanded)',
+          entry.compressed_size, expanded_size)
+      return True
+
+  except gcs.NotFoundError as e:
+    # Somebody deleted a file between get_file_info and read_file calls.
+    purge_entry(entry, 'File was unexpectedly deleted')
+    return True
+  except (gcs.ForbiddenError, gcs.AuthorizationError) as e:
+    # Misconfiguration in Google Storage ACLs. Don't delete an entry, it may
+    # be fine. Maybe ACL problems would be fixed before the next retry.
+    logging.warning(
+        'CloudStorage auth issues (%s): %s', e.__class__.__name__, e)
+    return False
+  except (gcs.FatalError, zlib.error, IOError) as e:
+    # ForbiddenError and AuthorizationError inherit FatalError, so this except
+    # block should be last.
+    # It's broken or unreadable.
+    purge_entry(entry,
+        'Failed to read the file (%s): %s', e.__class__.__name__, e)
+    return True
+
+  # Verified. Data matches the hash.
+  entry.expanded_size = expanded_size
+  entry.is_verified = True
+  future = entry.put_async()
+  model.cache_existence([entry.key])
+  logging.info(
+      '%d bytes (%d bytes expanded) verified',
+      entry.compressed_size, expanded_size)
+  if save_to_memcache:
+    model.save_in_memcache(namespace, hash_key, ''.join(stream.accumulated))
+  future.wait()
+  return True
+
+
+def verify_batch():
+  """Verifies the entries queued in the verify-pull queue.
+
+  Runs for at most VERIFY_BATCH_DURATION seconds. Tasks of entries whose
+  verification must be retried are left leased, so they are retried once their
+  lease expires.
+  """
+  queue = taskqueue.Queue('verify-pull')
+  deadline = time.time() + VERIFY_BATCH_DURATION
+  total = 0
+  while time.time() < deadline:
+    tasks = queue.lease_tasks(VERIFY_LEASE_SECONDS, VERIFY_LEASE_MAX_TASKS)
+    if not tasks:
+      break
+    entries = ndb.get_multi(
+        model.entry_key_from_id(task.payload) for task in tasks)
+    done = []
+    for task, entry in zip(tasks, entries):
+      try:
+        if entry and not verify_entry(entry):
+          continue
+      except gcs.TransientError as e:
+        logging.warning('Failed to verify %s: %s', task.payload, e)
+        continue
+      done.append(task)
+    queue.delete_tasks(done)
+    total += len(done)
+  logging.info('Verified %d entries', total)
+
+
 def incremental_delete(query, delete, check=None):
   """Applies |delete| to objects in a query asynchrously.
 
@@ -98,7 +293,7 @@ def incremental_delete(query, delete, check=None):
   to_delete = []
   count = 0
   deleted_count = 0
-  futures = []
+  futures = collections.deque()
   for item in query:
     count += 1
     if not (count % 1000):
@@ -117,7 +312,7 @@ def incremental_delete(query, delete, check=None):
     # TODO(maruel): Profile memory usage to see if a few thousands of on-going
     # RPC objects is a problem in practice.
     while len(futures) > 10 * ITEMS_TO_DELETE_ASYNC:
-      futures.pop(0).wait()
+      futures.popleft().wait()
 
   if to_delete:
     logging.info('Deleting %s entries', len(to_delete))
@@ -127,12 +322,95 @@ def incremental_delete(query, delete, check=None):
   return deleted_count
 
 
+def iter_until(iterable, deadline):
+  """Yields the items of |iterable| until time.time() reaches |deadline|."""
+  for item in iterable:
+    yield item
+    if time.time() >= deadline:
+      return
+
+
+def find_lost_files(files, checkpoint):
+  """Yields the GS files that are not referenced by a ContentEntry.
+
+  Arguments:
+  - files: iterator of (filename, stats) tuples as returned by gcs.list_files().
+  - checkpoint: callback called with the last filename of each batch of files
+                once all the lost files of the batch were yielded.
+  """
+  cutoff = time.time() - 60*60
+  files = iter(files)
+  while True:
+    listed = list(itertools.islice(files, ITEMS_TO_DELETE_ASYNC))
+    if not listed:
+      return
+    # If the file was uploaded in the last hour, ignore it.
+    filepaths = [
+      filepath for filepath, filestats in listed if filestats.st_ctime < cutoff
+    ]
+    # This must match the logic in model.entry_key(). Since this request will
+    # in practice touch every item, do not use memcache since it'll mess it up
+    # by loading every items in it.
+    entries = ndb.get_multi(
+        [model.entry_key_from_id(filepath) for filepath in filepaths],
+        use_cache=False, use_memcache=False)
+    for filepath, entry in zip(filepaths, entries):
+      if not entry:
+        yield filepath
+    checkpoint(listed[-1][0])
+
+
+def lease_cleanup_shard(cleanup, shard, **kwargs):
+  """Returns a CleanupShard marking |shard| in flight for CLEANUP_LEASE."""
+  return model.CleanupShard(
+      key=model.cleanup_shard_key(cleanup, shard),
+      cleanup=cleanup,
+      lease_ts=utils.utcnow() + datetime.timedelta(seconds=CLEANUP_LEASE),
+      **kwargs)
+
+
+def get_live_cleanup_shards(cleanup):
+  """Returns the CleanupShard of |cleanup| still in flight, by shard name.
+
+  The ones whose lease expired are deleted. The query is eventually consistent,
+  which is fine at the rate of the cron jobs.
+  """
+  now = utils.utcnow()
+  live = {}
+  dead = []
+  q = model.CleanupShard.query(model.CleanupShard.cleanup == cleanup)
+  for shard in q:
+    if shard.lease_ts > now:
+      live[shard.key.id().split(':', 1)[1]] = shard
+    else:
+      dead.append(shard.key)
+  if dead:
+    logging.warning('%d %s shards died', len(dead), cleanup)
+    ndb.delete_multi(dead)
+  return live
+
+
+def log_throughput(what, count, start):
+  """Logs how many |what| were deleted since |start| and at which rate."""
+  duration = time.time() - start
+  logging.info(
+      'Deleted %d %s in %.1fs (%.1f/s)',
+      count, what, duration, count / duration if duration else 0.)
+
+
 ### Restricted handlers
 
 
 class InternalCleanupOldEntriesWorkerHandler(webapp2.RequestHandler):
   """Removes the old data from the datastore.
 
+  Splits the expired entries in CLEANUP_SHARDS ranges of expiration_ts, each
+  deleted by its own InternalCleanupOldEntriesShardWorkerHandler task.
+
+  The ranges of the shards still in flight from a previous run are skipped.
+  Since expiration_ts is always set in the future, no entry can expire in them
+  anymore, so the new ranges start after the last of them.
+
   Only a task queue task can use this handler.
   """
   # pylint: disable=R0201
@@ -143,11 +421,76 @@ class InternalCleanupOldEntriesWorkerHandler(webapp2.RequestHandler):
       runtime.DeadlineExceededError)
   @decorators.require_taskqueue('cleanup')
   def post(self):
+    now = utils.utcnow()
+    oldest = model.ContentEntry.query(
+        model.ContentEntry.expiration_ts < now
+        ).order(model.ContentEntry.expiration_ts).get()
+    if not oldest:
+      logging.info('No expired entries')
+      return
+    start = utils.datetime_to_timestamp(oldest.expiration_ts)
+    end = utils.datetime_to_timestamp(now)
+    live = get_live_cleanup_shards('old')
+    if live:
+      start = max(start, max(shard.end for shard in live.itervalues()))
+      logging.info('%d shards still in flight', len(live))
+    if start >= end:
+      logging.info('No expired entries outside of the shards in flight')
+      return
+    bounds = sorted(set(
+        start + (end - start) * i / CLEANUP_SHARDS
+        for i in xrange(CLEANUP_SHARDS + 1)))
+    ranges = zip(bounds, bounds[1:])
+    ndb.put_multi([
+      lease_cleanup_shard('old', '%d/%d' % (s, e), end=e) for s, e in ranges
+    ])
+    for shard_start, shard_end in ranges:
+      utils.enqueue_task(
+          '/internal/taskqueue/cleanup/old/%d/%d' % (shard_start, shard_end),
+          'cleanup-shard')
+    logging.info('Triggered %d shards', len(ranges))
+
+
+class InternalCleanupOldEntriesShardWorkerHandler(webapp2.RequestHandler):
+  """Removes the entries that expired in a range of expiration_ts.
+
+  The payload is an optional datastore cursor to resume from. When it runs out
+  of time, the rest of the range is handed over to a new task. The CleanupShard
+  of the range is renewed by each task and deleted once the range is done.
+
+  Only a task queue task can use this handler.
+  """
+  # pylint: disable=R0201
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      datastore_errors.TransactionFailedError,
+      runtime.DeadlineExceededError)
+  @decorators.require_taskqueue('cleanup-shard')
+  def post(self, start, end):
+    started = time.time()
+    shard = lease_cleanup_shard('old', '%s/%s' % (start, end), end=long(end))
+    shard.put()
+    cursor = None
+    if self.request.body:
+      cursor = ndb.Cursor(urlsafe=self.request.body)
     q = model.ContentEntry.query(
-        model.ContentEntry.expiration_ts < utils.utcnow()
-        ).iter(keys_only=True)
-    total = incremental_delete(q, delete=model.delete_entry_and_gs_entry)
-    logging.info('Deleting %s expired entries', total)
+        model.ContentEntry.expiration_ts >=
+            utils.timestamp_to_datetime(long(start)),
+        model.ContentEntry.expiration_ts <
+            utils.timestamp_to_datetime(long(end)),
+        ).iter(keys_only=True, start_cursor=cursor, produce_cursors=True)
+    total = incremental_delete(
+        iter_until(q, started + CLEANUP_DURATION),
+        delete=model.delete_entry_and_gs_entry)
+    cursor = q.cursor_after() if total else None
+    if cursor and q.has_next():
+      logging.info('Out of time, resuming in a new task')
+      utils.enqueue_task(
+          self.request.path, 'cleanup-shard', payload=cursor.urlsafe())
+    else:
+      shard.key.delete()
+    log_throughput('expired entries', total, started)
 
 
 class InternalObliterateWorkerHandler(webapp2.RequestHandler):
@@ -194,47 +537,72 @@ class InternalCleanupTrimLostWorkerHandler(webapp2.RequestHandler):
       runtime.DeadlineExceededError)
   @decorators.require_taskqueue('cleanup')
   def post(self):
-    """Enumerates all GS files and delete those that do not have an associated
-    ContentEntry.
+    """Splits the GS bucket in shards, each enumerated by its own
+    InternalCleanupTrimLostShardWorkerHandler task.
+
+    The file names are hex digests so each namespace is split on their first
+    character. The subdirectories still enumerated by a previous run are
+    skipped.
     """
     gs_bucket = config.settings().gs_bucket
+    live = get_live_cleanup_shards('trim_lost')
+    subdirs = [
+      '%s/%s' % (namespace, char)
+      for namespace in gcs.list_directories(gs_bucket)
+      for char in '0123456789abcdef'
+      if '%s/%s' % (namespace, char) not in live
+    ]
+    ndb.put_multi([lease_cleanup_shard('trim_lost', s) for s in subdirs])
+    for subdir in subdirs:
+      utils.enqueue_task(
+          '/internal/taskqueue/cleanup/trim_lost/shard', 'cleanup-shard',
+          payload=json.dumps({'subdir': subdir}))
+    logging.info(
+        'Triggered %d shards, %d still in flight', len(subdirs), len(live))
+    # TODO(maruel): Find all the empty directories that are old and remove them.
+    # We need to safe guard against the race condition where a user would upload
+    # to this directory.
 
-    def filter_missing():
-      futures = {}
-      cutoff = time.time() - 60*60
-      for filepath, filestats in gcs.list_files(gs_bucket):
-        # If the file was uploaded in the last hour, ignore it.
-        if filestats.st_ctime >= cutoff:
-          continue
 
-        # This must match the logic in model.entry_key(). Since this request
-        # will in practice touch every item, do not use memcache since it'll
-        # mess it up by loading every items in it.
-        # TODO(maruel): Batch requests to use get_multi_async() similar to
-        # datastore_utils.page_queries().
-        future = model.entry_key_from_id(filepath).get_async(
-            use_cache=False, use_memcache=False)
-        futures[future] = filepath
-
-        if len(futures) > 20:
-          future = ndb.Future.wait_any(futures)
-          filepath = futures.pop(future)
-          if future.get_result():
-            continue
-          yield filepath
-      while futures:
-        future = ndb.Future.wait_any(futures)
-        filepath = futures.pop(future)
-        if future.get_result():
-          continue
-        yield filepath
+class InternalCleanupTrimLostShardWorkerHandler(webapp2.RequestHandler):
+  """Removes the lost GS files in a subdirectory of the bucket.
+
+  The payload is a JSON dict with the 'subdir' to enumerate and an optional
+  'marker' file name to resume after. When it runs out of time, the rest of the
+  subdirectory is handed over to a new task. The CleanupShard of the
+  subdirectory is renewed by each task and deleted once it is done.
 
+  Only a task queue task can use this handler.
+  """
+  # pylint: disable=R0201
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      datastore_errors.TransactionFailedError,
+      runtime.DeadlineExceededError)
+  @decorators.require_taskqueue('cleanup-shard')
+  def post(self):
+    started = time.time()
+    deadline = started + CLEANUP_DURATION
+    request = json.loads(self.request.body)
+    shard = lease_cleanup_shard('trim_lost', request['subdir'])
+    shard.put()
+    gs_bucket = config.settings().gs_bucket
+    files = gcs.list_files(
+        gs_bucket, request['subdir'], marker=request.get('marker'))
+    marker = []
     gs_delete = lambda filenames: gcs.delete_files(gs_bucket, filenames)
-    total = incremental_delete(filter_missing(), gs_delete)
-    logging.info('Deleted %d lost GS files', total)
-    # TODO(maruel): Find all the empty directories that are old and remove them.
-    # We need to safe guard against the race condition where a user would upload
-    # to this directory.
+    total = incremental_delete(
+        find_lost_files(iter_until(files, deadline), marker.append),
+        gs_delete)
+    if marker and time.time() >= deadline:
+      logging.info('Out of time, resuming in a new task')
+      request['marker'] = marker[-1]
+      utils.enqueue_task(
+          self.request.path, 'cleanup-shard', payload=json.dumps(request))
+    else:
+      shard.key.delete()
+    log_throughput('lost GS files', total, started)
 
 
 class InternalCleanupTriggerHandler(webapp2.RequestHandler):
@@ -275,43 +643,57 @@ class InternalTagWorkerHandler(webapp2.RequestHandler):
   def post(self, namespace, timestamp):
     digests = []
     now = utils.timestamp_to_datetime(long(timestamp))
-    expiration = config.settings().default_expiration
     try:
       digests = payload_to_hashes(self, namespace)
-      # Requests all the entities at once.
-      futures = ndb.get_multi_async(
-          model.entry_key(namespace, binascii.hexlify(d)) for d in digests)
-
-      to_save = []
-      while futures:
-        # Return opportunistically the first entity that can be retrieved.
-        future = ndb.Future.wait_any(futures)
-        futures.remove(future)
-        item = future.get_result()
-        if item and item.next_tag_ts < now:
-          # Update the timestamp. Add a bit of pseudo randomness.
-          item.expiration_ts, item.next_tag_ts = model.expiration_jitter(
-              now, expiration)
-          to_save.append(item)
-      if to_save:
-        ndb.put_multi(to_save)
-      logging.info(
-          'Timestamped %d entries out of %s', len(to_save), len(digests))
+      tagged = tag_entries(namespace, digests, now)
+      logging.info('Timestamped %d entries out of %s', tagged, len(digests))
     except Exception as e:
       logging.error('Failed to stamp entries: %s\n%d entries', e, len(digests))
       raise
 
 
+class InternalTagFlushHandler(webapp2.RequestHandler):
+  """Tags the ContentEntry buffered in the tag pull queue by /preupload.
+
+  Each leased batch holds the tasks of a single namespace. Their digests are
+  deduplicated and tagged together, so a hot entry is read once per batch
+  instead of once per lookup.
+  """
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      datastore_errors.TransactionFailedError,
+      runtime.DeadlineExceededError)
+  @decorators.require_cronjob
+  def get(self):
+    queue = taskqueue.Queue('tag-pull')
+    deadline = time.time() + TAG_FLUSH_DURATION
+    total = 0
+    while time.time() < deadline:
+      # Without a tag, leases the tasks with the same tag as the oldest task.
+      tasks = queue.lease_tasks_by_tag(TAG_LEASE_SECONDS, TAG_LEASE_MAX_TASKS)
+      if not tasks:
+        break
+      namespace = tasks[0].tag
+      digest_size = model.get_hash_algo(namespace).digest_size
+      digests = set()
+      for task in tasks:
+        payload = task.payload
+        digests.update(
+            payload[i:i+digest_size]
+            for i in xrange(0, len(payload), digest_size))
+      tagged = tag_entries(namespace, digests, utils.utcnow())
+      queue.delete_tasks(tasks)
+      logging.info(
+          'Timestamped %d entries out of %d in %s from %d tasks',
+          tagged, len(digests), namespace, len(tasks))
+      total += tagged
+    logging.info('Timestamped %d entries', total)
+
+
 class InternalVerifyWorkerHandler(webapp2.RequestHandler):
   """Verify the SHA-1 matches for an object stored in Cloud Storage."""
 
-  @staticmethod
-  def purge_entry(entry, message, *args):
-    """Logs error message, deletes |entry| from datastore and GS."""
-    logging.error(
-        'Verification failed for %s: %s', entry.key.id(), message % args)
-    model.delete_entry_and_gs_entry([entry.key])
-
   @decorators.silence(
       datastore_errors.InternalError,
       datastore_errors.Timeout,
@@ -324,88 +706,60 @@ class InternalVerifyWorkerHandler(webapp2.RequestHandler):
     if not entry:
       logging.error('Failed to find entity')
       return
-    if entry.is_verified:
-      logging.warning('Was already verified')
-      return
-    if entry.content is not None:
-      logging.error('Should not be called with inline content')
-      return
+    if not verify_entry(entry):
+      # Abort so the job is retried automatically.
+      self.abort(500)
 
-    # Get GS file size.
-    gs_bucket = config.settings().gs_bucket
-    gs_file_info = gcs.get_file_info(gs_bucket, entry.key.id())
-
-    # It's None if file is missing.
-    if not gs_file_info:
-      # According to the docs, GS is read-after-write consistent, so a file is
-      # missing only if it wasn't stored at all or it was deleted, in any case
-      # it's not a valid ContentEntry.
-      self.purge_entry(entry, 'No such GS file')
-      return
 
-    # Expected stored length and actual length should match.
-    if gs_file_info.size != entry.compressed_size:
-      self.purge_entry(entry,
-          'Bad GS file: expected size is %d, actual size is %d',
-          entry.compressed_size, gs_file_info.size)
-      return
+class InternalVerifyBatchWorkerHandler(webapp2.RequestHandler):
+  """Verifies the small objects stored in Cloud Storage queued in the
+  verify-pull queue, many at a time.
+
+  Triggered by finalize_gs_upload, with a cron job as a safety net.
+  """
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      datastore_errors.TransactionFailedError,
+      runtime.DeadlineExceededError)
+  @decorators.require_cronjob
+  def get(self):
+    verify_batch()
 
-    save_to_memcache = (
-        entry.compressed_size <= model.MAX_MEMCACHE_ISOLATED and
-        entry.is_isolated)
-    expanded_size = 0
-    digest = model.get_hash_algo(namespace)
-    data = None
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      datastore_errors.TransactionFailedError,
+      runtime.DeadlineExceededError)
+  @decorators.require_taskqueue('verify')
+  def post(self):
+    verify_batch()
 
-    try:
-      # Start a loop where it reads the data in block.
-      stream = gcs.read_file(gs_bucket, entry.key.id())
-      if save_to_memcache:
-        # Wraps stream with a generator that accumulates the data.
-        stream = Accumulator(stream)
-
-      for data in model.expand_content(namespace, stream):
-        expanded_size += len(data)
-        digest.update(data)
-        # Make sure the data is GC'ed.
-        del data
-
-      # Hashes should match.
-      if digest.hexdigest() != hash_key:
-        self.purge_entry(entry,
-            'SHA-1 do not match data (%d bytes, %d bytes expanded)',
-            entry.compressed_size, expanded_size)
-        return
-
-    except gcs.NotFoundError as e:
-      # Somebody deleted a file between get_file_info and read_file calls.
-      self.purge_entry(entry, 'File was unexpectedly deleted')
+
+class InternalHotContentWorkerHandler(webapp2.RequestHandler):
+  """Copies a frequently retrieved entry stored in GS to memcache."""
+
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      gcs.TransientError,
+      runtime.DeadlineExceededError)
+  @decorators.require_taskqueue('hot-content')
+  def post(self, namespace, hash_key):
+    entry = model.entry_key(namespace, hash_key).get()
+    # Only verified content is served from memcache.
+    if (not entry or not entry.is_verified or entry.content is not None or
+        entry.compressed_size > model.MAX_MEMCACHE_HOT):
       return
-    except (gcs.ForbiddenError, gcs.AuthorizationError) as e:
-      # Misconfiguration in Google Storage ACLs. Don't delete an entry, it may
-      # be fine. Maybe ACL problems would be fixed before the next retry.
-      logging.warning(
-          'CloudStorage auth issues (%s): %s', e.__class__.__name__, e)
-      # Abort so the job is retried automatically.
-      return self.abort(500)
-    except (gcs.FatalError, zlib.error, IOError) as e:
-      # ForbiddenError and AuthorizationError inherit FatalError, so this except
-      # block should be last.
-      # It's broken or unreadable.
-      self.purge_entry(entry,
-          'Failed to read the file (%s): %s', e.__class__.__name__, e)
+    try:
+      content = ''.join(
+          gcs.read_file(config.settings().gs_bucket, entry.key.id()))
+    except gcs.FatalError as e:
+      logging.warning('Failed to read %s: %s', entry.key.id(), e)
       return
-
-    # Verified. Data matches the hash.
-    entry.expanded_size = expanded_size
-    entry.is_verified = True
-    future = entry.put_async()
-    logging.info(
-        '%d bytes (%d bytes expanded) verified',
-        entry.compressed_size, expanded_size)
-    if save_to_memcache:
-      model.save_in_memcache(namespace, hash_key, ''.join(stream.accumulated))
-    future.wait()
+    model.save_in_memcache(
+        namespace, hash_key, content,
+        expiration=model.HOT_CONTENT_EXPIRATION)
 
 
 class InternalStatsUpdateHandler(webapp2.RequestHandler):
@@ -453,17 +807,28 @@ def get_routes():
     webapp2.Route(
         r'/internal/taskqueue/cleanup/old',
         InternalCleanupOldEntriesWorkerHandler),
+    webapp2.Route(
+        r'/internal/taskqueue/cleanup/old/<start:\d+>/<end:\d+>',
+        InternalCleanupOldEntriesShardWorkerHandler),
     webapp2.Route(
         r'/internal/taskqueue/cleanup/obliterate',
         InternalObliterateWorkerHandler),
     webapp2.Route(
         r'/internal/taskqueue/cleanup/trim_lost',
         InternalCleanupTrimLostWorkerHandler),
+    webapp2.Route(
+        r'/internal/taskqueue/cleanup/trim_lost/shard',
+        InternalCleanupTrimLostShardWorkerHandler),
 
     # Tasks triggered by other request handlers.
     webapp2.Route(
         r'/internal/taskqueue/tag%s/<timestamp:\d+>' % namespace,
         InternalTagWorkerHandler),
+    webapp2.Route(
+        r'/internal/taskqueue/hot%s' % namespace_key,
+        InternalHotContentWorkerHandler),
+    webapp2.Route(
+        r'/internal/taskqueue/verify/batch', InternalVerifyBatchWorkerHandler),
     webapp2.Route(
         r'/internal/taskqueue/verify%s' % namespace_key,
         InternalVerifyWorkerHandler),
@@ -472,6 +837,13 @@ def get_routes():
     webapp2.Route(
         r'/internal/cron/stats/update', InternalStatsUpdateHandler),
 
+    # Tags the entries buffered by /preupload.
+    webapp2.Route(r'/internal/cron/tag/flush', InternalTagFlushHandler),
+
+    # Verifies the small entries left behind by the verify batch tasks.
+    webapp2.Route(
+        r'/internal/cron/verify/batch', InternalVerifyBatchWorkerHandler),
+
     # Mapreduce related urls.
     webapp2.Route(
         r'/internal/taskqueue/mapreduce/launch/<job_id:[^\/]+>',
@@ -6,8 +6,11 @@
 
 import binascii
 import datetime
+import json
+import logging
 import re
 import time
+import zlib
 
 from google.appengine import runtime
 from google.appengine.api import datastore_errors
@@ -60,6 +63,11 @@ class StorageRequest(messages.Message):
   content = messages.BytesField(2)
 
 
+class StorageRequestCollection(messages.Message):
+  """Many StorageRequest to be added to the data store at once."""
+  items = messages.MessageField(StorageRequest, 1, repeated=True)
+
+
 class FinalizeRequest(messages.Message):
   """Request to validate upload of large Google storage entities."""
   upload_ticket = messages.StringField(1)
@@ -72,6 +80,18 @@ class RetrieveRequest(messages.Message):
   offset = messages.IntegerField(3, default=0)
 
 
+class RetrieveMultiRequest(messages.Message):
+  """Request to retrieve the content of many small entities at once."""
+  digests = messages.StringField(1, repeated=True)
+  namespace = messages.MessageField(Namespace, 2)
+
+
+class ResolveTreeRequest(messages.Message):
+  """Request to retrieve a .isolated file and all the ones it includes."""
+  digest = messages.StringField(1, required=True)
+  namespace = messages.MessageField(Namespace, 2)
+
+
 ### Response Types
 
 
@@ -93,6 +113,20 @@ class RetrievedContent(messages.Message):
   url = messages.StringField(2)
 
 
+class RetrievedItem(messages.Message):
+  """Content of a single entity retrieved by retrieve_multi or resolve_tree."""
+  digest = messages.StringField(1)
+  content = messages.BytesField(2)
+
+
+class RetrievedCollection(messages.Message):
+  """Entities retrieved by retrieve_multi or resolve_tree.
+
+  Only the entities stored inline or in memcache are returned.
+  """
+  items = messages.MessageField(RetrievedItem, 1, repeated=True)
+
+
 class PushPing(messages.Message):
   """Indicates whether data storage executed successfully."""
   ok = messages.BooleanField(1)
@@ -110,6 +144,42 @@ class ServerDetails(messages.Message):
 DEFAULT_LINK_EXPIRATION = datetime.timedelta(hours=4)
 
 
+# maximum number of bytes of content returned by a single retrieve_multi call
+MAX_RETRIEVE_MULTI_SIZE = 16*1024*1024
+
+
+# signed download URLs are cached in memcache per period of this length (in
+# seconds); they are signed to stay valid DEFAULT_LINK_EXPIRATION past its end
+DOWNLOAD_URL_CACHE_NAMESPACE = 'download_url'
+DOWNLOAD_URL_CACHE_EXPIRATION = 15*60
+
+
+# entries in GS retrieved at least HOT_CONTENT_MIN_HITS times during a period of
+# HOT_CONTENT_WINDOW seconds are copied to memcache, set to 0 to disable
+HIT_COUNT_NAMESPACE = 'hits'
+HOT_CONTENT_MIN_HITS = 10
+HOT_CONTENT_WINDOW = 10*60
+
+
+# maximum number of .isolated files returned by a single resolve_tree call
+MAX_RESOLVE_TREE_ITEMS = 1000
+
+
+# memcache namespace of the digests recently queued for tagging and for how long
+# (in seconds) they are remembered there
+TAG_CACHE_NAMESPACE = 'tagged'
+TAG_CACHE_EXPIRATION = 60*60
+
+
+# entries in GCS up to this size (in bytes) are verified in batches, larger ones
+# get a verify task each
+VERIFY_BATCH_MAX_SIZE = 1024*1024
+
+
+# the batch verify tasks are coalesced over this period (in seconds)
+VERIFY_BATCH_PERIOD = 1
+
+
 # messages for generating and validating upload tickets
 UPLOAD_MESSAGES = ['datastore', 'gs']
 
@@ -122,13 +192,53 @@ class TokenSigner(auth.TokenKind):
 
 @ndb.transactional
 def store_and_enqueue_verify_task(entry, task_queue_host):
+  """Stores |entry| and queues it for verification.
+
+  Small entries are queued in the verify-pull queue, to be verified in batches
+  by enqueue_verify_batch_task(), larger ones get a verify task each.
+
+  Returns:
+    True if the entry is verified in a batch.
+  """
   entry.put()
+  if entry.compressed_size <= VERIFY_BATCH_MAX_SIZE:
+    taskqueue.add(
+        payload=entry.key.id(),
+        method='PULL',
+        queue_name='verify-pull',
+        transactional=True,
+    )
+    return True
   taskqueue.add(
       url='/internal/taskqueue/verify/%s' % entry.key.id(),
       queue_name='verify',
       headers={'Host': task_queue_host},
       transactional=True,
   )
+  return False
+
+
+def enqueue_verify_batch_task(task_queue_host):
+  """Triggers a batch verification of the entries in the verify-pull queue.
+
+  The tasks are named per VERIFY_BATCH_PERIOD so that a single one runs for all
+  the entries finalized during that period. Errors are only logged, a cron job
+  picks up the entries left behind.
+  """
+  now = time.time()
+  period = int(now / VERIFY_BATCH_PERIOD)
+  try:
+    taskqueue.add(
+        url='/internal/taskqueue/verify/batch',
+        name='verify-batch-%d' % period,
+        queue_name='verify',
+        headers={'Host': task_queue_host},
+        countdown=(period + 1) * VERIFY_BATCH_PERIOD - now,
+    )
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+  except (taskqueue.Error, runtime.apiproxy_errors.Error) as e:
+    logging.warning('Failed to enqueue a verify batch task: %s', e)
 
 
 def entry_key_or_error(namespace, digest):
@@ -138,6 +248,70 @@ def entry_key_or_error(namespace, digest):
     raise endpoints.BadRequestException(error.message)
 
 
+def count_retrieval(entry):
+  """Counts a retrieval of an entry stored in GS.
+
+  Enqueues a task that copies the entry to memcache when it becomes hot.
+  """
+  if (not HOT_CONTENT_MIN_HITS or not entry.is_verified or
+      entry.compressed_size > model.MAX_MEMCACHE_HOT):
+    return
+  window = int(time.time() / HOT_CONTENT_WINDOW)
+  hits = memcache.incr(
+      '%s/%d' % (entry.key.id(), window),
+      initial_value=0,
+      namespace=HIT_COUNT_NAMESPACE)
+  # Only the retrieval that crosses the threshold enqueues the task.
+  if hits == HOT_CONTENT_MIN_HITS:
+    utils.enqueue_task(
+        url='/internal/taskqueue/hot/%s' % entry.key.id(),
+        queue_name='hot-content')
+
+
+def get_inline_contents(namespace, digests):
+  """Looks up the content of entities in memcache, then in ndb in a single
+  batch.
+
+  Returns:
+    Tuple (contents, found): dicts digest -> content and digest -> where it was
+    found, only for the entities not stored in GS.
+  """
+  contents = memcache.get_multi(digests, namespace='table_%s' % namespace)
+  found = dict.fromkeys(contents, 'memcache')
+  missing = [digest for digest in digests if digest not in contents]
+  entities = ndb.get_multi(
+      [model.entry_key(namespace, digest) for digest in missing])
+  for digest, stored in zip(missing, entities):
+    # content is None if entity is in GCS
+    if stored and stored.content is not None:
+      contents[digest] = stored.content
+      found[digest] = 'inline'
+  return contents, found
+
+
+def get_includes(namespace, digest, content):
+  """Returns the digests of the .isolated files included by an .isolated file.
+
+  Returns None if |content| is not a valid .isolated file.
+  """
+  try:
+    data = json.loads(''.join(model.expand_content(namespace, [content])))
+  except (ValueError, zlib.error) as e:
+    logging.warning('%s is not an .isolated file: %s', digest, e)
+    return None
+  includes = data.get('includes', []) if isinstance(data, dict) else None
+  if not isinstance(includes, list):
+    logging.warning('%s is not an .isolated file', digest)
+    return None
+  for include in includes:
+    try:
+      model.entry_key(namespace, include)
+    except (TypeError, ValueError):
+      logging.warning('%s includes an invalid digest', digest)
+      return None
+  return [str(include) for include in includes]
+
+
 ### API
 
 
@@ -221,6 +395,21 @@ class IsolateService(remote.Service):
     """Stores relatively small entities in the datastore."""
     return self.storage_helper(request, False)
 
+  @auth.endpoints_method(StorageRequestCollection, PushPing)
+  def store_inline_multi(self, request):
+    """Stores many relatively small entities in the datastore at once.
+
+    All the items are validated before any is stored.
+    """
+    if len(request.items) > model.MAX_KEYS_PER_DB_OPS:
+      raise endpoints.BadRequestException(
+          'Requested %d entries; max is %d.' % (
+              len(request.items), model.MAX_KEYS_PER_DB_OPS))
+    entries = [self.new_entry_from_request(i, False) for i in request.items]
+    ndb.put_multi(entries)
+    model.cache_existence([entry.key for entry in entries])
+    return PushPing(ok=True)
+
   @auth.endpoints_method(FinalizeRequest, PushPing)
   def finalize_gs_upload(self, request):
     """Informs client that large entities have been uploaded to GCS."""
@@ -268,9 +457,75 @@ class IsolateService(remote.Service):
         stats.RETURN,
         stored.compressed_size - offset,
         'GS; %s' % stored.key.id())
-    return RetrievedContent(url=self.gs_url_signer.get_download_url(
-        filename=key.id(),
-        expiration=DEFAULT_LINK_EXPIRATION))
+    count_retrieval(stored)
+    return RetrievedContent(url=self.get_download_url(key))
+
+  @auth.endpoints_method(
+      RetrieveMultiRequest, RetrievedCollection, http_method='POST')
+  def retrieve_multi(self, request):
+    """Retrieves the content of many small entities in a single call.
+
+    Only the entities whose content is in memcache or inline in the datastore
+    are returned, up to MAX_RETRIEVE_MULTI_SIZE bytes. The client fetches the
+    other ones, e.g. the ones in GS, with retrieve.
+    """
+    if len(request.digests) > model.MAX_KEYS_PER_DB_OPS:
+      raise endpoints.BadRequestException(
+          'Requested %d entries; max is %d.' % (
+              len(request.digests), model.MAX_KEYS_PER_DB_OPS))
+    namespace = request.namespace.namespace
+    for digest in request.digests:
+      entry_key_or_error(namespace, digest)
+
+    contents, found = get_inline_contents(namespace, request.digests)
+    response = RetrievedCollection()
+    total = 0
+    for digest in request.digests:
+      content = contents.get(digest)
+      if content is None or total + len(content) > MAX_RETRIEVE_MULTI_SIZE:
+        continue
+      total += len(content)
+      stats.add_entry(stats.RETURN, len(content), found[digest])
+      response.items.append(RetrievedItem(digest=digest, content=content))
+    return response
+
+  @auth.endpoints_method(
+      ResolveTreeRequest, RetrievedCollection, http_method='POST')
+  def resolve_tree(self, request):
+    """Retrieves a .isolated file and all the .isolated files it includes.
+
+    The include graph is walked one level at a time, with a single memcache and
+    datastore batch per level. Only the .isolated files in memcache or inline
+    in the datastore are returned, up to MAX_RETRIEVE_MULTI_SIZE bytes, and the
+    walk stops at the other ones. The client fetches those with retrieve.
+    """
+    namespace = request.namespace.namespace
+    entry_key_or_error(namespace, request.digest)
+
+    response = RetrievedCollection()
+    seen = set()
+    level = [request.digest]
+    total = 0
+    while level:
+      seen.update(level)
+      contents, found = get_inline_contents(namespace, level)
+      next_level = []
+      for digest in level:
+        content = contents.get(digest)
+        if (content is None or
+            total + len(content) > MAX_RETRIEVE_MULTI_SIZE or
+            len(response.items) >= MAX_RESOLVE_TREE_ITEMS):
+          continue
+        includes = get_includes(namespace, digest, content)
+        if includes is None:
+          continue
+        total += len(content)
+        stats.add_entry(stats.RETURN, len(content), found[digest])
+        response.items.append(RetrievedItem(digest=digest, content=content))
+        next_level.extend(
+            i for i in includes if i not in seen and i not in next_level)
+      level = next_level
+    return response
 
   @auth.endpoints_method(message_types.VoidMessage, ServerDetails)
   def server_details(self, _request):
@@ -280,6 +535,40 @@ class IsolateService(remote.Service):
 
   def storage_helper(self, request, uploaded_to_gs):
     """Implement shared logic between store_inline and finalize_gs."""
+    entry = self.new_entry_from_request(request, uploaded_to_gs)
+
+    # DB: the content was verified, store it right away
+    if not uploaded_to_gs:
+      entry.put()
+      model.cache_existence([entry.key])
+
+    # GCS: enqueue verification task
+    else:
+      task_queue_host = utils.get_task_queue_host()
+      try:
+        batched = store_and_enqueue_verify_task(entry, task_queue_host)
+      except (
+          datastore_errors.Error,
+          runtime.apiproxy_errors.CancelledError,
+          runtime.apiproxy_errors.DeadlineExceededError,
+          runtime.apiproxy_errors.OverQuotaError,
+          runtime.DeadlineExceededError,
+          taskqueue.Error) as e:
+        raise endpoints.InternalServerErrorException(
+            'Unable to store the entity: %s.' % e.__class__.__name__)
+      model.cache_existence([entry.key])
+      if batched:
+        enqueue_verify_batch_task(task_queue_host)
+
+    return PushPing(ok=True)
+
+  @classmethod
+  def new_entry_from_request(cls, request, uploaded_to_gs):
+    """Validates the upload ticket of |request| and returns a new ContentEntry.
+
+    Doesn't store it. For inline content, also verifies that the content matches
+    the digest.
+    """
     # validate token or error out
     if not request.upload_ticket:
       raise endpoints.BadRequestException(
@@ -330,23 +619,7 @@ class IsolateService(remote.Service):
       if (digest, size) != hash_content(content, namespace):
         raise endpoints.BadRequestException(
             'Embedded digest does not match provided data.')
-      entry.put()
-
-    # GCS: enqueue verification task
-    else:
-      try:
-        store_and_enqueue_verify_task(entry, utils.get_task_queue_host())
-      except (
-          datastore_errors.Error,
-          runtime.apiproxy_errors.CancelledError,
-          runtime.apiproxy_errors.DeadlineExceededError,
-          runtime.apiproxy_errors.OverQuotaError,
-          runtime.DeadlineExceededError,
-          taskqueue.Error) as e:
-        raise endpoints.InternalServerErrorException(
-            'Unable to store the entity: %s.' % e.__class__.__name__)
-
-    return PushPing(ok=True)
+    return entry
 
   @classmethod
   def generate_ticket(cls, digest, namespace):
@@ -393,19 +666,34 @@ class IsolateService(remote.Service):
     Raises:
       BadRequestException if any digest is not a valid hexadecimal number.
     """
-    # Kick off all queries in parallel. Build mapping Future -> digest.
-    futures = {}
-    for digest in entries.items:
-      # check for error conditions
-      key = entry_key_or_error(entries.namespace.namespace, digest.digest)
-      futures[key.get_async(use_cache=False)] = digest
-
-    # Pick first one that finishes and yield it, rinse, repeat.
-    while futures:
-      future = ndb.Future.wait_any(futures)
+    # check for error conditions
+    keys = [
+      entry_key_or_error(entries.namespace.namespace, digest.digest)
+      for digest in entries.items
+    ]
+
+    # Most digests were recently seen; answer them from the existence cache.
+    cached = model.get_cached_existence(keys)
+    missed = []
+    for key, digest in zip(keys, entries.items):
+      if key.id() in cached:
+        yield digest, True
+      else:
+        missed.append((key, digest))
+    if not missed:
+      return
+
+    # Look up the rest in the datastore in a single batch.
+    futures = ndb.get_multi_async([key for key, _ in missed], use_cache=False)
+    found = []
+    for (key, digest), future in zip(missed, futures):
       # TODO(maruel): For items that were present, make sure
       # future.get_result().compressed_size == digest.size.
-      yield futures.pop(future), bool(future.get_result())
+      exists = bool(future.get_result())
+      if exists:
+        found.append(key)
+      yield digest, exists
+    model.cache_existence(found)
 
   @classmethod
   def partition_collection(cls, entries):
@@ -435,20 +723,65 @@ class IsolateService(remote.Service):
           settings.gs_private_key)
     return self._gs_url_signer
 
+  def get_download_url(self, key):
+    """Returns a signed URL to download the content of an entry from GS.
+
+    The URL is signed once per DOWNLOAD_URL_CACHE_EXPIRATION period and cached
+    in memcache in between.
+    """
+    period = int(time.time() / DOWNLOAD_URL_CACHE_EXPIRATION)
+    cache_key = '%s/%d' % (key.id(), period)
+    url = memcache.get(cache_key, namespace=DOWNLOAD_URL_CACHE_NAMESPACE)
+    if url is None:
+      # the URL is returned until the end of the period
+      expiration = (
+          DEFAULT_LINK_EXPIRATION +
+          datetime.timedelta(seconds=DOWNLOAD_URL_CACHE_EXPIRATION))
+      url = self.gs_url_signer.get_download_url(
+          filename=key.id(), expiration=expiration)
+      memcache.set(
+          cache_key, url, time=DOWNLOAD_URL_CACHE_EXPIRATION,
+          namespace=DOWNLOAD_URL_CACHE_NAMESPACE)
+    return url
+
   @classmethod
   def tag_existing(cls, collection):
     """Tag existing digests with new timestamp.
 
+    The digests are buffered in the tag pull queue, which is flushed in large
+    batches by a cron job. A digest is only queued once per
+    TAG_CACHE_EXPIRATION, no matter how many clients look it up.
+
     Arguments:
       collection: a DigestCollection containing existing digests
 
     Returns:
-      the enqueued task if there were existing entries; None otherwise
+      True if digests were queued, False if the task queue failed and None if
+      there was nothing to queue.
     """
-    if collection.items:
-      url = '/internal/taskqueue/tag/%s/%s' % (
-          collection.namespace.namespace,
-          utils.datetime_to_timestamp(utils.utcnow()))
-      payload = ''.join(
-          binascii.unhexlify(digest.digest) for digest in collection.items)
-      return utils.enqueue_task(url, 'tag', payload=payload)
+    namespace = collection.namespace.namespace
+    cache_keys = dict(
+        ('%s/%s' % (namespace, digest.digest), digest.digest)
+        for digest in collection.items)
+    if not cache_keys:
+      return None
+    # add_multi() returns the keys that were already present.
+    queued = set(memcache.add_multi(
+        dict.fromkeys(cache_keys, 1),
+        time=TAG_CACHE_EXPIRATION,
+        namespace=TAG_CACHE_NAMESPACE))
+    new_keys = [k for k in cache_keys if k not in queued]
+    if not new_keys:
+      return None
+    task = taskqueue.Task(
+        payload=''.join(binascii.unhexlify(cache_keys[k]) for k in new_keys),
+        method='PULL',
+        tag=namespace)
+    try:
+      taskqueue.Queue('tag-pull').add(task)
+    except (taskqueue.Error, runtime.apiproxy_errors.Error) as e:
+      logging.warning('Failed to queue %d digests: %s', len(new_keys), e)
+      # Let the next lookup retry.
+      memcache.delete_multi(new_keys, namespace=TAG_CACHE_NAMESPACE)
+      return False
+    return True
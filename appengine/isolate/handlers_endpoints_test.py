@@ -4,9 +4,11 @@
 # found in the LICENSE file.
 
 import base64
+import datetime
 import json
 import logging
 import sys
+import time
 import unittest
 from Crypto.PublicKey import RSA
 
@@ -15,6 +17,7 @@ test_env.setup_test_env()
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 from protorpc.remote import protojson
 import webapp2
@@ -232,7 +235,7 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     _ = self.execute_tasks()
 
   def test_check_existing_enqueues_tasks(self):
-    """Assert that existent entities are enqueued."""
+    """Assert that existent entities are buffered for tagging once."""
     collection = handlers_endpoints.DigestCollection(
         namespace=handlers_endpoints.Namespace())
     collection.items.append(
@@ -240,14 +243,73 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     key = model.entry_key(
         collection.namespace.namespace, collection.items[0].digest)
 
-    # guarantee that one digest already exists in the datastore
-    model.new_content_entry(key).put()
-    self.call_api(
+    # guarantee that one digest already exists in the datastore and is due for
+    # tagging
+    entry = model.new_content_entry(key)
+    old_next_tag_ts = datetime.datetime(2010, 1, 1)
+    entry.next_tag_ts = old_next_tag_ts
+    entry.put()
+    for _ in xrange(3):
+      self.call_api(
+          'preupload', self.message_to_dict(collection), 200)
+
+    # no push task; a single pull task no matter how many lookups
+    self.assertEqual(0, self.execute_tasks())
+    tasks = self._taskqueue_stub.GetTasks('tag-pull')
+    self.assertEqual(1, len(tasks))
+
+    # the cron job flushes the pull queue
+    self.app.get(
+        '/internal/cron/tag/flush', headers={'X-AppEngine-Cron': 'true'})
+    self.assertEqual([], self._taskqueue_stub.GetTasks('tag-pull'))
+    self.assertGreater(key.get().next_tag_ts, old_next_tag_ts)
+
+  def test_check_existing_uses_existence_cache(self):
+    """Assert that cached digests are not looked up in the datastore."""
+    collection = generate_collection(['small content', 'larger content'])
+    keys = [
+      model.entry_key(collection.namespace.namespace, item.digest)
+      for item in collection.items
+    ]
+    model.new_content_entry(keys[1]).put()
+    # Only in the existence cache, not in the datastore.
+    model.cache_existence([keys[0]])
+    lookups = []
+    get_multi_async = ndb.get_multi_async
+    def mocked_get_multi_async(lookup_keys, **kwargs):
+      lookups.append(lookup_keys)
+      return get_multi_async(lookup_keys, **kwargs)
+    self.mock(ndb, 'get_multi_async', mocked_get_multi_async)
+
+    response = self.call_api(
         'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual([], response.json.get('items', []))
+    # Only the uncached digest was looked up, in a single batch.
+    self.assertEqual([[keys[1]]], lookups)
+    # The digest found in the datastore is now cached too.
+    self.assertEqual(
+        set(k.id() for k in keys), model.get_cached_existence(keys))
+    _ = self.execute_tasks()
 
-    # find enqueued tasks
-    enqueued_tasks = self.execute_tasks()
-    self.assertEqual(1, enqueued_tasks)
+  def test_check_existing_deleted_while_looked_up(self):
+    """Assert that an entry deleted during the lookup is not cached."""
+    collection = generate_collection(['small content'])
+    key = model.entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(key).put()
+    self.mock(gcs, 'delete_files', lambda *_args, **_kwargs: [])
+    get_multi_async = ndb.get_multi_async
+    def mocked_get_multi_async(lookup_keys, **kwargs):
+      futures = get_multi_async(lookup_keys, **kwargs)
+      ndb.Future.wait_all(futures)
+      # The cleanup deletes the entry after it was found.
+      model.delete_entry_and_gs_entry(lookup_keys)
+      return futures
+    self.mock(ndb, 'get_multi_async', mocked_get_multi_async)
+
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(set(), model.get_cached_existence([key]))
+    _ = self.execute_tasks()
 
   def test_store_inline_ok(self):
     """Assert that inline content storage completes successfully."""
@@ -309,6 +371,30 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'store_inline', self.message_to_dict(request), 200)
 
+  def test_store_inline_multi_ok(self):
+    """Assert that many inline contents are stored in one call."""
+    contents = ['ode', 'to a nightingale']
+    requests = [self.store_request(content) for content in contents]
+    keys = []
+    for request in requests:
+      embedded = validate(
+          request.upload_ticket, handlers_endpoints.UPLOAD_MESSAGES[0])
+      keys.append(model.entry_key(embedded['n'], embedded['d']))
+    collection = handlers_endpoints.StorageRequestCollection(items=requests)
+    self.call_api(
+        'store_inline_multi', self.message_to_dict(collection), 200)
+    self.assertEqual(contents, [e.content for e in ndb.get_multi(keys)])
+
+  def test_store_inline_multi_bad_digest(self):
+    """Assert that nothing is stored when one of the items is invalid."""
+    requests = [self.store_request(c) for c in ('la belle', 'dame sans merci')]
+    requests[1].content = ':)' + requests[1].content[2:]
+    collection = handlers_endpoints.StorageRequestCollection(items=requests)
+    with self.call_should_fail('400'):
+      self.call_api(
+          'store_inline_multi', self.message_to_dict(collection), 200)
+    self.assertEqual(0, model.ContentEntry.query().count())
+
   def test_finalized_data_in_gs(self):
     """Assert that data are actually in GS when finalized."""
     # create content
@@ -370,6 +456,36 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     self.assertEqual(1, self.execute_tasks())
     self.assertTrue(stored.key.get().is_verified)
 
+  def test_finalize_gs_verifies_in_batch(self):
+    """Assert that small GS entries are verified by a single task."""
+    contents = {}
+    requests = []
+    for content in (pad_string('sonnet'), pad_string('elegy')):
+      request = self.store_request(content)
+      embedded = validate(
+          request.upload_ticket, handlers_endpoints.UPLOAD_MESSAGES[1])
+      contents[model.entry_key(embedded['n'], embedded['d']).id()] = content
+      requests.append(request)
+    self.mock(
+        gcs, 'get_file_info',
+        lambda _bucket, key_id: FileInfaux(contents[key_id]))
+    self.mock(gcs, 'read_file', lambda _bucket, key_id: contents[key_id])
+    # both entries are finalized within the same VERIFY_BATCH_PERIOD
+    now = int(time.time()) + 0.5
+    self.mock(time, 'time', lambda: now)
+
+    for request in requests:
+      self.call_api(
+          'finalize_gs_upload', self.message_to_dict(request), 200)
+    self.assertEqual(
+        2, len(self._taskqueue_stub.GetTasks('verify-pull')))
+
+    # a single batch task verifies both entries
+    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual([], self._taskqueue_stub.GetTasks('verify-pull'))
+    for key_id in contents:
+      self.assertTrue(model.entry_key_from_id(key_id).get().is_verified)
+
   def test_storage_wrong_type(self):
     """Assert that GS and inline storage fail when the wrong type is sent."""
     small = 'elephant'
@@ -436,6 +552,76 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     retrieved = response.json
     self.assertEqual(content, base64.b64decode(retrieved.get(u'content', '')))
 
+  def test_retrieve_multi_ok(self):
+    """Assert that many small entities are retrieved in a single call."""
+    namespace = handlers_endpoints.Namespace()
+    contents = ['Endymion', 'Hyperion']
+    for content in contents:
+      request = self.store_request(content)
+      self.call_api('store_inline', self.message_to_dict(request), 200)
+    # one is only in the datastore, the other one is also in memcache
+    memcache.flush_all()
+    model.save_in_memcache(
+        namespace.namespace, hash_content(contents[1], namespace.namespace),
+        contents[1])
+    # the ones in GS and the missing ones are left to retrieve
+    in_gs = hash_content('Lamia', namespace.namespace)
+    model.new_content_entry(
+        model.entry_key(namespace.namespace, in_gs)).put()
+    missing = hash_content('Ode to Psyche', namespace.namespace)
+
+    digests = [hash_content(c, namespace.namespace) for c in contents]
+    retrieve_request = handlers_endpoints.RetrieveMultiRequest(
+        digests=digests + [in_gs, missing], namespace=namespace)
+    response = self.call_api(
+        'retrieve_multi', self.message_to_dict(retrieve_request), 200)
+    retrieved = [
+      (item['digest'], base64.b64decode(item['content']))
+      for item in response.json['items']
+    ]
+    self.assertEqual(zip(digests, contents), retrieved)
+
+  def test_resolve_tree_ok(self):
+    """Assert that a tree of .isolated files is retrieved in a single call."""
+    namespace = handlers_endpoints.Namespace()
+    def store_isolated(includes, in_gs=False):
+      content = json.dumps({'includes': includes})
+      digest = hash_content(content, namespace.namespace)
+      model.new_content_entry(
+          model.entry_key(namespace.namespace, digest),
+          content=None if in_gs else content,
+          is_isolated=True).put()
+      return digest, content
+
+    # the one in GS and the ones it includes are left to retrieve
+    in_gs, _ = store_isolated([], in_gs=True)
+    leaf = store_isolated([])
+    middle = store_isolated([leaf[0], in_gs])
+    root = store_isolated([middle[0], leaf[0]])
+
+    retrieve_request = handlers_endpoints.ResolveTreeRequest(
+        digest=root[0], namespace=namespace)
+    response = self.call_api(
+        'resolve_tree', self.message_to_dict(retrieve_request), 200)
+    retrieved = [
+      (item['digest'], base64.b64decode(item['content']))
+      for item in response.json['items']
+    ]
+    self.assertEqual([root, middle, leaf], retrieved)
+
+  def test_resolve_tree_not_isolated(self):
+    """Assert that resolve_tree doesn't walk past invalid .isolated files."""
+    namespace = handlers_endpoints.Namespace()
+    content = 'Ode on Melancholy'
+    request = self.store_request(content)
+    self.call_api('store_inline', self.message_to_dict(request), 200)
+
+    retrieve_request = handlers_endpoints.ResolveTreeRequest(
+        digest=hash_content(content, namespace.namespace), namespace=namespace)
+    response = self.call_api(
+        'resolve_tree', self.message_to_dict(retrieve_request), 200)
+    self.assertEqual([], response.json.get('items', []))
+
   def test_retrieve_gs_url_ok(self):
     """Assert that URL retrieval works for GS entities."""
 
@@ -467,6 +653,64 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     # clear the taskqueue
     self.assertEqual(1, self.execute_tasks())
 
+  def test_retrieve_gs_url_cached(self):
+    """Assert that the signed URL of a GS entity is reused."""
+    namespace = handlers_endpoints.Namespace()
+    digest = hash_content('Hyperion', namespace.namespace)
+    model.new_content_entry(
+        model.entry_key(namespace.namespace, digest),
+        compressed_size=len('Hyperion')).put()
+    signed = []
+    def get_download_url(_self, filename, expiration):
+      signed.append(expiration)
+      return 'https://signed/%s' % filename
+    self.mock(gcs.URLSigner, 'get_download_url', get_download_url)
+
+    retrieve_request = handlers_endpoints.RetrieveRequest(
+        digest=digest, namespace=namespace)
+    for _ in xrange(3):
+      response = self.call_api(
+          'retrieve', self.message_to_dict(retrieve_request), 200)
+      self.assertEqual(
+          'https://signed/default/%s' % digest, response.json['url'])
+    # signed once, to stay valid past the end of the caching period
+    self.assertEqual(
+        [handlers_endpoints.DEFAULT_LINK_EXPIRATION + datetime.timedelta(
+            seconds=handlers_endpoints.DOWNLOAD_URL_CACHE_EXPIRATION)],
+        signed)
+
+  def test_retrieve_gs_hot_content(self):
+    """Assert that a frequently retrieved GS entity is copied to memcache."""
+    self.mock(handlers_endpoints, 'HOT_CONTENT_MIN_HITS', 2)
+    namespace = handlers_endpoints.Namespace()
+    content = pad_string('Endymion')
+    digest = hash_content(content, namespace.namespace)
+    model.new_content_entry(
+        model.entry_key(namespace.namespace, digest),
+        compressed_size=len(content),
+        is_verified=True).put()
+    self.mock(gcs, 'read_file', lambda _bucket, _key: [content])
+
+    retrieve_request = handlers_endpoints.RetrieveRequest(
+        digest=digest, namespace=namespace)
+    for _ in xrange(2):
+      response = self.call_api(
+          'retrieve', self.message_to_dict(retrieve_request), 200)
+      self.assertIn('url', response.json)
+    self.assertEqual(1, self.execute_tasks())
+
+    # now served directly from memcache
+    response = self.call_api(
+        'retrieve', self.message_to_dict(retrieve_request), 200)
+    self.assertEqual(content, base64.b64decode(response.json['content']))
+
+    # until it is deleted
+    self.mock(gcs, 'delete_files', lambda *_args, **_kwargs: [])
+    model.delete_entry_and_gs_entry(
+        [model.entry_key(namespace.namespace, digest)])
+    with self.call_should_fail('404'):
+      self.call_api('retrieve', self.message_to_dict(retrieve_request), 200)
+
   def test_retrieve_partial_ok(self):
     """Assert that content retrieval works when a range is specified."""
     content = 'Song of the Andoumboulou'
@@ -28,10 +28,29 @@ MAX_KEYS_PER_DB_OPS = 1000
 MAX_MEMCACHE_ISOLATED = 500*1024
 
 
+# Maximum size of a frequently retrieved file stored in GS to be copied to
+# memcache, which rejects values larger than 1MB, and for how long (in seconds)
+# it is kept there.
+MAX_MEMCACHE_HOT = 1000*1024
+HOT_CONTENT_EXPIRATION = 60*60
+
+
 # Valid namespace key.
 NAMESPACE_RE = r'[a-z0-9A-Z\-._]+'
 
 
+# Memcache namespace of the existence cache of recently seen ContentEntry and
+# for how long (in seconds) an entry is remembered there. Entries are removed
+# explicitly when their ContentEntry is deleted.
+EXISTENCE_CACHE_NAMESPACE = 'exists'
+EXISTENCE_CACHE_EXPIRATION = 60*60
+
+# For how long (in seconds) a digest removed from the existence cache can't be
+# added back. It covers a lookup that found the ContentEntry right before it was
+# deleted and caches it afterward.
+EXISTENCE_CACHE_DELETE_LOCK = 60
+
+
 #### Models
 
 
@@ -91,6 +110,24 @@ class ContentEntry(ndb.Model):
     return self.key.parent().id().endswith(('-bzip2', '-deflate', '-gzip'))
 
 
+class CleanupShard(ndb.Model):
+  """A cleanup shard whose chain of task queue tasks is in flight.
+
+  Key is '<cleanup>:<shard>', where the shard is a range of expiration_ts for
+  the expired entries and a subdirectory for the lost GS files. They are root
+  entities so the shards of a cleanup can be updated concurrently.
+  """
+  # Name of the cleanup.
+  cleanup = ndb.StringProperty()
+
+  # Moment after which the chain is considered dead, e.g. its task ran out of
+  # retries, so the shard can be triggered again.
+  lease_ts = ndb.DateTimeProperty(indexed=False)
+
+  # End of the range of expiration_ts, as a timestamp, for the expired entries.
+  end = ndb.IntegerProperty(indexed=False)
+
+
 ### Private stuff.
 
 
@@ -135,6 +172,11 @@ def entry_key_from_id(key_id):
       parent=datastore_utils.shard_key(hash_key, N, 'ContentShard'))
 
 
+def cleanup_shard_key(cleanup, shard):
+  """Returns the ndb.Key for a CleanupShard."""
+  return ndb.Key(CleanupShard, '%s:%s' % (cleanup, shard))
+
+
 def expiration_jitter(now, expiration):
   """Returns expiration/next_tag pair to set in a ContentEntry."""
   jittered = random.uniform(1, 1.2) * expiration
@@ -177,13 +219,14 @@ def expand_content(namespace, source):
       del i
 
 
-def save_in_memcache(namespace, hash_key, content, async=False):
+def save_in_memcache(namespace, hash_key, content, async=False, expiration=0):
   namespace_key = 'table_%s' % namespace
   if async:
     return ndb.get_context().memcache_set(
-        hash_key, content, namespace=namespace_key)
+        hash_key, content, time=expiration, namespace=namespace_key)
   try:
-    if not memcache.set(hash_key, content, namespace=namespace_key):
+    if not memcache.set(
+        hash_key, content, time=expiration, namespace=namespace_key):
       msg = 'Failed to save content to memcache.\n%s\\%s %d bytes' % (
           namespace_key, hash_key, len(content))
       if len(content) < 100*1024:
@@ -194,6 +237,54 @@ def save_in_memcache(namespace, hash_key, content, async=False):
     logging.error(e)
 
 
+def get_cached_existence(keys):
+  """Returns the set of ContentEntry key ids known to exist.
+
+  Only looks at the existence cache, which is one batched memcache call. Each
+  digest has its own memcache key, so the cache is spread over all the memcache
+  shards.
+  """
+  if not keys:
+    return set()
+  return set(memcache.get_multi(
+      [key.id() for key in keys], namespace=EXISTENCE_CACHE_NAMESPACE))
+
+
+def cache_existence(keys):
+  """Records in the existence cache that the ContentEntry |keys| exist.
+
+  The digests removed by forget_existence() in the last
+  EXISTENCE_CACHE_DELETE_LOCK seconds are not added back.
+  """
+  if keys:
+    memcache.add_multi(
+        dict.fromkeys((key.id() for key in keys), 1),
+        time=EXISTENCE_CACHE_EXPIRATION,
+        namespace=EXISTENCE_CACHE_NAMESPACE)
+
+
+def forget_existence(keys):
+  """Removes the ContentEntry |keys| from the existence cache."""
+  if keys:
+    memcache.delete_multi(
+        [key.id() for key in keys], seconds=EXISTENCE_CACHE_DELETE_LOCK,
+        namespace=EXISTENCE_CACHE_NAMESPACE)
+
+
+def forget_content(keys):
+  """Removes the content of the ContentEntry |keys| from memcache.
+
+  It covers both the small entries saved there on upload and the hot entries
+  copied there from GS.
+  """
+  per_namespace = {}
+  for key in keys:
+    namespace, hash_key = key.id().rsplit('/', 1)
+    per_namespace.setdefault(namespace, []).append(hash_key)
+  for namespace, hash_keys in per_namespace.iteritems():
+    memcache.delete_multi(hash_keys, namespace='table_%s' % namespace)
+
+
 def new_content_entry(key, **kwargs):
   """Generates a new ContentEntry for the request.
 
@@ -215,6 +306,8 @@ def delete_entry_and_gs_entry(keys_to_delete):
   """
   # Always delete ContentEntry first.
   ndb.delete_multi(keys_to_delete)
+  forget_existence(keys_to_delete)
+  forget_content(keys_to_delete)
   # Note that some content entries may NOT have corresponding GS files. That
   # happens for small entries stored inline in the datastore or memcache. Since
   # this function operates only on keys, it can't distinguish "large" entries
@@ -73,6 +73,26 @@ def log_unexpected_keys(expected_keys, actual_keys, request, source, name):
       expected_keys, expected_keys, actual_keys, request, source, name)
 
 
+def _trim_utf8(data):
+  """Returns data without its trailing incomplete UTF-8 sequence, if any.
+
+  A ranged read may end in the middle of a multi-byte character, which must not
+  be decoded before the rest of the character is read.
+  """
+  # A sequence is at most 4 bytes long; look for its lead byte.
+  for i in xrange(1, min(len(data), 4) + 1):
+    c = ord(data[-i])
+    if c & 0xC0 == 0x80:
+      # Continuation byte.
+      continue
+    if c >= 0xC0:
+      needed = 2 if c < 0xE0 else (3 if c < 0xF0 else 4)
+      if needed > i:
+        return data[:-i]
+    break
+  return data
+
+
 def process_doc(handler):
   lines = handler.__doc__.rstrip().splitlines()
   rest = textwrap.dedent('\n'.join(lines[1:]))
@@ -181,15 +201,38 @@ class ClientTaskResultOutputHandler(ClientTaskResultBase):
 
   @auth.require(acl.is_bot_or_user)
   def get(self, task_id, command_index):
+    # When 'offset' or 'length' is specified, only this byte range is returned
+    # along 'next_offset', so a client can tail the output of a running task
+    # without fetching it all again.
+    ranged = 'offset' in self.request.GET or 'length' in self.request.GET
+    try:
+      offset = int(self.request.get('offset', 0))
+      length = self.request.get('length')
+      length = int(length) if length else None
+    except ValueError:
+      self.abort_with_error(400, error='Invalid offset or length')
+    if offset < 0 or (length is not None and length < 0):
+      self.abort_with_error(400, error='Invalid offset or length')
+
     result = self.get_result_entity(task_id)
-    output = result.get_command_output_async(int(command_index)).get_result()
+    output = result.get_command_output_async(
+        int(command_index), offset, length).get_result()
+    data = {}
+    if ranged:
+      # The rest of a truncated character is returned by the next read, unless
+      # the read reached the end of the output of a task that is done. The
+      # final bytes are then decoded as in ClientTaskResultOutputAllHandler.
+      max_length = task_result.TaskOutput.FETCH_MAX_CONTENT
+      if length is not None:
+        max_length = min(length, max_length)
+      if output and (result.is_running or len(output) >= max_length):
+        output = _trim_utf8(output)
+      data['next_offset'] = offset + len(output or '')
     if output:
       output = output.decode('utf-8', 'replace')
     # JSON then reencodes to ascii compatible encoded strings, which explodes
     # the size.
-    data = {
-      'output': output,
-    }
+    data['output'] = output
     self.send_response(utils.to_json_encodable(data))
 
 
@@ -276,6 +319,7 @@ class ClientApiBots(auth.ApiHandler):
     cursor = datastore_query.Cursor(urlsafe=self.request.get('cursor'))
     q = bot_management.BotInfo.query().order(bot_management.BotInfo.key)
     bots, cursor, more = q.fetch_page(limit, start_cursor=cursor)
+    bot_management.merge_heartbeats(bots)
     data = {
       'cursor': cursor.urlsafe() if cursor and more else None,
       'death_timeout': config.settings().bot_death_timeout_secs,
@@ -294,6 +338,7 @@ class ClientApiBot(auth.ApiHandler):
     bot = bot_management.get_info_key(bot_id).get()
     if not bot:
       self.abort_with_error(404, error='Bot not found')
+    bot_management.merge_heartbeats([bot])
     now = utils.utcnow()
     self.send_response(utils.to_json_encodable(bot.to_dict_with_now(now)))
 
@@ -354,6 +354,50 @@ class ClientApiTest(test_env_handlers.AppTestBase):
         '/swarming/api/v1/client/task/%s/output/1' % run_id).json
     self.assertEqual({'output': None}, response)
 
+  def test_get_task_output_range(self):
+    self.client_create_task()
+
+    self.set_as_bot()
+    task_id = self.bot_run_task()
+
+    self.set_as_privileged_user()
+    url = '/swarming/api/v1/client/task/%s/output/0' % task_id
+    response = self.app.get(url + '?offset=0&length=1').json
+    self.assertEqual({'next_offset': 1, 'output': u'r'}, response)
+    # u'É' is 2 bytes long, it is not cut in half.
+    response = self.app.get(url + '?offset=0&length=2').json
+    self.assertEqual({'next_offset': 1, 'output': u'r'}, response)
+    response = self.app.get(url + '?offset=1&length=2').json
+    self.assertEqual({'next_offset': 3, 'output': u'\xc9'}, response)
+    response = self.app.get(url + '?offset=3').json
+    self.assertEqual({'next_offset': 14, 'output': u'sult string'}, response)
+    response = self.app.get(url + '?offset=14').json
+    self.assertEqual({'next_offset': 14, 'output': u''}, response)
+    self.app.get(url + '?offset=-1', status=400)
+    self.app.get(url + '?length=a', status=400)
+
+  def test_get_task_output_range_completed(self):
+    # The output of a completed task ends with a truncated character. It is not
+    # held back forever but decoded like the whole output.
+    self.client_create_task()
+    self.set_as_bot()
+    token, _ = self.get_bot_token()
+    task_id = self.bot_poll()['manifest']['task_id']
+    self.bot_complete_task(
+        token, task_id=task_id, output=base64.b64encode('r\xc3'))
+
+    self.set_as_privileged_user()
+    url = '/swarming/api/v1/client/task/%s/output/0' % task_id
+    response = self.app.get(url + '?offset=0&length=2').json
+    self.assertEqual({'next_offset': 1, 'output': u'r'}, response)
+    response = self.app.get(url + '?offset=0').json
+    self.assertEqual({'next_offset': 2, 'output': u'r\ufffd'}, response)
+    response = self.app.get(url + '?offset=1&length=5').json
+    self.assertEqual({'next_offset': 2, 'output': u'\ufffd'}, response)
+    response = self.app.get(
+        '/swarming/api/v1/client/task/%s/output/all' % task_id).json
+    self.assertEqual({'outputs': [u'r\ufffd']}, response)
+
   def test_get_task_output_empty(self):
     _, task_id = self.client_create_task()
     response = self.app.get(
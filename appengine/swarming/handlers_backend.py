@@ -4,13 +4,18 @@
 
 """Main entry point for Swarming backend handlers."""
 
+import logging
+
 import webapp2
 from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
 
 import mapreduce_jobs
 from components import decorators
+from server import bot_management
 from server import stats
+from server import task_pack
+from server import task_result
 from server import task_scheduler
 
 
@@ -30,6 +35,22 @@ class CronAbortExpiredShardToRunHandler(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class CronRebuildDispatchIndexHandler(webapp2.RequestHandler):
+  @decorators.require_cronjob
+  def get(self):
+    task_scheduler.cron_rebuild_dispatch_index()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class CronFlushBotHeartbeatsHandler(webapp2.RequestHandler):
+  @decorators.require_cronjob
+  def get(self):
+    bot_management.cron_flush_heartbeats()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 class CronTriggerCleanupDataHandler(webapp2.RequestHandler):
   """Triggers task to delete orphaned blobs."""
 
@@ -52,6 +73,22 @@ class TaskCleanupDataHandler(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class TaskCompactOutputHandler(webapp2.RequestHandler):
+  """Compacts the output of a task. The payload is the packed run id."""
+
+  @decorators.require_taskqueue('compact-output')
+  def post(self):
+    try:
+      run_result_key = task_pack.unpack_run_result_key(self.request.body)
+    except ValueError as e:
+      # Do not retry, it would fail the same way.
+      logging.error('Invalid task id %r: %s', self.request.body, e)
+    else:
+      task_result.compact_output(run_result_key)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 ### Mapreduce related handlers
 
 
@@ -75,12 +112,15 @@ def get_routes():
     ('/internal/cron/handle_bot_died', CronBotDiedHandler),
     ('/internal/cron/abort_expired_task_to_run',
         CronAbortExpiredShardToRunHandler),
+    ('/internal/cron/rebuild_dispatch_index', CronRebuildDispatchIndexHandler),
+    ('/internal/cron/flush_bot_heartbeats', CronFlushBotHeartbeatsHandler),
 
     ('/internal/cron/stats/update', stats.InternalStatsUpdateHandler),
     ('/internal/cron/trigger_cleanup_data', CronTriggerCleanupDataHandler),
 
     # Task queues.
     ('/internal/taskqueue/cleanup_data', TaskCleanupDataHandler),
+    ('/internal/taskqueue/compact_output', TaskCompactOutputHandler),
 
     # Mapreduce related urls.
     (r'/internal/taskqueue/mapreduce/launch/<job_id:[^\/]+>',
@@ -8,6 +8,8 @@ import base64
 import json
 import logging
 import textwrap
+import time
+import zlib
 
 import webapp2
 
@@ -29,6 +31,12 @@ from server import task_scheduler
 from server import task_to_run
 
 
+# Maximum duration in seconds a /poll request is held when the bot long polls.
+# The reap itself can take up to 40s and the request has to complete within the
+# 60s frontend deadline.
+BOT_LONG_POLL_MAX_SECS = 15
+
+
 def has_unexpected_subset_keys(expected_keys, minimum_keys, actual_keys, name):
   """Returns an error if unexpected keys are present or expected keys are
   missing.
@@ -138,6 +146,7 @@ class _BotBaseHandler(auth.ApiHandler):
   """
 
   EXPECTED_KEYS = {u'dimensions', u'state', u'version'}
+  OPTIONAL_KEYS = set()
   REQUIRED_STATE_KEYS = {u'running_time', u'sleep_streak'}
 
   def _process(self):
@@ -172,8 +181,9 @@ class _BotBaseHandler(auth.ApiHandler):
     # Use a dummy 'for' to be able to break early from the block.
     for _ in [0]:
 
-      quarantined_msg = has_unexpected_keys(
-          self.EXPECTED_KEYS, request, 'keys')
+      quarantined_msg = has_unexpected_subset_keys(
+          self.EXPECTED_KEYS | self.OPTIONAL_KEYS, self.EXPECTED_KEYS,
+          request, 'keys')
       if quarantined_msg:
         break
 
@@ -266,8 +276,15 @@ class BotPollHandler(_BotBaseHandler):
   errors in bot code doesn't kill all the fleet at once, they should still be up
   just enough to be able to self-update again even if they don't get task
   assigned anymore.
+
+  The bot can optionally ask to long poll by setting "long_poll" to a number of
+  seconds in the request. When no task is available, the request is then held
+  until a matching task is scheduled or for up to this duration, whichever
+  comes first, and the bot is told to poll again right away.
   """
 
+  OPTIONAL_KEYS = {u'long_poll'}
+
   @auth.require(acl.is_bot)
   def post(self):
     """Handles a polling request.
@@ -278,10 +295,14 @@ class BotPollHandler(_BotBaseHandler):
 
     It makes recovery of the fleet in case of catastrophic failure much easier.
     """
-    (_request, bot_id, version, state,
+    (request, bot_id, version, state,
         dimensions, quarantined_msg) = self._process()
     sleep_streak = state.get('sleep_streak', 0)
     quarantined = bool(quarantined_msg)
+    long_poll = request.get('long_poll') or 0
+    if not isinstance(long_poll, (int, float)):
+      long_poll = 0
+    long_poll = min(max(long_poll, 0), BOT_LONG_POLL_MAX_SECS)
 
     # Note bot existence at two places, one for stats at 1 minute resolution,
     # the other for the list of known bots.
@@ -325,12 +346,15 @@ class BotPollHandler(_BotBaseHandler):
     # The bot is in good shape. Try to grab a task.
     try:
       # This is a fairly complex function call, exceptions are expected.
+      deadline = time.time() + long_poll if long_poll else None
       request, run_result = task_scheduler.bot_reap_task(
-          dimensions, bot_id, version)
+          dimensions, bot_id, version, deadline)
       if not request:
-        # No task found, tell it to sleep a bit.
+        # No task found, tell it to sleep a bit. It already waited when long
+        # polling, so it can poll again right away; the next poll doesn't scan
+        # the queue unless a task was notified in the meantime.
         bot_event('request_sleep')
-        self._cmd_sleep(sleep_streak, quarantined)
+        self._cmd_sleep(sleep_streak, quarantined, 0 if long_poll else None)
         return
 
       try:
@@ -370,10 +394,12 @@ class BotPollHandler(_BotBaseHandler):
     }
     self.send_response(out)
 
-  def _cmd_sleep(self, sleep_streak, quarantined):
+  def _cmd_sleep(self, sleep_streak, quarantined, duration=None):
+    if duration is None:
+      duration = task_scheduler.exponential_backoff(sleep_streak)
     out = {
       'cmd': 'sleep',
-      'duration': task_scheduler.exponential_backoff(sleep_streak),
+      'duration': duration,
       'quarantined': quarantined,
     }
     self.send_response(out)
@@ -463,7 +489,8 @@ class BotTaskUpdateHandler(auth.ApiHandler):
   """
   ACCEPTED_KEYS = {
     u'cost_usd', u'duration', u'exit_code', u'hard_timeout',
-    u'id', u'io_timeout', u'output', u'output_chunk_start', u'task_id',
+    u'id', u'io_timeout', u'output', u'output_chunk_start',
+    u'output_compression', u'task_id',
   }
   REQUIRED_KEYS = {u'id', u'task_id'}
 
@@ -488,6 +515,10 @@ class BotTaskUpdateHandler(auth.ApiHandler):
     io_timeout = request.get('io_timeout')
     output = request.get('output')
     output_chunk_start = request.get('output_chunk_start')
+    output_compression = request.get('output_compression')
+    if output_compression not in (None, u'zlib'):
+      self.abort_with_error(
+          400, error='Unknown output_compression %r' % output_compression)
 
     run_result_key = task_pack.unpack_run_result_key(task_id)
     if output is not None:
@@ -501,6 +532,14 @@ class BotTaskUpdateHandler(auth.ApiHandler):
         # and returning a HTTP 500 would only force the bot to stay in a retry
         # loop.
         logging.error('Failed to decode output\n%s\n%r', e, output)
+      if output_compression:
+        try:
+          output = zlib.decompress(output)
+        except zlib.error as e:
+          # Unlike a base64 error, the data is useless as-is. Have the bot
+          # retry.
+          logging.error('Failed to decompress output\n%s', e)
+          self.abort_with_error(400, error='Failed to decompress output')
 
     try:
       success, completed = task_scheduler.bot_update_task(
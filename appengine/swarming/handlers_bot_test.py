@@ -11,8 +11,10 @@ import os
 import random
 import StringIO
 import sys
+import time
 import unittest
 import zipfile
+import zlib
 
 # Setups environment.
 import test_env_handlers
@@ -29,6 +31,7 @@ from components import ereporter2
 from components import utils
 from server import bot_archive
 from server import bot_management
+from server import task_pack
 from server import task_result
 
 
@@ -185,6 +188,27 @@ class BotApiTest(test_env_handlers.AppTestBase):
     }
     self.assertEqual(expected, response)
 
+  def test_poll_sleep_long_poll(self):
+    # A bot long polls, gets nothing after waiting and is told to come back
+    # right away.
+    clock = [1000.]
+    self.mock(time, 'time', lambda: clock[0])
+    slept = []
+    def sleep(duration):
+      slept.append(duration)
+      clock[0] += duration
+    self.mock(time, 'sleep', sleep)
+    token, params = self.get_bot_token()
+    params['long_poll'] = 60
+    response = self.post_with_token('/swarming/api/v1/bot/poll', params, token)
+    expected = {
+      u'cmd': u'sleep',
+      u'duration': 0,
+      u'quarantined': False,
+    }
+    self.assertEqual(expected, response)
+    self.assertEqual(handlers_bot.BOT_LONG_POLL_MAX_SECS, sum(slept))
+
   def test_poll_update(self):
     token, params = self.get_bot_token()
     old_version = params['version']
@@ -430,6 +454,42 @@ class BotApiTest(test_env_handlers.AppTestBase):
         state=task_result.State.COMPLETED)
     _cycle(params, expected)
 
+  def test_task_update_compressed(self):
+    self.client_create_task(
+        properties=dict(commands=[['python', 'runtest.py']]))
+
+    token, params = self.get_bot_token()
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/poll', params, token)
+    task_id = response['manifest']['task_id']
+
+    params = {
+      'cost_usd': 0.1,
+      'id': 'bot1',
+      'output': base64.b64encode(zlib.compress('result string')),
+      'output_chunk_start': 0,
+      'output_compression': 'zlib',
+      'task_id': task_id,
+    }
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/task_update', params, token)
+    self.assertEqual({u'ok': True}, response)
+    run_result = task_pack.unpack_run_result_key(task_id).get()
+    self.assertEqual(
+        'result string', run_result.get_command_output_async(0).get_result())
+
+    # Data that can't be decompressed is refused.
+    self.mock(logging, 'error', lambda *_: None)
+    params['output'] = base64.b64encode('result string')
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/task_update', params, token, status=400)
+    self.assertEqual({u'error': u'Failed to decompress output'}, response)
+    params['output_compression'] = 'bz2'
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/task_update', params, token, status=400)
+    self.assertEqual(
+        {u'error': u'Unknown output_compression u\'bz2\''}, response)
+
   def test_task_update_db_failure(self):
     # The error is caught in task_scheduler.bot_update_task().
     self.client_create_task(
@@ -195,6 +195,7 @@ class SwarmingBotService(remote.Service):
   def get(self, request):
     """Provides BotInfo corresponding to a provided bot_id."""
     bot = get_or_raise(bot_management.get_info_key(request.bot_id))
+    bot_management.merge_heartbeats([bot])
     entity_dict = bot.to_dict_with_now(utils.utcnow())
     return message_conversion.bot_info_from_dict(entity_dict)
 
@@ -237,6 +238,7 @@ class SwarmingBotService(remote.Service):
     cursor = datastore_query.Cursor(urlsafe=request.cursor)
     q = bot_management.BotInfo.query().order(bot_management.BotInfo.key)
     bots, cursor, more = q.fetch_page(request.limit, start_cursor=cursor)
+    bot_management.merge_heartbeats(bots)
     return swarming_rpcs.BotList(
         cursor=cursor.urlsafe() if cursor and more else None,
         death_timeout=config.settings().bot_death_timeout_secs,
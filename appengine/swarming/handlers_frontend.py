@@ -213,6 +213,7 @@ class BotsListHandler(auth.AuthenticatingHandler):
     # version-dot-appid.appspot.com urls are used to access this page.
     version = bot_code.get_bot_version(self.request.host_url)
     bots, cursor, more = fetch_future.get_result()
+    bot_management.merge_heartbeats(bots)
     # Prefetch the tasks. We don't actually use the value here, it'll be
     # implicitly used by ndb local's cache when refetched by the html template.
     tasks = filter(None, (b.task for b in bots))
@@ -259,6 +260,7 @@ class BotHandler(auth.AuthenticatingHandler):
 
     now = utils.utcnow()
     bot = bot_future.get_result()
+    bot_management.merge_heartbeats([bot])
     # Calculate the time this bot was idle.
     idle_time = datetime.timedelta()
     run_time = datetime.timedelta()
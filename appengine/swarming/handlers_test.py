@@ -474,6 +474,7 @@ class BackendTest(AppTestBase):
     )
     task_queues = [
       ('cleanup', '/internal/taskqueue/cleanup_data'),
+      ('compact-output', '/internal/taskqueue/compact_output'),
     ]
     self.assertEqual(sorted(zip(*task_queues)[1]), task_queue_urls)
 
@@ -22,7 +22,8 @@
 - BotInfo is a 'dump-only' entity used for UI, it permits quickly show the
   state of every bots in an single query. It is basically a cache of the last
   BotEvent and additionally updated on poll. It doesn't need to be updated in a
-  transaction.
+  transaction. The polls that do not change anything material about the bot
+  are buffered in memcache and written in batches, see bot_event().
 - BotSettings contains bot-specific settings. It must be updated in a
   transaction and contains admin-provided settings, contrary to the other
   entities which are generated from data provided by the bot itself.
@@ -30,7 +31,10 @@
 
 import datetime
 import hashlib
+import logging
 
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import datastore_utils
@@ -44,6 +48,32 @@ from server import task_pack
 BOT_REBOOT_PERIOD_RANDOMIZATION_MARGIN = 0.2
 
 
+# The heartbeats, e.g. the bot_event() calls for 'request_sleep' and
+# 'task_update', only update BotInfo.last_seen_ts and BotInfo.state most of the
+# time. They are buffered in memcache, one entry per bot id, and written to the
+# DB in batches by cron_flush_heartbeats(). Each entry is a dict:
+# - 'material': the BotInfo properties in _MATERIAL_PROPERTIES as last written.
+#   A heartbeat changing one of them is written right away.
+# - 'last_seen_ts' and 'state': the values of the last heartbeat.
+# - 'flushed_ts': the last_seen_ts written to the DB.
+# When an entry is evicted, the next heartbeat is simply written right away.
+_HEARTBEAT_NAMESPACE = 'bot_heartbeat'
+
+# A heartbeat is written right away when the previous one written to the DB is
+# older than this, e.g. when the cron job is not running or when BotInfo was
+# deleted. It must be well below config.settings().bot_death_timeout_secs.
+_HEARTBEAT_MAX_BUFFERING = datetime.timedelta(minutes=5)
+
+# BotInfo properties that are never buffered.
+_MATERIAL_PROPERTIES = (
+  'dimensions', 'external_ip', 'quarantined', 'task_id', 'task_name',
+  'version',
+)
+
+# Number of BotInfo looked at per batch in cron_flush_heartbeats().
+_HEARTBEAT_FLUSH_BATCH = 500
+
+
 ### Models.
 
 # There is one BotRoot entity per bot id. Multiple bots could run on a single
@@ -171,6 +201,75 @@ class BotSettings(ndb.Model):
   quarantined = ndb.BooleanProperty()
 
 
+### Private stuff.
+
+
+def _get_updates(
+    external_ip, dimensions, state, version, quarantined, task_id, task_name):
+  """Returns the BotInfo properties to update from the bot_event() arguments."""
+  out = {'external_ip': external_ip}
+  if dimensions:
+    out['dimensions'] = dimensions
+  if state:
+    out['state'] = state
+  if quarantined is not None:
+    out['quarantined'] = quarantined
+  if task_id is not None:
+    out['task_id'] = task_id
+  if task_name:
+    out['task_name'] = task_name
+  if version is not None:
+    out['version'] = version
+  return out
+
+
+def _take(iterator):
+  """Returns up to _HEARTBEAT_FLUSH_BATCH items from iterator as a list."""
+  out = []
+  for item in iterator:
+    out.append(item)
+    if len(out) == _HEARTBEAT_FLUSH_BATCH:
+      break
+  return out
+
+
+def _get_material(bot_info):
+  """Returns the values of _MATERIAL_PROPERTIES of a BotInfo as a dict."""
+  return {k: getattr(bot_info, k) for k in _MATERIAL_PROPERTIES}
+
+
+def _save_heartbeat(bot_info):
+  """Resets the heartbeat entry of a bot to the BotInfo just written."""
+  entry = {
+    'material': _get_material(bot_info),
+    'last_seen_ts': bot_info.last_seen_ts,
+    'state': bot_info.state,
+    'flushed_ts': bot_info.last_seen_ts,
+  }
+  memcache.set(bot_info.id, entry, namespace=_HEARTBEAT_NAMESPACE)
+
+
+def _buffer_heartbeat(bot_id, now, updates):
+  """Buffers a heartbeat in memcache.
+
+  Returns:
+    True if the heartbeat was buffered, False if it must be written to the DB
+    right away.
+  """
+  entry = memcache.get(bot_id, namespace=_HEARTBEAT_NAMESPACE)
+  if not entry or now - entry['flushed_ts'] > _HEARTBEAT_MAX_BUFFERING:
+    return False
+  material = entry['material']
+  if any(
+      material[k] != v for k, v in updates.iteritems()
+      if k in _MATERIAL_PROPERTIES):
+    return False
+  entry['last_seen_ts'] = now
+  if 'state' in updates:
+    entry['state'] = updates['state']
+  return memcache.set(bot_id, entry, namespace=_HEARTBEAT_NAMESPACE)
+
+
 ### Public APIs.
 
 
@@ -220,30 +319,25 @@ def bot_event(
   if not bot_id:
     return
 
+  now = utils.utcnow()
+  updates = _get_updates(
+      external_ip, dimensions, state, version, quarantined, task_id, task_name)
+  is_heartbeat = event_type in ('request_sleep', 'task_update')
+  if is_heartbeat and _buffer_heartbeat(bot_id, now, updates):
+    return
+
   # Retrieve the previous BotInfo and update it.
   info_key = get_info_key(bot_id)
   bot_info = info_key.get() or BotInfo(key=info_key)
-  bot_info.last_seen_ts = utils.utcnow()
-  bot_info.external_ip = external_ip
-  if dimensions:
-    bot_info.dimensions = dimensions
-  if state:
-    bot_info.state = state
-  if quarantined is not None:
-    bot_info.quarantined = quarantined
-  if task_id is not None:
-    bot_info.task_id = task_id
-  if task_name:
-    bot_info.task_name = task_name
-  if version is not None:
-    bot_info.version = version
+  bot_info.populate(last_seen_ts=now, **updates)
 
-  if event_type in ('request_sleep', 'task_update'):
+  if is_heartbeat:
     # Handle this specifically. It's not much of an even worth saving a BotEvent
     # for but it's worth updating BotInfo. The only reason BotInfo is GET is to
     # keep first_seen_ts. It's not necessary to use a transaction here since no
     # BotEvent is being added, only last_seen_ts is really updated.
     bot_info.put()
+    _save_heartbeat(bot_info)
     return
 
   event = BotEvent(
@@ -262,6 +356,111 @@ def bot_event(
     bot_info.task_id = ''
 
   datastore_utils.store_new_version(event, BotRoot, [bot_info])
+  _save_heartbeat(bot_info)
+
+
+def merge_heartbeats(bot_infos):
+  """Updates BotInfo entities in place with their heartbeats not flushed yet.
+
+  The entities must not be saved back. Use this to show the bots state.
+
+  Arguments:
+  - bot_infos: list of BotInfo, None items are ignored.
+
+  Returns:
+    bot_infos, for convenience.
+  """
+  valid = [b for b in bot_infos if b]
+  if not valid:
+    return bot_infos
+  entries = memcache.get_multi(
+      [b.id for b in valid], namespace=_HEARTBEAT_NAMESPACE)
+  for bot_info in valid:
+    entry = entries.get(bot_info.id)
+    if (entry and entry['last_seen_ts'] > bot_info.last_seen_ts and
+        entry['material'] == _get_material(bot_info)):
+      bot_info.last_seen_ts = entry['last_seen_ts']
+      bot_info.state = entry['state']
+  return bot_infos
+
+
+@ndb.tasklet
+def _flush_heartbeat_async(bot_id, entry):
+  """Writes a heartbeat to its BotInfo.
+
+  The BotInfo is checked again in a transaction, since bot_event() may have
+  updated it after it was read by the caller.
+
+  Returns:
+    ndb.Future that resolves to True if the BotInfo was updated.
+  """
+  @ndb.tasklet
+  def run():
+    bot_info = yield get_info_key(bot_id).get_async()
+    if (not bot_info or entry['material'] != _get_material(bot_info) or
+        entry['last_seen_ts'] <= bot_info.last_seen_ts):
+      raise ndb.Return(False)
+    bot_info.last_seen_ts = entry['last_seen_ts']
+    bot_info.state = entry['state']
+    yield bot_info.put_async()
+    raise ndb.Return(True)
+
+  try:
+    result = yield ndb.transaction_async(run)
+  except datastore_errors.TransactionFailedError:
+    # The bot is busy being updated, the heartbeat is flushed next time.
+    result = False
+  raise ndb.Return(result)
+
+
+def cron_flush_heartbeats():
+  """Writes the heartbeats buffered in memcache to BotInfo.
+
+  The BotInfo are first read in batches to skip the ones that don't need an
+  update, then each one is updated in its own transaction.
+
+  Returns:
+    Number of BotInfo updated.
+  """
+  client = memcache.Client()
+  total = 0
+  q = BotInfo.query().iter(keys_only=True, batch_size=_HEARTBEAT_FLUSH_BATCH)
+  while True:
+    bot_ids = [k.parent().string_id() for k in _take(q)]
+    if not bot_ids:
+      break
+    entries = client.get_multi(
+        bot_ids, namespace=_HEARTBEAT_NAMESPACE, for_cas=True)
+    entries = {
+      bot_id: entry for bot_id, entry in entries.iteritems()
+      if entry['last_seen_ts'] > entry['flushed_ts']
+    }
+    if not entries:
+      continue
+    to_flush = []
+    for bot_info in ndb.get_multi([get_info_key(b) for b in sorted(entries)]):
+      if not bot_info:
+        continue
+      entry = entries[bot_info.id]
+      if entry['material'] != _get_material(bot_info):
+        # BotInfo was updated concurrently, so the entry can't be trusted. The
+        # next heartbeat is written right away.
+        client.delete(bot_info.id, namespace=_HEARTBEAT_NAMESPACE)
+        continue
+      if entry['last_seen_ts'] <= bot_info.last_seen_ts:
+        continue
+      to_flush.append(bot_info.id)
+    futures = [_flush_heartbeat_async(b, entries[b]) for b in to_flush]
+    for bot_id, future in zip(to_flush, futures):
+      if not future.get_result():
+        continue
+      total += 1
+      entry = entries[bot_id]
+      entry['flushed_ts'] = entry['last_seen_ts']
+      # If it fails, a newer heartbeat came in and will be flushed next time.
+      client.cas(bot_id, entry, namespace=_HEARTBEAT_NAMESPACE)
+  logging.info('Flushed %d heartbeats', total)
+  return total
 
 
 def get_bot_reboot_period(bot_id, state):
@@ -108,6 +108,93 @@ class BotManagementTest(test_case.TestCase):
     # No BotEvent is registered for 'poll'.
     self.assertEqual([], bot_management.get_events_query('id1').fetch())
 
+  def _poll(self, state, **kwargs):
+    params = dict(
+        event_type='request_sleep', bot_id='id1', external_ip='8.8.4.4',
+        dimensions={'id': ['id1'], 'foo': ['bar']}, state=state,
+        version=hashlib.sha1().hexdigest(), quarantined=False, task_id=None,
+        task_name=None)
+    params.update(kwargs)
+    bot_management.bot_event(**params)
+
+  def test_bot_event_poll_sleep_buffered(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll({'ram': 65})
+
+    # Only the state changed, it is buffered.
+    self.mock_now(now, 30)
+    self._poll({'ram': 66})
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(now, bot_info.last_seen_ts)
+    self.assertEqual({u'ram': 65}, bot_info.state)
+
+    # The dimensions changed, it is written right away.
+    self.mock_now(now, 60)
+    self._poll({'ram': 67}, dimensions={'id': ['id1'], 'foo': ['baz']})
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(
+        now + datetime.timedelta(seconds=60), bot_info.last_seen_ts)
+    self.assertEqual({u'ram': 67}, bot_info.state)
+
+  def test_merge_heartbeats(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll({'ram': 65})
+    self.mock_now(now, 30)
+    self._poll({'ram': 66})
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(
+        [bot_info, None], bot_management.merge_heartbeats([bot_info, None]))
+    self.assertEqual(
+        now + datetime.timedelta(seconds=30), bot_info.last_seen_ts)
+    self.assertEqual({'ram': 66}, bot_info.state)
+
+  def test_cron_flush_heartbeats(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll({'ram': 65})
+    self.assertEqual(0, bot_management.cron_flush_heartbeats())
+
+    self.mock_now(now, 30)
+    self._poll({'ram': 66})
+    self.assertEqual(1, bot_management.cron_flush_heartbeats())
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(
+        now + datetime.timedelta(seconds=30), bot_info.last_seen_ts)
+    self.assertEqual({u'ram': 66}, bot_info.state)
+    self.assertEqual(0, bot_management.cron_flush_heartbeats())
+
+    # A deleted bot is not recreated.
+    self.mock_now(now, 60)
+    self._poll({'ram': 67})
+    bot_management.get_info_key('id1').delete()
+    self.assertEqual(0, bot_management.cron_flush_heartbeats())
+    self.assertEqual(None, bot_management.get_info_key('id1').get())
+
+  def test_cron_flush_heartbeats_race(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll({'ram': 65})
+    self.mock_now(now, 30)
+    self._poll({'ram': 66})
+
+    # The bot is quarantined right after the cron read its BotInfo.
+    get_multi = ndb.get_multi
+    def mocked_get_multi(keys, **kwargs):
+      self.mock(ndb, 'get_multi', get_multi)
+      bot_infos = get_multi(keys, **kwargs)
+      self.mock_now(now, 40)
+      self._poll({'ram': 67}, quarantined=True)
+      return bot_infos
+    self.mock(ndb, 'get_multi', mocked_get_multi)
+    self.assertEqual(0, bot_management.cron_flush_heartbeats())
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(True, bot_info.quarantined)
+    self.assertEqual(
+        now + datetime.timedelta(seconds=40), bot_info.last_seen_ts)
+    self.assertEqual({u'ram': 67}, bot_info.state)
+
   def test_bot_event_busy(self):
     now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
     self.mock_now(now)
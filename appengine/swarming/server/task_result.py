@@ -13,7 +13,10 @@ store tasks results.
   be multiple tries for one job, for example if a bot dies.
 - The stdout of each command in TaskResult.properties.commands is saved inside
   TaskOutput.
-- It is chunked in TaskOutputChunk to fit the entity size limit.
+- Each packet of output sent by the bot is saved as an immutable
+  TaskOutputSegment, so appending output never reads nor rewrites previous
+  data. The segments are compacted in the background by compact_output() into
+  TaskOutputChunk, which are chunked to fit the entity size limit.
 
 Graph of schema:
 
@@ -44,12 +47,12 @@ Graph of schema:
         |TaskOutput      |  |TaskOutput| ...
         |id=1 <cmd index>|  |id=2      |
         +----------------+  +----------+
-                 ^      ^        ...
-                 |      |
-    +---------------+  +---------------+
-    |TaskOutputChunk|  |TaskOutputChunk| ...
-    |id=1           |  |id=2           |
-    +---------------+  +---------------+
+                 ^      ^        ^                   ...
+                 |      |        |
+    +---------------+  +---------------+  +-----------------+
+    |TaskOutputChunk|  |TaskOutputChunk|  |TaskOutputSegment| ...
+    |id=1           |  |id=2           |  |id=<offset + 1>  |
+    +---------------+  +---------------+  +-----------------+
 """
 
 import datetime
@@ -60,10 +63,15 @@ from google.appengine.api import search
 from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
+from components import datastore_utils
 from components import utils
 from server import task_pack
 from server import task_request
 
+# Maximum number of TaskOutputSegment compacted in a single transaction by
+# compact_output(). Each is at most TaskOutput.CHUNK_SIZE.
+_COMPACT_MAX_SEGMENTS = 50
+
 # Amount of time after which a bot is considered dead. In short, if a bot has
 # not ping in the last 5 minutes while running a task, it is considered dead.
 BOT_PING_TOLERANCE = datetime.timedelta(seconds=5*60)
@@ -164,8 +172,8 @@ class TaskOutput(ndb.Model):
   PUT_MAX_CHUNKS = PUT_MAX_CONTENT / CHUNK_SIZE
 
   # Hard limit on the amount of data returned by get_output_async() at once.
-  # Eventually, we'll want to add support for chunked fetch, if desired. Because
-  # CHUNK_SIZE is hardcoded, it's not exactly 16Mb.
+  # Use the offset argument to fetch the rest. Because CHUNK_SIZE is hardcoded,
+  # it's not exactly 16Mb.
   FETCH_MAX_CONTENT = 16*1000*1024
 
   # Maximum number of chunks to fetch at once.
@@ -177,34 +185,60 @@ class TaskOutput(ndb.Model):
 
   @classmethod
   @ndb.tasklet
-  def get_output_async(cls, output_key, number_chunks):
-    """Returns the stdout for a single command as a ndb.Future."""
+  def get_output_async(cls, output_key, number_chunks, offset=0, length=None):
+    """Returns the stdout for a single command as a ndb.Future.
+
+    Only the TaskOutputChunk overlapping [offset, offset+length) are fetched.
+    length is capped to FETCH_MAX_CONTENT. The TaskOutputSegment not compacted
+    yet are overlaid on top of the TaskOutputChunk.
+    """
     # TODO(maruel): Save number_chunks locally in this entity.
     if not number_chunks:
       raise ndb.Return(None)
 
-    number_chunks = min(number_chunks, cls.FETCH_MAX_CHUNKS)
-
+    if length is None or length > cls.FETCH_MAX_CONTENT:
+      length = cls.FETCH_MAX_CONTENT
+    first_chunk = offset / cls.CHUNK_SIZE
+    end_chunk = min(
+        number_chunks, (offset + length + cls.CHUNK_SIZE - 1) / cls.CHUNK_SIZE)
+    if first_chunk >= end_chunk:
+      raise ndb.Return('')
+
+    # The segments must be fetched before the chunks. compact_output() merges
+    # segments into their chunks and deletes them in the same transaction, so a
+    # segment compacted in between is then found in the fresher chunk instead
+    # of being missing from both. Overlaying it again is a no-op. The context
+    # cache is bypassed so the chunks are not older than the segments.
+    segments = yield _output_segments_query(
+        output_key, first_chunk * cls.CHUNK_SIZE,
+        end_chunk * cls.CHUNK_SIZE).fetch_async()
     # TODO(maruel): Always get one more than necessary, in case number_chunks
     # is invalid. If there's an unexpected TaskOutputChunk entity present,
     # continue fetching for more incrementally.
-    parts = []
-    for f in ndb.get_multi_async(
-        _output_key_to_output_chunk_key(output_key, i)
-        for i in xrange(number_chunks)):
+    chunk_futures = ndb.get_multi_async(
+        (_output_key_to_output_chunk_key(output_key, i)
+         for i in xrange(first_chunk, end_chunk)),
+        use_cache=False)
+    chunks = []
+    for f in chunk_futures:
       chunk = yield f
-      parts.append(chunk.chunk if chunk else None)
+      chunks.append(chunk or TaskOutputChunk())
+    for segment in segments:
+      _write_to_chunk(
+          chunks[segment.chunk_number - first_chunk], segment.start,
+          segment.content)
+    parts = [chunk.chunk for chunk in chunks]
 
     # Trim ending empty chunks.
     while parts and not parts[-1]:
       parts.pop()
 
     # parts is now guaranteed to not end with an empty chunk.
-    # Replace any missing chunk.
-    for i in xrange(len(parts)):
-      if not parts[i]:
-        parts[i] = '\x00' * cls.CHUNK_SIZE
-    raise ndb.Return(''.join(parts))
+    # Replace any missing chunk and pad the incomplete ones.
+    for i in xrange(len(parts) - 1):
+      parts[i] = parts[i].ljust(cls.CHUNK_SIZE, '\x00')
+    start = offset - first_chunk * cls.CHUNK_SIZE
+    raise ndb.Return(''.join(parts)[start:start+length])
 
 
 class TaskOutputChunk(ndb.Model):
@@ -227,6 +261,32 @@ class TaskOutputChunk(ndb.Model):
     return self.key.integer_id() - 1
 
 
+class TaskOutputSegment(ndb.Model):
+  """Represents a packet of a command output, as sent by the bot.
+
+  Parent is TaskOutput. Key id is the offset of the data in the output + 1,
+  since 0 is not a valid id. A packet overlapping multiple TaskOutputChunk is
+  split in multiple segments, so each segment fits in a single chunk.
+
+  This entity is immutable; it is deleted once compacted into its
+  TaskOutputChunk. Overlapping segments are applied in offset order.
+  """
+  content = ndb.BlobProperty(default='', compressed=True)
+
+  @property
+  def offset(self):
+    return self.key.integer_id() - 1
+
+  @property
+  def chunk_number(self):
+    return self.offset / TaskOutput.CHUNK_SIZE
+
+  @property
+  def start(self):
+    """Offset relative to the start of its TaskOutputChunk."""
+    return self.offset % TaskOutput.CHUNK_SIZE
+
+
 class _TaskResultCommon(ndb.Model):
   """Contains properties that is common to both TaskRunResult and
   TaskResultSummary.
@@ -256,9 +316,9 @@ class _TaskResultCommon(ndb.Model):
   # automatically if possible.
   internal_failure = ndb.BooleanProperty(default=False)
 
-  # Number of TaskOutputChunk entities for each output for each command. Set to
-  # 0 when no output has been collected for a specific index. Ordered by
-  # command.
+  # Number of TaskOutputChunk for each output for each command, including the
+  # ones only having TaskOutputSegment not compacted yet. Set to 0 when no
+  # output has been collected for a specific index. Ordered by command.
   stdout_chunks = ndb.IntegerProperty(repeated=True, indexed=False)
 
   # Aggregated exit codes. Ordered by command.
@@ -394,11 +454,12 @@ class _TaskResultCommon(ndb.Model):
     return (future.get_result() for future in futures)
 
   @ndb.tasklet
-  def get_command_output_async(self, command_index):
+  def get_command_output_async(self, command_index, offset=0, length=None):
     """Returns the stdout for a single command as a ndb.Future.
 
     Use out.get_result() to get the data as a str or None if no output is
-    present.
+    present. offset and length select a byte range of the output, see
+    TaskOutput.get_output_async().
     """
     assert isinstance(command_index, int), command_index
     if (not self.run_result_key or
@@ -412,7 +473,8 @@ class _TaskResultCommon(ndb.Model):
 
     output_key = _run_result_key_to_output_key(
         self.run_result_key, command_index)
-    out = yield TaskOutput.get_output_async(output_key, number_chunks)
+    out = yield TaskOutput.get_output_async(
+        output_key, number_chunks, offset, length)
     raise ndb.Return(out)
 
   def _pre_put_hook(self):
@@ -503,6 +565,8 @@ class TaskRunResult(_TaskResultCommon):
   def append_output(self, command_index, output, output_chunk_start):
     """Appends output to the stdout of the command.
 
+    Doesn't do any DB operation.
+
     Returns the entities to save.
     """
     while len(self.stdout_chunks) <= command_index:
@@ -695,11 +759,39 @@ def _output_key_to_output_chunk_key(output_key, chunk_number):
   return ndb.Key(TaskOutputChunk, chunk_number+1, parent=output_key)
 
 
+def _output_key_to_output_segment_key(output_key, offset):
+  """Returns a ndb.key to a TaskOutputSegment."""
+  assert output_key.kind() == 'TaskOutput', output_key
+  assert offset >= 0, offset
+  return ndb.Key(TaskOutputSegment, offset+1, parent=output_key)
+
+
+def _output_segments_query(output_key, start=None, end=None):
+  """Returns a ndb.Query for the TaskOutputSegment of an output by offset.
+
+  Arguments:
+    output_key: ndb.Key to TaskOutput that is the parent of TaskOutputSegment.
+    start: if set, only the segments starting at or after this offset are
+        returned.
+    end: if set, only the segments starting before this offset are returned.
+  """
+  q = TaskOutputSegment.query(ancestor=output_key).order(TaskOutputSegment.key)
+  if start is not None:
+    q = q.filter(
+        TaskOutputSegment.key >= _output_key_to_output_segment_key(
+            output_key, start))
+  if end is not None:
+    q = q.filter(
+        TaskOutputSegment.key < _output_key_to_output_segment_key(
+            output_key, end))
+  return q
+
+
 def _output_append(output_key, number_chunks, output, output_chunk_start):
-  """Appends output to a TaskOutput in TaskOutputChunk entities.
+  """Appends output to a TaskOutput as TaskOutputSegment entities.
 
-  Creates new TaskOutputChunk entities as necessary as children of
-  TaskRunResult/TaskOutput.
+  Creates new TaskOutputSegment entities as children of
+  TaskRunResult/TaskOutput, one per TaskOutputChunk overlapped by the output.
 
   It silently drops saving the output if it goes over ~16Mb. The hard limit is
   32Mb but HTML escaping can expand the raw data a bit, so just store half of
@@ -709,11 +801,11 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
   this point, it's probably just a ton of junk. Figure out a way to better
   implement this if necessary.
 
-  Does one DB read by key and no puts. It's the responsibility of the caller to
-  save the entities.
+  Does no DB operation. It's the responsibility of the caller to save the
+  entities.
 
   Arguments:
-    output_key: ndb.Key to TaskOutput that is the parent of TaskOutputChunk.
+    output_key: ndb.Key to TaskOutput that is the parent of TaskOutputSegment.
     number_chunks: Current number of TaskOutputChunk instances. If 0, this means
         there is not data yet.
     output: Actual content to append.
@@ -727,81 +819,68 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
   assert output_key.kind() == 'TaskOutput', output_key
 
   # Split everything in small bits.
-  chunks = []
+  segments = []
   while output:
     chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
     if chunk_number >= TaskOutput.PUT_MAX_CHUNKS:
       # TODO(maruel): Log into TaskOutput that data was dropped.
       logging.error('Dropping output\n%d bytes were lost', len(output))
       break
-    key = _output_key_to_output_chunk_key(output_key, chunk_number)
     start = output_chunk_start % TaskOutput.CHUNK_SIZE
     next_start = TaskOutput.CHUNK_SIZE - start
-    chunks.append((key, start, output[:next_start]))
+    segments.append(TaskOutputSegment(
+        key=_output_key_to_output_segment_key(output_key, output_chunk_start),
+        content=output[:next_start]))
     output = output[next_start:]
     number_chunks = max(number_chunks, chunk_number + 1)
     output_chunk_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
+  return segments, number_chunks
 
-  if not chunks:
-    return [], number_chunks
-
-  # Get the TaskOutputChunk from the DB. Normally it would be only one entity
-  # (the last incomplete one) but this code supports arbitrary overwrite.
-  #
-  # number_chunks should normally be used to skip entities that are assumed to
-  # not be present but we don't assume the number_chunks is valid for safety.
-  #
-  # This means an unneeded get() is done on the missing chunk.
-  entities = ndb.get_multi(i[0] for i in chunks)
-
-  # Update the entities.
-  for i in xrange(len(chunks)):
-    key, start, output = chunks[i]
-    if not entities[i]:
-      # Fill up for missing entities.
-      entities[i] = TaskOutputChunk(key=key)
-    chunk = entities[i]
-    # Magically combine everything.
-    end = start + len(output)
-    if len(chunk.chunk) < start:
-      # Insert blank data automatically.
-      chunk.gaps.extend((len(chunk.chunk), start))
-      chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
-
-    # Strip gaps that are being written to.
-    new_gaps = []
-    for i in xrange(0, len(chunk.gaps), 2):
-      # All values are relative to the starting offset of the chunk itself.
-      gap_start = chunk.gaps[i]
-      gap_end = chunk.gaps[i+1]
-      # If the gap overlaps the chunk being written, strip it. Cases:
-      #   Gap:     |   |
-      #   Chunk: |   |
-      if start <= gap_start <= end and end <= gap_end:
-        gap_start = end
-
-      #   Gap:     |   |
-      #   Chunk:     |   |
-      if gap_start <= start and start <= gap_end <= end:
-        gap_end = start
-
-      #   Gap:       |  |
-      #   Chunk:   |      |
-      if start <= gap_start <= end and start <= gap_end <= end:
-        continue
-
-      #   Gap:     |      |
-      #   Chunk:     |  |
-      if gap_start < start < gap_end and gap_start <= end <= gap_end:
-        # Create a hole.
-        new_gaps.extend((gap_start, start))
-        new_gaps.extend((end, gap_end))
-      else:
-        new_gaps.extend((gap_start, gap_end))
 
-    chunk.gaps = new_gaps
-    chunk.chunk = chunk.chunk[:start] + output + chunk.chunk[end:]
-  return entities, number_chunks
+def _write_to_chunk(chunk, start, output):
+  """Writes output at offset start in a TaskOutputChunk, keeping track of the
+  gaps.
+  """
+  # Magically combine everything.
+  end = start + len(output)
+  if len(chunk.chunk) < start:
+    # Insert blank data automatically.
+    chunk.gaps.extend((len(chunk.chunk), start))
+    chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
+
+  # Strip gaps that are being written to.
+  new_gaps = []
+  for i in xrange(0, len(chunk.gaps), 2):
+    # All values are relative to the starting offset of the chunk itself.
+    gap_start = chunk.gaps[i]
+    gap_end = chunk.gaps[i+1]
+    # If the gap overlaps the chunk being written, strip it. Cases:
+    #   Gap:     |   |
+    #   Chunk: |   |
+    if start <= gap_start <= end and end <= gap_end:
+      gap_start = end
+
+    #   Gap:     |   |
+    #   Chunk:     |   |
+    if gap_start <= start and start <= gap_end <= end:
+      gap_end = start
+
+    #   Gap:       |  |
+    #   Chunk:   |      |
+    if start <= gap_start <= end and start <= gap_end <= end:
+      continue
+
+    #   Gap:     |      |
+    #   Chunk:     |  |
+    if gap_start < start < gap_end and gap_start <= end <= gap_end:
+      # Create a hole.
+      new_gaps.extend((gap_start, start))
+      new_gaps.extend((end, gap_end))
+    else:
+      new_gaps.extend((gap_start, gap_end))
+
+  chunk.gaps = new_gaps
+  chunk.chunk = chunk.chunk[:start] + output + chunk.chunk[end:]
 
 
 def _sort_property(sort):
@@ -856,6 +935,50 @@ def new_run_result(request, try_number, bot_id, bot_version):
       server_versions=[utils.get_app_version()])
 
 
+def compact_output(run_result_key):
+  """Merges the TaskOutputSegment of a TaskRunResult into its TaskOutputChunk.
+
+  Each batch of segments is compacted in a transaction, so it is safe to run
+  concurrently with output being appended.
+
+  Returns:
+    Number of TaskOutputSegment compacted.
+  """
+  assert not ndb.in_transaction()
+
+  def chunk_key(segment):
+    return _output_key_to_output_chunk_key(
+        segment.key.parent(), segment.chunk_number)
+
+  def run():
+    segments = TaskOutputSegment.query(ancestor=run_result_key).order(
+        TaskOutputSegment.key).fetch(_COMPACT_MAX_SEGMENTS)
+    if not segments:
+      return 0
+    chunk_keys = sorted(set(chunk_key(s) for s in segments))
+    chunks = {
+      key: chunk or TaskOutputChunk(key=key)
+      for key, chunk in zip(chunk_keys, ndb.get_multi(chunk_keys))
+    }
+    for segment in segments:
+      _write_to_chunk(
+          chunks[chunk_key(segment)], segment.start, segment.content)
+    ndb.put_multi(chunks.values())
+    ndb.delete_multi([s.key for s in segments])
+    return len(segments)
+
+  total = 0
+  while True:
+    count = datastore_utils.transaction(run)
+    total += count
+    if count < _COMPACT_MAX_SEGMENTS:
+      break
+  logging.info(
+      'Compacted %d segments for %s',
+      total, task_pack.pack_run_result_key(run_result_key))
+  return total
+
+
 def yield_run_result_keys_with_dead_bot():
   """Yields all the TaskRunResult ndb.Key where the bot died recently.
 
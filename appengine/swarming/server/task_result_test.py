@@ -453,6 +453,10 @@ class TaskResultApiTest(TestCase):
     # Tested in task_scheduler_test.
     pass
 
+  def test_compact_output(self):
+    # Tested in TestOutput.
+    pass
+
 
 class TestOutput(TestCase):
   APP_DIR = test_env.APP_DIR
@@ -470,6 +474,13 @@ class TestOutput(TestCase):
     self.run_result = self.run_result.key.get()
 
   def assertTaskOutputChunk(self, expected):
+    # The TaskOutputSegment are only merged into TaskOutputChunk when compacted,
+    # and the output is the same either way.
+    output = self.run_result.get_command_output_async(0).get_result()
+    self.assertTrue(task_result.compact_output(self.run_result.key))
+    self.assertEqual([], task_result.TaskOutputSegment.query().fetch())
+    self.assertEqual(
+        output, self.run_result.get_command_output_async(0).get_result())
     q = task_result.TaskOutputChunk.query().order(
         task_result.TaskOutputChunk.key)
     self.assertEqual(expected, [t.to_dict() for t in q.fetch()])
@@ -584,6 +595,23 @@ class TestOutput(TestCase):
     ]
     self.assertTaskOutputChunk(expected)
 
+  def test_append_output_range(self):
+    # Reading a range only fetches the overlapping TaskOutputChunk, whether
+    # compacted or not.
+    size = task_result.TaskOutput.CHUNK_SIZE
+    ndb.put_multi(self.run_result.append_output(
+        0, 'a' * (size - 3) + 'FooBar', 0))
+    get = lambda *args: self.run_result.get_command_output_async(
+        0, *args).get_result()
+    for _ in xrange(2):
+      self.assertEqual('FooBar', get(size - 3))
+      self.assertEqual('Foo', get(size - 3, 3))
+      self.assertEqual('Bar', get(size))
+      self.assertEqual('ar', get(size + 1, 10))
+      self.assertEqual('', get(size + 3))
+      self.assertEqual('', get(3 * size))
+      self.assertTrue(task_result.compact_output(self.run_result.key))
+
   def test_append_output_overwrite(self):
     # Overwrite previously written data.
     ndb.put_multi(self.run_result.append_output(0, 'FooBar', 0))
@@ -605,6 +633,20 @@ class TestOutput(TestCase):
     self.assertTaskOutputChunk(
         [{'chunk': expected_output, 'gaps': [3, 4, 7, 8]}])
 
+  def test_append_output_compact(self):
+    # Segments written after a compaction are overlaid on the compacted chunk.
+    self.mock(task_result, '_COMPACT_MAX_SEGMENTS', 2)
+    ndb.put_multi(self.run_result.append_output(0, 'Foo', 0))
+    ndb.put_multi(self.run_result.append_output(0, 'Bar', 3))
+    ndb.put_multi(self.run_result.append_output(0, 'Baz', 6))
+    self.assertEqual(3, task_result.compact_output(self.run_result.key))
+    self.assertEqual(0, task_result.compact_output(self.run_result.key))
+    ndb.put_multi(self.run_result.append_output(0, 'Wow', 9))
+    self.assertEqual(
+        'FooBarBazWow',
+        self.run_result.get_command_output_async(0).get_result())
+    self.assertTaskOutputChunk([{'chunk': 'FooBarBazWow', 'gaps': []}])
+
   def test_append_output_reverse_order_second_chunk(self):
     # Write the data in reverse order in multiple calls.
     ndb.put_multi(self.run_result.append_output(
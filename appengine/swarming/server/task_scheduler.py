@@ -12,9 +12,11 @@ import datetime
 import logging
 import math
 import random
+import time
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.runtime import apiproxy_errors
 
@@ -33,6 +35,14 @@ from server import task_to_run
 
 _PROBABILITY_OF_QUICK_COMEBACK = 0.05
 
+# Maximum number of seconds bot_reap_task() spends scanning the queue and
+# waiting, out of the 60 seconds given to the handlers.
+_REAP_MAX_SECS = 40
+
+# Number of seconds reserved out of _REAP_MAX_SECS to scan the queue once a
+# task was notified while waiting.
+_REAP_MIN_SCAN_SECS = 10
+
 
 def _secs_to_ms(value):
   """Converts a seconds value in float to the number of ms as an integer."""
@@ -85,6 +95,7 @@ def _expire_task(to_run_key, request):
     success = False
   if success:
     task_to_run.set_lookup_cache(to_run_key, False)
+    task_to_run.remove_from_dispatch_index(to_run_key)
     logging.info(
         'Expired %s', task_pack.pack_result_summary_key(result_summary_key))
   return success
@@ -131,9 +142,21 @@ def _reap_task(to_run_key, request, bot_id, bot_version):
     run_result = None
   if run_result:
     task_to_run.set_lookup_cache(to_run_key, False)
+    task_to_run.remove_from_dispatch_index(to_run_key)
   return run_result
 
 
+def _enqueue_compact_output(run_result_key):
+  """Enqueues the compaction of the output of a task, as part of the current
+  transaction.
+  """
+  taskqueue.add(
+      url='/internal/taskqueue/compact_output',
+      payload=task_pack.pack_run_result_key(run_result_key),
+      queue_name='compact-output',
+      transactional=True)
+
+
 def _update_stats(run_result, bot_id, request, completed):
   """Updates stats after a bot task update notification."""
   if completed:
@@ -216,6 +239,9 @@ def _handle_dead_bot(run_result_key):
       run_result.abandoned_ts = now
       result_summary.set_from_run_result(run_result, request)
       result = False
+    if run_result.stdout_chunks:
+      # The bot won't send any more output.
+      _enqueue_compact_output(run_result.key)
     ndb.put_multi(to_put)
     return result, run_result.bot_id
 
@@ -232,6 +258,10 @@ def _handle_dead_bot(run_result_key):
           dimensions=request.properties.dimensions,
           user=request.user)
     else:
+      # The TaskToRun was just given back the same queue_number.
+      to_run = task_to_run.new_task_to_run(request)
+      task_to_run.add_to_dispatch_index(to_run)
+      task_to_run.notify_task_available(to_run)
       logging.info('Retried %s', packed)
   else:
     logging.info('Ignored %s', packed)
@@ -386,6 +416,10 @@ def schedule_request(request):
     # Check for failures, it would raise in this case, aborting the call.
     future.get_result()
 
+  if task.queue_number:
+    task_to_run.add_to_dispatch_index(task)
+    task_to_run.notify_task_available(task)
+
   stats.add_task_entry(
       'task_enqueued', result_summary.key,
       dimensions=request.properties.dimensions,
@@ -393,18 +427,12 @@ def schedule_request(request):
   return result_summary
 
 
-def bot_reap_task(dimensions, bot_id, bot_version):
-  """Reaps a TaskToRun if one is available.
+def _reap_next_task(dimensions, bot_id, bot_version, deadline):
+  """Reaps the first available TaskToRun matching the dimensions, if any.
 
-  The process is to find a TaskToRun where its .queue_number is set, then
-  create a TaskRunResult for it.
-
-  Returns:
-    tuple of (TaskRequest, TaskRunResult) for the task that was reaped.
-    The TaskToRun involved is not returned.
+  Gives up searching at deadline, a utils.utcnow() value.
   """
-  assert bot_id
-  q = task_to_run.yield_next_available_task_to_dispatch(dimensions)
+  q = task_to_run.yield_next_available_task_to_dispatch(dimensions, deadline)
   # When a large number of bots try to reap hundreds of tasks simultaneously,
   # they'll constantly fail to call reap_task_to_run() as they'll get preempted
   # by other bots. So randomly jump farther in the queue when the number of
@@ -452,6 +480,50 @@ def bot_reap_task(dimensions, bot_id, bot_version):
   return None, None
 
 
+def bot_reap_task(dimensions, bot_id, bot_version, deadline=None):
+  """Reaps a TaskToRun if one is available.
+
+  The process is to find a TaskToRun where its .queue_number is set, then
+  create a TaskRunResult for it.
+
+  Arguments:
+  - dimensions: dimensions of the bot.
+  - bot_id: id of the bot.
+  - bot_version: version of the bot code.
+  - deadline: if set, time.time() value until which to wait for a matching
+        task to be scheduled when none is available right away. The queue is
+        only scanned again when task_to_run.notify_task_available() is called
+        for a matching task. The first scan is skipped when no task was
+        notified since the previous long poll of this bot timed out. The wait
+        is cut short to always leave _REAP_MIN_SCAN_SECS to scan the queue
+        within _REAP_MAX_SECS.
+
+  Returns:
+    tuple of (TaskRequest, TaskRunResult) for the task that was reaped.
+    The TaskToRun involved is not returned.
+  """
+  assert bot_id
+  scan_deadline = utils.utcnow() + datetime.timedelta(seconds=_REAP_MAX_SECS)
+  if not deadline:
+    return _reap_next_task(dimensions, bot_id, bot_version, scan_deadline)
+
+  deadline = min(
+      deadline, time.time() + _REAP_MAX_SECS - _REAP_MIN_SCAN_SECS)
+  # The listener is created before the first scan so no task is missed.
+  listener = task_to_run.TaskListener(dimensions, bot_id)
+  if listener.changed():
+    request, run_result = _reap_next_task(
+        dimensions, bot_id, bot_version, scan_deadline)
+    if request:
+      return request, run_result
+  while listener.wait(deadline):
+    request, run_result = _reap_next_task(
+        dimensions, bot_id, bot_version, scan_deadline)
+    if request:
+      return request, run_result
+  return None, None
+
+
 def bot_update_task(
     run_result_key, bot_id, output, output_chunk_start,
     exit_code, duration, hard_timeout, io_timeout, cost_usd):
@@ -534,10 +606,18 @@ def bot_update_task(
 
     run_result.signal_server_version(server_version)
     to_put = [run_result]
+    previous_chunks = (
+        run_result.stdout_chunks[0] if run_result.stdout_chunks else 0)
     if output:
-      # This does 1 multi GETs. This also modifies run_result in place.
+      # This does no DB operation. This also modifies run_result in place.
       to_put.extend(
           run_result.append_output(0, output, output_chunk_start or 0))
+    # Compact the output once a TaskOutputChunk is full and when the task is
+    # done.
+    if run_result.stdout_chunks and (
+        run_result.stdout_chunks[0] > max(previous_chunks, 1) or
+        run_result.state not in task_result.State.STATES_RUNNING):
+      _enqueue_compact_output(run_result.key)
 
     run_result.cost_usd = max(cost_usd, run_result.cost_usd or 0.)
     run_result.modified_ts = now
@@ -600,6 +680,8 @@ def bot_kill_task(run_result_key, bot_id):
     run_result.abandoned_ts = now
     run_result.modified_ts = now
     result_summary.set_from_run_result(run_result, None)
+    if run_result.stdout_chunks:
+      _enqueue_compact_output(run_result.key)
     ndb.put_multi((run_result, result_summary))
     return run_result, None
 
@@ -645,6 +727,8 @@ def cancel_task(result_summary_key):
     return 'Failed killing task %s: %s' % (packed, e)
   # Add it to the negative cache.
   task_to_run.set_lookup_cache(to_run_key, False)
+  if ok:
+    task_to_run.remove_from_dispatch_index(to_run_key)
   # TODO(maruel): Add stats.
   return ok, was_running
 
@@ -688,6 +772,14 @@ def cron_abort_expired_task_to_run():
   return killed
 
 
+def cron_rebuild_dispatch_index():
+  """Rebuilds the dispatch index used by bot_reap_task().
+
+  Returns the number of tasks indexed.
+  """
+  return task_to_run.rebuild_dispatch_index()
+
+
 def cron_handle_bot_died():
   """Aborts or retry stale TaskRunResult where the bot stopped sending updates.
 
@@ -9,6 +9,7 @@ import logging
 import os
 import random
 import sys
+import time
 import unittest
 
 import test_env
@@ -139,6 +140,71 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertEqual('localhost', run_result.bot_id)
     self.assertEqual(None, task_to_run.TaskToRun.query().get().queue_number)
 
+  def test_bot_reap_task_long_poll(self):
+    bot_dimensions = {
+      u'OS': [u'Windows', u'Windows-3.1.1'],
+      u'hostname': u'localhost',
+      u'foo': u'bar',
+    }
+    clock = [1000.]
+    self.mock(time, 'time', lambda: clock[0])
+    # Nothing is scheduled, it gives up at the deadline.
+    def sleep(duration):
+      clock[0] += duration
+    self.mock(time, 'sleep', sleep)
+    self.assertEqual(
+        (None, None),
+        task_scheduler.bot_reap_task(bot_dimensions, 'localhost', 'abc', 1005.))
+    self.assertEqual(1005., clock[0])
+
+    # A task scheduled while waiting is reaped right away.
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    request = task_request.make_request(data)
+    def sleep_and_schedule(duration):
+      sleep(duration)
+      if clock[0] == 1007.:
+        task_scheduler.schedule_request(request)
+    self.mock(time, 'sleep', sleep_and_schedule)
+    actual_request, run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc', 1020.)
+    self.assertEqual(request, actual_request)
+    self.assertEqual('localhost', run_result.bot_id)
+    self.assertEqual(1007., clock[0])
+
+  def test_bot_reap_task_long_poll_unchanged(self):
+    bot_dimensions = {
+      u'OS': [u'Windows', u'Windows-3.1.1'],
+      u'hostname': u'localhost',
+      u'foo': u'bar',
+    }
+    clock = [1000.]
+    self.mock(time, 'time', lambda: clock[0])
+    def sleep(duration):
+      clock[0] += duration
+    self.mock(time, 'sleep', sleep)
+    # A task the bot can't reap.
+    task_scheduler.schedule_request(task_request.make_request(
+        _gen_request_data(properties=dict(dimensions={u'OS': u'Amiga'}))))
+    self.assertEqual(
+        (None, None),
+        task_scheduler.bot_reap_task(bot_dimensions, 'localhost', 'abc', 1005.))
+
+    # Nothing was notified since the previous long poll timed out, so the queue
+    # is not scanned. The wait leaves time to scan the queue.
+    scans = []
+    self.mock(
+        task_scheduler, '_reap_next_task',
+        lambda *args: scans.append(args) or (None, None))
+    self.assertEqual(
+        (None, None),
+        task_scheduler.bot_reap_task(bot_dimensions, 'localhost', 'abc', 2000.))
+    self.assertEqual([], scans)
+    self.assertEqual(
+        1005. + task_scheduler._REAP_MAX_SECS -
+          task_scheduler._REAP_MIN_SCAN_SECS,
+        clock[0])
+
   def test_exponential_backoff(self):
     self.mock(
         task_scheduler.random, 'random',
@@ -713,6 +779,25 @@ class TaskSchedulerApiTest(test_case.TestCase):
     }
     self.assertEqual(expected, run_result.key.get().to_dict())
 
+  def test_bot_kill_task_compact_output(self):
+    # The output of a killed task is compacted since no more output will come.
+    compacted = []
+    self.mock(task_scheduler, '_enqueue_compact_output', compacted.append)
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    task_scheduler.schedule_request(task_request.make_request(data))
+    _, run_result = task_scheduler.bot_reap_task(
+        {'OS': 'Windows-3.1.1'}, 'localhost', 'abc')
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hi', 0, None, None, False, False,
+            0.1))
+    self.assertEqual([], compacted)
+    self.assertEqual(
+        None, task_scheduler.bot_kill_task(run_result.key, 'localhost'))
+    self.assertEqual([run_result.key], compacted)
+
   def test_bot_kill_task_wrong_bot(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     data = _gen_request_data(
@@ -786,6 +871,19 @@ class TaskSchedulerApiTest(test_case.TestCase):
     }
     self.assertEqual(expected, result_summary.key.get().to_dict())
 
+  def test_cron_rebuild_dispatch_index(self):
+    self.assertEqual(0, task_scheduler.cron_rebuild_dispatch_index())
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    request = task_request.make_request(data)
+    task_scheduler.schedule_request(request)
+    self.assertEqual(1, task_scheduler.cron_rebuild_dispatch_index())
+    # The index is kept up to date, the task is reaped from it.
+    _, run_result = task_scheduler.bot_reap_task(
+        {'OS': 'Windows-3.1.1'}, 'localhost', 'abc')
+    self.assertEqual('localhost', run_result.bot_id)
+    self.assertEqual(0, task_scheduler.cron_rebuild_dispatch_index())
+
   def test_cron_abort_expired_task_to_run_retry(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     data = _gen_request_data(
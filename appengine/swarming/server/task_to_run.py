@@ -25,11 +25,13 @@ Graph of the schema:
     +-----------------------+
 """
 
+import bisect
 import datetime
 import hashlib
 import itertools
 import logging
 import struct
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
@@ -41,6 +43,78 @@ from server import task_request
 # Maximum product search space for dimensions for a bot.
 MAX_DIMENSIONS = 16384
 
+# Number of candidates whose lookup cache entry is checked again at once, right
+# before they are yielded.
+_RECHECK_SLICE = 10
+
+
+# The dispatch index is a hint kept in memcache to find the pending TaskToRun
+# that a bot can reap without scanning the whole queue. It is made of a root
+# entry, the set of the dimensions_hash with pending tasks, and _INDEX_SHARDS
+# entries per dimensions_hash. Each shard is a list of (queue_number,
+# TaskRequest key id, timestamp when added) sorted by queue_number. Sharding
+# reduces the compare-and-set contention and keeps each value well below the
+# memcache value size limit.
+#
+# A shard with more than _INDEX_MAX_ENTRIES is replaced by _INDEX_OVERFLOW and
+# the bots accepting this dimensions_hash scan the queue instead. An empty tuple
+# is a tombstone, a shard that rebuild_dispatch_index() is about to remove from
+# the root entry.
+#
+# The DB stays the source of truth; every candidate found in the index is still
+# fetched and verified before being yielded. The root entry is only created by
+# rebuild_dispatch_index(), so when it is evicted or when an update fails, the
+# index is simply not used until the next rebuild.
+#
+# A TaskToRun is added to the index after its transaction committed, so a crash
+# in between leaves it out of the index until the next rebuild, which rewrites
+# every shard. The time of the last rebuild is saved along the root entry; when
+# it is missing or older than _INDEX_MAX_AGE_SECS, the queue is scanned instead.
+_INDEX_NAMESPACE = 'task_to_run_index'
+_INDEX_ROOT_KEY = 'root'
+_INDEX_REBUILT_KEY = 'rebuilt'
+_INDEX_SHARDS = 8
+_INDEX_MAX_ENTRIES = 2000
+_INDEX_OVERFLOW = 'overflow'
+
+# Entries added less than this number of seconds before a rebuild are kept even
+# if the eventually consistent query used for the rebuild didn't return them.
+_INDEX_RECENT_SECS = 120
+
+# Maximum number of compare-and-set attempts to update a dispatch index entry.
+_INDEX_CAS_RETRIES = 10
+
+# The index is rebuilt every minute by a cron job. It is not used when the last
+# rebuild is older than a few periods.
+_INDEX_MAX_AGE_SECS = 180
+
+
+# Notification channel for the bots long-polling for a task. It is made of one
+# counter per dimensions_hash, incremented when a task with these dimensions
+# becomes available, and a global counter incremented for every task. A waiting
+# bot only reads the global counter at each interval, and its own counters once
+# the global one changed. An evicted counter is seen as a change, which only
+# causes a spurious reap attempt.
+#
+# The global counter is sharded in _NOTIFY_ALL_SHARDS keys, all incremented
+# together, so the polling of the waiting bots is spread over as many memcache
+# keys. Each bot reads a single shard.
+_NOTIFY_NAMESPACE = 'task_to_run_notify'
+_NOTIFY_ALL_SHARDS = 16
+
+# Interval in seconds at which a waiting bot checks the global counter.
+_NOTIFY_POLL_INTERVAL = 1.
+
+# Above this number of dimensions hashes, a bot only watches the global counter,
+# to not fetch thousands of counters at each change.
+_NOTIFY_MAX_HASHES = 512
+
+# A bot whose long poll timed out doesn't scan the queue again on its next long
+# poll if no task was notified in the meantime. The state seen at the timeout is
+# kept for this number of seconds, so an idle bot still scans the queue at least
+# this often, to catch tasks whose notification was lost.
+_NOTIFY_RESCAN_SECS = 60
+
 
 class TaskToRun(ndb.Model):
   """Defines a TaskRequest ready to be scheduled on a bot.
@@ -187,9 +261,223 @@ def _lookup_cache_is_taken(task_key):
   return bool(memcache.get(key, namespace='task_to_run'))
 
 
+def _lookup_cache_is_taken_async(task_keys):
+  """Queries the quick lookup cache for multiple keys in a single RPC.
+
+  Returns a memcache RPC. Its get_result() returns a dict of the keys as
+  returned by _memcache_to_run_key() that are known to be taken.
+  """
+  assert not ndb.in_transaction()
+  return memcache.Client().get_multi_async(
+      [_memcache_to_run_key(k) for k in task_keys], namespace='task_to_run')
+
+
+def _filter_taken(task_keys):
+  """Returns the keys in task_keys that are not marked as taken in memcache."""
+  if not task_keys:
+    return []
+  taken = _lookup_cache_is_taken_async(task_keys).get_result() or {}
+  return [k for k in task_keys if not taken.get(_memcache_to_run_key(k))]
+
+
+def _notify_key(dimensions_hash):
+  """Returns the memcache key of the notification counter for a hash."""
+  return '%x' % dimensions_hash
+
+
+def _notify_all_key(shard):
+  """Returns the memcache key of a shard of the global notification counter."""
+  return 'all:%d' % shard
+
+
+def _index_shard_key(dimensions_hash, request_id):
+  """Returns the memcache key of the dispatch index shard for a TaskToRun."""
+  # The lowest 4 bits are the TaskRequest key version, use the random bits.
+  return '%x:%d' % (dimensions_hash, (request_id >> 4) % _INDEX_SHARDS)
+
+
+def _index_shard_keys(dimensions_hash):
+  """Returns the memcache keys of all the dispatch index shards for a hash."""
+  return ['%x:%d' % (dimensions_hash, i) for i in xrange(_INDEX_SHARDS)]
+
+
+def _index_update(client, key, update, create=False):
+  """Updates a dispatch index entry with compare-and-set.
+
+  update(value) must return the new value, or None to leave it untouched. If
+  create is True, a missing entry is added with the value of update(None).
+
+  Returns:
+    True on success, False if the entry is missing or couldn't be updated.
+  """
+  for _ in xrange(_INDEX_CAS_RETRIES):
+    value = client.gets(key, namespace=_INDEX_NAMESPACE)
+    if value is None:
+      if not create:
+        return False
+      value = update(None)
+      if value is None or client.add(key, value, namespace=_INDEX_NAMESPACE):
+        return True
+      # It was created concurrently, retry.
+      continue
+    value = update(value)
+    if value is None or client.cas(key, value, namespace=_INDEX_NAMESPACE):
+      return True
+  return False
+
+
+def _drop_dispatch_index():
+  """Disables the dispatch index until the next rebuild."""
+  logging.warning('Dropping the dispatch index')
+  memcache.delete(_INDEX_ROOT_KEY, namespace=_INDEX_NAMESPACE)
+
+
+def _get_task_keys_from_index(accepted_dimensions_hash):
+  """Returns the TaskToRun keys in the dispatch index matching the hashes.
+
+  The keys are sorted by queue_number.
+
+  Returns:
+    list of ndb.Key, or None if the dispatch index can't be used.
+  """
+  values = memcache.get_multi(
+      [_INDEX_ROOT_KEY, _INDEX_REBUILT_KEY], namespace=_INDEX_NAMESPACE)
+  hashes = values.get(_INDEX_ROOT_KEY)
+  if hashes is None:
+    return None
+  rebuilt = values.get(_INDEX_REBUILT_KEY)
+  if rebuilt is None or rebuilt < utils.time_time() - _INDEX_MAX_AGE_SECS:
+    # The tasks whose addition was lost may not be indexed, scan the queue.
+    logging.warning('The dispatch index is stale')
+    return None
+  hashes = sorted(hashes.intersection(accepted_dimensions_hash))
+  if not hashes:
+    return []
+  values = memcache.get_multi(
+      [k for h in hashes for k in _index_shard_keys(h)],
+      namespace=_INDEX_NAMESPACE)
+  entries = []
+  for h in hashes:
+    for key in _index_shard_keys(h):
+      value = values.get(key)
+      if value is None or value == _INDEX_OVERFLOW:
+        # The entry is being created, was evicted or is too large, play safe.
+        return None
+      entries.extend((queue_number, request_id, h)
+                     for queue_number, request_id, _ in value)
+  entries.sort()
+  return [
+    ndb.Key(
+        TaskToRun, h, parent=ndb.Key(task_request.TaskRequest, request_id))
+    for _, request_id, h in entries
+  ]
+
+
+def _get_dimensions_hashes(bot_dimensions):
+  """Returns the frozenset of the dimensions_hash a bot can reap."""
+  return frozenset(
+      _hash_dimensions(utils.encode_to_json(i))
+      for i in _powerset(bot_dimensions))
+
+
+def _yield_pages(q, page_size):
+  """Yields pages of results from ndb.Query q.
+
+  The fetch of the next page is always in flight while the caller processes the
+  current one, so the query latency overlaps with the caller's own RPCs.
+  """
+  future = q.fetch_page_async(page_size)
+  while future:
+    results, cursor, more = future.get_result()
+    future = None
+    if more and cursor:
+      future = q.fetch_page_async(page_size, start_cursor=cursor)
+    yield results
+
+
 ### Public API.
 
 
+class TaskListener(object):
+  """Waits for a TaskToRun matching a bot's dimensions to become available.
+
+  The state of the notification channel is saved on creation, so a task
+  scheduled between the creation and the first call to wait() is not missed.
+
+  When wait() times out, the state of the counters is also saved for the bot,
+  so the next listener of the same bot can tell with changed() whether the
+  queue needs to be scanned again at all.
+  """
+
+  def __init__(self, bot_dimensions, bot_id):
+    hashes = _get_dimensions_hashes(bot_dimensions)
+    self._keys = None
+    if len(hashes) <= _NOTIFY_MAX_HASHES:
+      self._keys = [_notify_key(h) for h in hashes]
+    # The dimensions are part of the key so a bot whose dimensions changed
+    # scans the queue right away.
+    self._bot_key = 'bot:%s:%s' % (
+        bot_id, hashlib.md5(utils.encode_to_json(bot_dimensions)).hexdigest())
+    self._all_key = _notify_all_key(
+        int(hashlib.md5(bot_id.encode('utf-8')).hexdigest(), 16) %
+        _NOTIFY_ALL_SHARDS)
+    self._client = memcache.Client()
+    # The global counter is read first, so a notification racing with the read
+    # of the counters is seen as a change of the global counter later on.
+    self._generation = self._client.get(
+        self._all_key, namespace=_NOTIFY_NAMESPACE)
+    self._counters = self._get_counters()
+
+  def _get_counters(self):
+    if self._keys is None:
+      return None
+    return self._client.get_multi(self._keys, namespace=_NOTIFY_NAMESPACE)
+
+  def changed(self):
+    """Returns False if no task matching the bot was notified since the last
+    time wait() timed out for this bot, so the queue doesn't need to be scanned.
+    """
+    if self._generation is None:
+      return True
+    memo = self._client.get(self._bot_key, namespace=_NOTIFY_NAMESPACE)
+    if not memo:
+      return True
+    generation, counters = memo
+    if generation == self._generation:
+      return False
+    # Tasks were notified, look if any could be reaped by this bot.
+    return counters is None or counters != self._counters
+
+  def wait(self, deadline):
+    """Blocks until a matching task may have been scheduled or the deadline.
+
+    Arguments:
+    - deadline: time.time() value at which to give up.
+
+    Returns:
+      True if a matching task may have become available since the previous
+      call, False if the deadline was reached.
+    """
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        if self._generation is not None:
+          self._client.set(
+              self._bot_key, (self._generation, self._counters),
+              time=_NOTIFY_RESCAN_SECS, namespace=_NOTIFY_NAMESPACE)
+        return False
+      time.sleep(min(_NOTIFY_POLL_INTERVAL, remaining))
+      generation = self._client.get(
+          self._all_key, namespace=_NOTIFY_NAMESPACE)
+      if generation == self._generation:
+        continue
+      self._generation = generation
+      counters = self._get_counters()
+      if counters is None or counters != self._counters:
+        self._counters = counters
+        return True
+
+
 def request_to_task_to_run_key(request):
   """Returns the ndb.Key for a TaskToRun from a TaskRequest."""
   assert isinstance(request, task_request.TaskRequest), request
@@ -289,24 +577,198 @@ def set_lookup_cache(task_key, is_available_to_schedule):
     memcache.set(key, True, time=cache_lifetime, namespace='task_to_run')
 
 
-def yield_next_available_task_to_dispatch(bot_dimensions):
+def add_to_dispatch_index(to_run):
+  """Adds a reapable TaskToRun to the dispatch index, if it is in use."""
+  assert not ndb.in_transaction()
+  assert to_run.queue_number
+  client = memcache.Client()
+  h = to_run.key.integer_id()
+  request_id = to_run.request_key.integer_id()
+  entry = (to_run.queue_number, request_id, utils.time_time())
+  if client.get(_INDEX_ROOT_KEY, namespace=_INDEX_NAMESPACE) is None:
+    return
+  resurrected = []
+
+  def add_entry(entries):
+    if entries == _INDEX_OVERFLOW:
+      return None
+    if entries is None or isinstance(entries, tuple):
+      # The hash may be removed from the root concurrently, see add_hash().
+      resurrected.append(True)
+      entries = []
+    if any(e[:2] == entry[:2] for e in entries):
+      return None
+    # A retried task keeps its TaskRequest but may get a new queue_number.
+    entries = [e for e in entries if e[1] != request_id]
+    if len(entries) >= _INDEX_MAX_ENTRIES:
+      return _INDEX_OVERFLOW
+    bisect.insort(entries, entry)
+    return entries
+
+  def add_hash(hashes):
+    # Always write the root when the shard was created or was a tombstone, so a
+    # concurrent rebuild_dispatch_index() that is about to remove this hash
+    # fails its compare-and-set and looks at the shard again.
+    if h in hashes and not resurrected:
+      return None
+    hashes.add(h)
+    return hashes
+
+  # The shard is updated before the root so a reaper never sees a hash without
+  # its shards, except if one was evicted.
+  if (not _index_update(
+          client, _index_shard_key(h, request_id), add_entry, create=True) or
+      not _index_update(client, _INDEX_ROOT_KEY, add_hash)):
+    _drop_dispatch_index()
+
+
+def remove_from_dispatch_index(task_key):
+  """Removes a TaskToRun that is not reapable anymore from the dispatch index.
+
+  This is not strictly necessary, since each entry is verified against the DB
+  when used, but it saves useless fetches.
+  """
+  assert not ndb.in_transaction()
+  request_id = task_to_run_key_to_request_key(task_key).integer_id()
+
+  def remove_entry(entries):
+    if not isinstance(entries, list):
+      return None
+    out = [e for e in entries if e[1] != request_id]
+    return out if len(out) != len(entries) else None
+
+  # A missing entry is fine, there is nothing to remove.
+  _index_update(
+      memcache.Client(), _index_shard_key(task_key.integer_id(), request_id),
+      remove_entry)
+
+
+def notify_task_available(to_run):
+  """Wakes up the bots waiting in TaskListener.wait() for this TaskToRun.
+
+  The bots are woken by dimensions_hash, so only the bots that could reap it
+  look at the DB.
+  """
+  assert not ndb.in_transaction()
+  # The hash counter is incremented first, see TaskListener.__init__().
+  client = memcache.Client()
+  client.incr(
+      _notify_key(to_run.key.integer_id()), namespace=_NOTIFY_NAMESPACE,
+      initial_value=0)
+  client.offset_multi(
+      dict.fromkeys(
+          (_notify_all_key(i) for i in xrange(_NOTIFY_ALL_SHARDS)), 1),
+      namespace=_NOTIFY_NAMESPACE, initial_value=0)
+
+
+def rebuild_dispatch_index():
+  """Rebuilds the dispatch index from the DB.
+
+  The shards are merged with their current value instead of being overwritten,
+  so the entries added concurrently by add_to_dispatch_index() are kept.
+  Entries missed because of memcache eviction or of a crash before
+  add_to_dispatch_index() are recovered the next time it is run.
+
+  Only the queue_number is projected, so the query is served from its built-in
+  index like a keys-only query, without fetching the entities. Expired tasks
+  are indexed until they are aborted; they are skipped when dispatching.
+
+  Returns:
+    Number of TaskToRun in the index.
+  """
+  start = utils.time_time()
+  # shard key -> {request_id: entry}.
+  entries = {}
+  q = TaskToRun.query(projection=[TaskToRun.queue_number]).filter(
+      TaskToRun.queue_number > 0)
+  for to_run in q:
+    h = to_run.key.integer_id()
+    request_id = to_run.request_key.integer_id()
+    entries.setdefault(_index_shard_key(h, request_id), {})[request_id] = (
+        to_run.queue_number, request_id, 0)
+
+  client = memcache.Client()
+  previous = client.get(_INDEX_ROOT_KEY, namespace=_INDEX_NAMESPACE) or set()
+  hashes = previous.union(
+      int(key.split(':', 1)[0], 16) for key in entries)
+  # Hashes with at least one shard that is not a tombstone.
+  live = set()
+  total = 0
+  for h in hashes:
+    for key in _index_shard_keys(h):
+      merged = {}
+
+      def merge(value):
+        # This function may be called multiple times on compare-and-set
+        # conflict.
+        merged.clear()
+        merged.update(entries.get(key, {}))
+        # An overflowing shard doesn't record the recent entries. When it stops
+        # overflowing, the entries missed by the query are only recovered by
+        # the next rebuild.
+        if isinstance(value, list):
+          # Keep the recent entries that the query may have missed.
+          for e in value:
+            if e[2] >= start - _INDEX_RECENT_SECS:
+              merged.setdefault(e[1], e)
+        if len(merged) > _INDEX_MAX_ENTRIES:
+          return _INDEX_OVERFLOW
+        return sorted(merged.itervalues()) or ()
+
+      if not _index_update(client, key, merge, create=True):
+        logging.error('Failed to save the dispatch index')
+        _drop_dispatch_index()
+        return 0
+      if merged:
+        # An overflowing shard must stay in the root so it is scanned.
+        live.add(h)
+        if len(merged) <= _INDEX_MAX_ENTRIES:
+          total += len(merged)
+
+  def update_root(root):
+    root = (root or set()).union(live)
+    # Only remove a hash when all its shards are still tombstones. Otherwise
+    # add_to_dispatch_index() resurrected one, see add_hash() there.
+    candidates = sorted(root - live)
+    if candidates:
+      values = client.get_multi(
+          [k for h in candidates for k in _index_shard_keys(h)],
+          namespace=_INDEX_NAMESPACE)
+      for h in candidates:
+        if all(values.get(k) == () for k in _index_shard_keys(h)):
+          root.discard(h)
+    return root
+
+  if not _index_update(client, _INDEX_ROOT_KEY, update_root, create=True):
+    logging.error('Failed to save the dispatch index')
+    _drop_dispatch_index()
+    return 0
+  client.set(_INDEX_REBUILT_KEY, start, namespace=_INDEX_NAMESPACE)
+  logging.info('Indexed %d tasks for %d dimensions hashes', total, len(live))
+  return total
+
+
+def yield_next_available_task_to_dispatch(bot_dimensions, deadline=None):
   """Yields next available (TaskRequest, TaskToRun) in decreasing order of
   priority.
 
   Once the caller determines the task is suitable to execute, it must use
   reap_task_to_run(task.key) to mark that it is not to be scheduled anymore.
 
-  Performance is the top most priority here.
+  Performance is the top most priority here. The candidates are taken from the
+  dispatch index when it is usable, otherwise the whole queue is scanned.
 
   Arguments:
   - bot_dimensions: dimensions (as a dict) defined by the bot that can be
       matched.
+  - deadline: utils.utcnow() value at which to stop searching. Defaults to 40
+      seconds from now.
   """
   # List of all the valid dimensions hashed.
-  accepted_dimensions_hash = frozenset(
-      _hash_dimensions(utils.encode_to_json(i))
-      for i in _powerset(bot_dimensions))
+  accepted_dimensions_hash = _get_dimensions_hashes(bot_dimensions)
   now = utils.utcnow()
+  if deadline is None:
+    deadline = now + datetime.timedelta(seconds=40)
   broken = 0
   cache_lookup = 0
   expired = 0
@@ -315,9 +777,17 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
   no_queue = 0
   real_mismatch = 0
   total = 0
-  # Be very aggressive in fetching the largest amount of items as possible. Note
-  # that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
-  # returned. It's handled specifically.
+  # Keys are fetched by pages. Each page is processed in a pipelined way: the
+  # next page fetch is started, then the quick lookup cache is queried for all
+  # the candidates of the current page in a single memcache RPC, then both the
+  # TaskToRun and TaskRequest entities of the remaining candidates are fetched
+  # in parallel with ndb.get_multi_async().
+  #
+  # Note that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
+  # returned by the query. It's handled specifically. Using ndb.get_multi
+  # returns fresher objects than what is returned by the query.
+  #
+  # The previous serial implementation measured:
   # - 100/200 gives 2s~40s of query time for 1275 items.
   # - 250/500 gives 2s~50s of query time for 1275 items.
   # - 50/500 gives 3s~20s of query time for 1275 items. (Slower but less
@@ -328,20 +798,20 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
   # - Abusing batching will slow down this query.
   #
   # TODO(maruel): Measure query performance with stats_framework!!
-  # TODO(maruel): Use fetch_page_async() + ndb.get_multi_async() +
-  # memcache.get_multi_async() to do pipelined processing. Should greatly reduce
-  # the effect of latency on the total duration of this function. I also suspect
-  # using ndb.get_multi() will return fresher objects than what is returned by
-  # the query.
-  opts = ndb.QueryOptions(batch_size=50, prefetch_size=500, keys_only=True)
+  page_size = 100
+  # Interestingly, the filter on .queue_number>0 is required otherwise all the
+  # None items are returned first.
+  q = TaskToRun.query(default_options=ndb.QueryOptions(keys_only=True)).order(
+      TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
+  indexed = _get_task_keys_from_index(accepted_dimensions_hash)
+  if indexed is None:
+    pages = _yield_pages(q, page_size)
+  else:
+    pages = (
+      indexed[i:i+page_size] for i in xrange(0, len(indexed), page_size))
   try:
-    # Interestingly, the filter on .queue_number>0 is required otherwise all the
-    # None items are returned first.
-    q = TaskToRun.query(default_options=opts).order(
-        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
-    for task_key in q:
-      duration = (utils.utcnow() - now).total_seconds()
-      if duration > 40.:
+    for task_keys in pages:
+      if utils.utcnow() > deadline:
         # Stop searching after too long, since the odds of the request blowing
         # up right after succeeding in reaping a task is not worth the dangling
         # task request that will stay in limbo until the cron job reaps it and
@@ -350,67 +820,86 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
         # request.
         return
 
-      total += 1
-      # Verify TaskToRun is what is expected. Play defensive here.
-      try:
-        validate_to_run_key(task_key)
-      except ValueError as e:
-        logging.error(str(e))
-        broken += 1
-        continue
-
-      # integer_id() == dimensions_hash.
-      if task_key.integer_id() not in accepted_dimensions_hash:
-        hash_mismatch += 1
-        continue
-
-      # Do this after the basic weeding out but before fetching TaskRequest.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # Ok, it's now worth taking a real look at the entity.
-      task = task_key.get(use_cache=False)
-
-      # DB operations are slow, double check memcache again.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # It is possible for the index to be inconsistent since it is not executed
-      # in a transaction, no problem.
-      if not task.queue_number:
-        no_queue += 1
-        continue
-
-      # It expired. A cron job will cancel it eventually. Since 'now' is saved
-      # before the query, an expired task may still be reaped even if
-      # technically expired if the query is very slow. This is on purpose so
-      # slow queries do not cause exagerate expirations.
-      if task.expiration_ts < now:
-        expired += 1
-        continue
-
-      # The hash may have conflicts. Ensure the dimensions actually match by
-      # verifying the TaskRequest. There's a probability of 2**-31 of conflicts,
-      # which is low enough for our purpose. The reason use_cache=False is
-      # otherwise it'll create a buffer bloat.
-      request = task.request_key.get(use_cache=False)
-      if not match_dimensions(request.properties.dimensions, bot_dimensions):
-        real_mismatch += 1
+      candidates = []
+      for task_key in task_keys:
+        total += 1
+        # Verify TaskToRun is what is expected. Play defensive here.
+        try:
+          validate_to_run_key(task_key)
+        except ValueError as e:
+          logging.error(str(e))
+          broken += 1
+          continue
+
+        # integer_id() == dimensions_hash.
+        if task_key.integer_id() not in accepted_dimensions_hash:
+          hash_mismatch += 1
+          continue
+        candidates.append(task_key)
+
+      # Do this after the basic weeding out but before fetching the entities.
+      keys = _filter_taken(candidates)
+      cache_lookup += len(candidates) - len(keys)
+      if not keys:
         continue
 
-      # It's a valid task! Note that in the meantime, another bot may have
-      # reaped it.
-      yield request, task
-      ignored += 1
+      # Ok, it's now worth taking a real look at the entities. The reason
+      # use_cache=False is otherwise it'll create a buffer bloat.
+      task_futures = ndb.get_multi_async(keys, use_cache=False)
+      request_futures = ndb.get_multi_async(
+          [task_to_run_key_to_request_key(k) for k in keys], use_cache=False)
+      tasks = [f.get_result() for f in task_futures]
+      requests = [f.get_result() for f in request_futures]
+
+      still_available = frozenset()
+      checked_until = 0
+      for i, (task_key, task, request) in enumerate(zip(keys, tasks, requests)):
+        if i >= checked_until:
+          # DB operations are slow, double check memcache again. It is done by
+          # small slices so it is still fresh when the candidates are yielded.
+          checked_until = i + _RECHECK_SLICE
+          still_available = frozenset(_filter_taken(keys[i:checked_until]))
+        if task_key not in still_available:
+          cache_lookup += 1
+          continue
+
+        # It is possible for the index to be inconsistent since it is not
+        # executed in a transaction, no problem.
+        if not task or not task.queue_number:
+          no_queue += 1
+          continue
+
+        # It expired. A cron job will cancel it eventually. Since 'now' is saved
+        # before the query, an expired task may still be reaped even if
+        # technically expired if the query is very slow. This is on purpose so
+        # slow queries do not cause exagerate expirations.
+        if task.expiration_ts < now:
+          expired += 1
+          continue
+
+        # The hash may have conflicts. Ensure the dimensions actually match by
+        # verifying the TaskRequest. There's a probability of 2**-31 of
+        # conflicts, which is low enough for our purpose.
+        if not request:
+          broken += 1
+          continue
+        if not match_dimensions(request.properties.dimensions, bot_dimensions):
+          real_mismatch += 1
+          continue
+
+        # It's a valid task! Note that in the meantime, another bot may have
+        # reaped it.
+        yield request, task
+        ignored += 1
+        # The caller took its time trying to reap it, check the next ones again.
+        checked_until = i + 1
   finally:
     duration = (utils.utcnow() - now).total_seconds()
     logging.info(
-        '%d/%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
+        '%d/page%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
         '%d cache negative, %d dimensions mismatch, %d ignored, %d broken',
-        opts.batch_size,
-        opts.prefetch_size,
+        page_size,
+        ' (indexed)' if indexed is not None else '',
         duration,
         total,
         expired,
@@ -8,12 +8,14 @@ import hashlib
 import os
 import random
 import sys
+import time
 import timeit
 import unittest
 
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import auth_testing
@@ -571,6 +573,26 @@ class TaskToRunApiTest(TestCase):
     actual = _yield_next_available_task_to_dispatch(bot_dimensions)
     self.assertEqual(expected, actual)
 
+  def test_yield_next_available_task_to_dispatch_taken(self):
+    # Tasks marked as taken in the quick lookup cache are skipped.
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    to_run_1 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    self.mock_now(self.now, 1)
+    _gen_new_task_to_run(properties=dict(dimensions=request_dimensions))
+    task_to_run.set_lookup_cache(to_run_1.key, False)
+
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = [
+      {
+        'dimensions_hash': _hash_dimensions(request_dimensions),
+        'expiration_ts': self.expiration_ts + datetime.timedelta(seconds=1),
+        'queue_number': '0x000a890b67c95586',
+      },
+    ]
+    self.assertEqual(expected, actual)
+
   def test_yield_expired_task_to_run(self):
     _gen_new_task_to_run(scheduling_expiration_secs=60)
     self.assertEqual(1, len(_yield_next_available_task_to_dispatch({})))
@@ -608,6 +630,219 @@ class TaskToRunApiTest(TestCase):
     task_to_run.set_lookup_cache(to_run.key, True)
     self.assertEqual(False, task_to_run._lookup_cache_is_taken(to_run.key))
 
+  def test_yield_next_available_task_to_dispatch_taken_meanwhile(self):
+    # A task reaped by another bot while the caller handles the previous one is
+    # not yielded.
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    to_run_1 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    self.mock_now(self.now, 1)
+    to_run_2 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    self.mock_now(self.now, 2)
+    to_run_3 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    it = task_to_run.yield_next_available_task_to_dispatch(bot_dimensions)
+    self.assertEqual(to_run_1.key, next(it)[1].key)
+    task_to_run.set_lookup_cache(to_run_2.key, False)
+    self.assertEqual(to_run_3.key, next(it)[1].key)
+    self.assertEqual([], list(it))
+
+  def test_filter_taken(self):
+    to_run_1 = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    self.mock_now(self.now, 1)
+    to_run_2 = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    keys = [to_run_1.key, to_run_2.key]
+    self.assertEqual([], task_to_run._filter_taken([]))
+    self.assertEqual(keys, task_to_run._filter_taken(keys))
+    task_to_run.set_lookup_cache(to_run_1.key, False)
+    self.assertEqual([to_run_2.key], task_to_run._filter_taken(keys))
+
+
+  def test_rebuild_dispatch_index(self):
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    to_run_1 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    self.mock_now(self.now, 1)
+    to_run_2 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    accepted = frozenset([_hash_dimensions(request_dimensions)])
+
+    # Not built yet, it is not used and it is not updated.
+    task_to_run.add_to_dispatch_index(to_run_1)
+    self.assertEqual(None, task_to_run._get_task_keys_from_index(accepted))
+
+    self.assertEqual(2, task_to_run.rebuild_dispatch_index())
+    self.assertEqual(
+        [to_run_1.key, to_run_2.key],
+        task_to_run._get_task_keys_from_index(accepted))
+    self.assertEqual([], task_to_run._get_task_keys_from_index(frozenset([1])))
+
+    # Only the tasks in the index are yielded.
+    task_to_run.remove_from_dispatch_index(to_run_1.key)
+    self.assertEqual(
+        [to_run_2.key], task_to_run._get_task_keys_from_index(accepted))
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    self.assertEqual([_task_to_run_to_dict(to_run_2)], actual)
+
+    task_to_run.add_to_dispatch_index(to_run_1)
+    self.assertEqual(
+        [to_run_1.key, to_run_2.key],
+        task_to_run._get_task_keys_from_index(accepted))
+    self.assertEqual(
+        2, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+
+  def test_rebuild_dispatch_index_merge(self):
+    # The entries added concurrently with a rebuild are not lost even if the
+    # eventually consistent query missed them.
+    now = [1000.]
+    self.mock(utils, 'time_time', lambda: now[0])
+    self.assertEqual(0, task_to_run.rebuild_dispatch_index())
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    h = _hash_dimensions(request_dimensions)
+    accepted = frozenset([h])
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    task_to_run.add_to_dispatch_index(to_run)
+
+    class EmptyQuery(object):
+      def __init__(self, **_):
+        pass
+      def filter(self, *_):
+        return []
+    self.mock(task_to_run.TaskToRun, 'query', staticmethod(EmptyQuery))
+    self.assertEqual(1, task_to_run.rebuild_dispatch_index())
+    self.assertEqual(
+        [to_run.key], task_to_run._get_task_keys_from_index(accepted))
+
+    # Once old enough, the entries not in the DB are removed and so is the hash.
+    now[0] += task_to_run._INDEX_RECENT_SECS + 1
+    self.assertEqual(0, task_to_run.rebuild_dispatch_index())
+    self.assertEqual([], task_to_run._get_task_keys_from_index(accepted))
+    root = lambda: memcache.get(
+        task_to_run._INDEX_ROOT_KEY, namespace=task_to_run._INDEX_NAMESPACE)
+    self.assertEqual(set(), root())
+
+    # Adding it back resurrects the hash.
+    task_to_run.add_to_dispatch_index(to_run)
+    self.assertEqual(set([h]), root())
+    self.assertEqual(
+        [to_run.key], task_to_run._get_task_keys_from_index(accepted))
+
+  def test_dispatch_index_overflow(self):
+    # A dimensions hash with too many tasks is scanned instead.
+    self.mock(task_to_run, '_INDEX_MAX_ENTRIES', 1)
+    self.mock(task_to_run, '_INDEX_SHARDS', 1)
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    to_run_1 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    accepted = frozenset([_hash_dimensions(request_dimensions)])
+    self.assertEqual(1, task_to_run.rebuild_dispatch_index())
+    self.assertEqual(
+        [to_run_1.key], task_to_run._get_task_keys_from_index(accepted))
+    self.mock_now(self.now, 1)
+    to_run_2 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    task_to_run.add_to_dispatch_index(to_run_2)
+    self.assertEqual(None, task_to_run._get_task_keys_from_index(accepted))
+    self.assertEqual(0, task_to_run.rebuild_dispatch_index())
+    self.assertEqual(None, task_to_run._get_task_keys_from_index(accepted))
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    self.assertEqual(
+        2, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+
+  def test_dispatch_index_stale(self):
+    # The index is not used when it was not rebuilt recently, since the tasks
+    # whose addition was lost are only indexed by a rebuild.
+    now = [1000.]
+    self.mock(utils, 'time_time', lambda: now[0])
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    accepted = frozenset([_hash_dimensions(request_dimensions)])
+    self.assertEqual(1, task_to_run.rebuild_dispatch_index())
+    now[0] += task_to_run._INDEX_MAX_AGE_SECS
+    self.assertEqual(
+        [to_run.key], task_to_run._get_task_keys_from_index(accepted))
+    now[0] += 1
+    self.assertEqual(None, task_to_run._get_task_keys_from_index(accepted))
+    self.assertEqual(1, task_to_run.rebuild_dispatch_index())
+    self.assertEqual(
+        [to_run.key], task_to_run._get_task_keys_from_index(accepted))
+
+    memcache.delete(
+        task_to_run._INDEX_REBUILT_KEY, namespace=task_to_run._INDEX_NAMESPACE)
+    self.assertEqual(None, task_to_run._get_task_keys_from_index(accepted))
+
+  def test_add_to_dispatch_index(self):
+    self.assertEqual(0, task_to_run.rebuild_dispatch_index())
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    accepted = frozenset([_hash_dimensions(request_dimensions)])
+    self.assertEqual([], task_to_run._get_task_keys_from_index(accepted))
+    task_to_run.add_to_dispatch_index(to_run)
+    self.assertEqual(
+        [to_run.key], task_to_run._get_task_keys_from_index(accepted))
+
+
+  def test_remove_from_dispatch_index(self):
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    accepted = frozenset([_hash_dimensions(request_dimensions)])
+    # Not built yet, it's a no-op.
+    task_to_run.remove_from_dispatch_index(to_run.key)
+    self.assertEqual(1, task_to_run.rebuild_dispatch_index())
+    task_to_run.remove_from_dispatch_index(to_run.key)
+    self.assertEqual([], task_to_run._get_task_keys_from_index(accepted))
+    # Removing twice is fine.
+    task_to_run.remove_from_dispatch_index(to_run.key)
+    self.assertEqual([], task_to_run._get_task_keys_from_index(accepted))
+
+  def test_notify_task_available(self):
+    clock = [1000.]
+    self.mock(time, 'time', lambda: clock[0])
+    def sleep(duration):
+      clock[0] += duration
+    self.mock(time, 'sleep', sleep)
+    request_dimensions = {u'OS': u'Windows-3.1.1'}
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    listener = task_to_run.TaskListener(bot_dimensions, 'localhost')
+    self.assertEqual(True, listener.changed())
+    self.assertEqual(False, listener.wait(1005.))
+    self.assertEqual(1005., clock[0])
+
+    # A task the bot can't reap only changes the global counter.
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Amiga'}))
+    task_to_run.notify_task_available(to_run)
+    self.assertEqual(False, listener.wait(1010.))
+    # Nothing was notified since the last timeout of this bot.
+    self.assertEqual(
+        False,
+        task_to_run.TaskListener(bot_dimensions, 'localhost').changed())
+    # Other tasks are being scheduled but none the bot could reap.
+    task_to_run.notify_task_available(to_run)
+    self.assertEqual(
+        False,
+        task_to_run.TaskListener(bot_dimensions, 'localhost').changed())
+    self.assertEqual(
+        True, task_to_run.TaskListener(bot_dimensions, 'other').changed())
+
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions))
+    task_to_run.notify_task_available(to_run)
+    self.assertEqual(
+        True, task_to_run.TaskListener(bot_dimensions, 'localhost').changed())
+    self.assertEqual(True, listener.wait(1020.))
+    self.assertEqual(1011., clock[0])
+    self.assertEqual(False, listener.wait(1015.))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -49,6 +49,12 @@ TASK_FAILED = 89
 _ERROR_HANDLER_WAS_REGISTERED = False
 
 
+# Number of seconds the server may hold a /poll request while waiting for a task
+# to be scheduled. The server caps it and tells the bot to poll again right away
+# when nothing came in, so the bot doesn't sleep between polls when idle.
+LONG_POLL_SECS = 15
+
+
 ### bot_config handler part.
 
 
@@ -302,8 +308,9 @@ def poll_server(botobj):
   """
   # Access to a protected member _XXX of a client class - pylint: disable=W0212
   start = time.time()
-  resp = botobj.remote.url_read_json(
-      '/swarming/api/v1/bot/poll', data=botobj._attributes)
+  data = botobj._attributes.copy()
+  data['long_poll'] = LONG_POLL_SECS
+  resp = botobj.remote.url_read_json('/swarming/api/v1/bot/poll', data=data)
   logging.debug('Server response:\n%s', resp)
 
   cmd = resp['cmd']
@@ -51,6 +51,8 @@ class TestBotMain(net_utils.TestCase):
       },
       'version': '123',
     }
+    self.poll_data = self.attributes.copy()
+    self.poll_data['long_poll'] = bot_main.LONG_POLL_SECS
     self.mock(zip_package, 'generate_version', lambda: '123')
     self.bot = bot.Bot(
         self.server, self.attributes, 'version1', self.root_dir, self.fail)
@@ -193,7 +195,7 @@ class TestBotMain(net_utils.TestCase):
           (
             'https://localhost:1/swarming/api/v1/bot/poll',
             {
-              'data': self.attributes,
+              'data': self.poll_data,
               'headers': {'X-XSRF-Token': 'token'},
             },
             {
@@ -221,7 +223,7 @@ class TestBotMain(net_utils.TestCase):
           (
             'https://localhost:1/swarming/api/v1/bot/poll',
             {
-              'data': self.bot._attributes,
+              'data': self.poll_data,
               'headers': {'X-XSRF-Token': 'token'},
             },
             {
@@ -250,7 +252,7 @@ class TestBotMain(net_utils.TestCase):
           (
             'https://localhost:1/swarming/api/v1/bot/poll',
             {
-              'data': self.attributes,
+              'data': self.poll_data,
               'headers': {'X-XSRF-Token': 'token'},
             },
             {
@@ -279,7 +281,7 @@ class TestBotMain(net_utils.TestCase):
           (
             'https://localhost:1/swarming/api/v1/bot/poll',
             {
-              'data': self.attributes,
+              'data': self.poll_data,
               'headers': {'X-XSRF-Token': 'token'},
             },
             {
@@ -308,7 +310,7 @@ class TestBotMain(net_utils.TestCase):
           (
             'https://localhost:1/swarming/api/v1/bot/poll',
             {
-              'data': self.attributes,
+              'data': self.poll_data,
               'headers': {'X-XSRF-Token': 'token'},
             },
             {
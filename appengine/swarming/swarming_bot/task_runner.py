@@ -14,7 +14,7 @@ up to the calling process (bot_main.py) to signal that there was an internal
 failure and to cancel this task run and ask the server to retry it.
 """
 
-__version__ = '0.4'
+__version__ = '0.5'
 
 import StringIO
 import base64
@@ -24,8 +24,10 @@ import optparse
 import os
 import subprocess
 import sys
+import threading
 import time
 import zipfile
+import zlib
 
 import xsrf_client
 from utils import net
@@ -45,6 +47,11 @@ MAX_PACKET_INTERVAL = 30
 MIN_PACKET_INTERNAL = 10
 
 
+# Maximum amount of stdout buffered by OutputUploader while it is sending
+# packets. Reading the child process output blocks past this point.
+MAX_BUFFERED_OUTPUT = 10*MAX_CHUNK_SIZE
+
+
 # Exit code used to indicate the task failed. Keep in sync with bot_main.py. The
 # reason for its existance is that if an exception occurs, task_runner's exit
 # code will be 1. If the process is killed, it'll likely be -9. In these cases,
@@ -143,7 +150,8 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
     swarming_server: XsrfRemote instance.
     params: Default JSON parameters for the POST.
     exit_code: Process exit code, only when a command completed.
-    stdout: Incremental output since last call, if any.
+    stdout: Incremental output since last call, if any. It is sent zlib
+        compressed.
     output_chunk_start: Total number of stdout previously sent, for coherency
         with the server.
   """
@@ -153,8 +161,9 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
   if stdout:
     # The output_chunk_start is used by the server to make sure that the stdout
     # chunks are processed and saved in the DB in order.
-    params['output'] = base64.b64encode(stdout)
+    params['output'] = base64.b64encode(zlib.compress(stdout))
     params['output_chunk_start'] = output_chunk_start
+    params['output_compression'] = 'zlib'
   # TODO(maruel): Support early cancellation.
   # https://code.google.com/p/swarming/issues/detail?id=62
   resp = swarming_server.url_read_json(
@@ -165,34 +174,138 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
     raise ValueError(resp.get('error'))
 
 
-def should_post_update(stdout, now, last_packet):
-  """Returns True if it's time to send a task_update packet via post_update().
+def calc_yield_wait(task_details, start, last_io, timed_out):
+  """Calculates the maximum number of seconds to wait in yield_any().
 
-  Sends a packet when one of this condition is met:
-  - more than MAX_CHUNK_SIZE of stdout is buffered.
-  - last packet was sent more than MIN_PACKET_INTERNAL seconds ago and there was
-    stdout.
-  - last packet was sent more than MAX_PACKET_INTERVAL seconds ago.
+  Packets are sent by OutputUploader, so only the timeouts matter.
   """
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
-  return len(stdout) >= MAX_CHUNK_SIZE or (now - last_packet) > packet_interval
-
-
-def calc_yield_wait(task_details, start, last_io, timed_out, stdout):
-  """Calculates the maximum number of seconds to wait in yield_any()."""
   now = monotonic_time()
   if timed_out:
     # Give a |grace_period| seconds delay.
     return max(now - timed_out - task_details.grace_period, 0.)
 
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
   hard_timeout = start + task_details.hard_timeout - now
   io_timeout = last_io + task_details.io_timeout - now
-  out = max(min(min(packet_interval, hard_timeout), io_timeout), 0)
+  out = max(min(hard_timeout, io_timeout), 0)
   logging.debug('calc_yield_wait() = %d', out)
   return out
 
 
+class OutputUploader(object):
+  """Sends the task_update packets with the output from a background thread.
+
+  run_command() only appends the output of the child process with add(), so
+  its pipe keeps being drained while a packet is in flight. The output buffered
+  meanwhile is coalesced in the next packet, up to MAX_CHUNK_SIZE. add() blocks
+  once MAX_BUFFERED_OUTPUT is buffered, so a slow server throttles the child
+  process instead of growing the memory usage.
+
+  The last packet, with the exit code, is sent by the caller with the output
+  returned by close().
+  """
+
+  def __init__(self, swarming_server, params, cost_usd_hour, task_start):
+    self._swarming_server = swarming_server
+    self._params = params.copy()
+    self._cost_usd_hour = cost_usd_hour
+    self._task_start = task_start
+    self._cond = threading.Condition()
+    # Only the first item is removed, when it was sent. The output is appended.
+    self._buffer = []
+    self._buffered = 0
+    self._output_chunk_start = 0
+    self._last_packet = monotonic_time()
+    self._closed = False
+    self._error = None
+    self._thread = threading.Thread(target=self._run, name='OutputUploader')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def add(self, stdout):
+    """Buffers output to be sent. Raises if sending a packet failed."""
+    with self._cond:
+      while self._buffered >= MAX_BUFFERED_OUTPUT and not self._error:
+        self._cond.wait()
+      if self._error:
+        raise self._error
+      self._buffer.append(stdout)
+      self._buffered += len(stdout)
+      # The thread only needs to wake up when the packet interval changes or a
+      # full packet is ready.
+      if (self._buffered == len(stdout) or
+          self._buffered - len(stdout) < MAX_CHUNK_SIZE <= self._buffered):
+        self._cond.notify_all()
+
+  def close(self):
+    """Stops the thread once every complete packet was sent.
+
+    Returns:
+      tuple(output not sent yet, output_chunk_start) for the last packet.
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    self._thread.join()
+    return ''.join(self._buffer), self._output_chunk_start
+
+  def _packet_interval(self):
+    return MIN_PACKET_INTERNAL if self._buffered else MAX_PACKET_INTERVAL
+
+  def _get_packet(self):
+    """Returns the output to send next or None if it is not time yet.
+
+    Sends a packet when one of this condition is met:
+    - more than MAX_CHUNK_SIZE of stdout is buffered.
+    - last packet was sent more than MIN_PACKET_INTERNAL seconds ago and there
+      was stdout.
+    - last packet was sent more than MAX_PACKET_INTERVAL seconds ago.
+
+    Once closed, only full packets are sent. Must be called with the lock held.
+    """
+    if self._buffered < MAX_CHUNK_SIZE and (
+        self._closed or
+        monotonic_time() - self._last_packet <= self._packet_interval()):
+      return None
+    stdout = ''.join(self._buffer)
+    self._buffer = [stdout] if stdout else []
+    return stdout[:MAX_CHUNK_SIZE]
+
+  def _run(self):
+    try:
+      while True:
+        with self._cond:
+          stdout = self._get_packet()
+          while stdout is None:
+            if self._closed:
+              return
+            self._cond.wait(max(
+                self._last_packet + self._packet_interval() - monotonic_time(),
+                0))
+            stdout = self._get_packet()
+          output_chunk_start = self._output_chunk_start
+
+        self._last_packet = monotonic_time()
+        self._params['cost_usd'] = (
+            self._cost_usd_hour * (self._last_packet - self._task_start) /
+            60. / 60.)
+        post_update(
+            self._swarming_server, self._params, None, stdout,
+            output_chunk_start)
+
+        with self._cond:
+          if stdout:
+            self._buffer[0] = self._buffer[0][len(stdout):]
+            self._buffered -= len(stdout)
+            self._output_chunk_start += len(stdout)
+          self._cond.notify_all()
+    except Exception as e:
+      # The output not sent is kept for the last packet.
+      logging.exception('Failed to send a task_update packet')
+      with self._cond:
+        self._error = e
+        self._cond.notify_all()
+
+
 def run_command(
     swarming_server, task_details, root_dir, cost_usd_hour, task_start):
   """Runs a command and sends packets to the server to stream results back.
@@ -204,7 +317,7 @@ def run_command(
     Child process exit code.
   """
   # Signal the command is about to be started.
-  last_packet = start = now = monotonic_time()
+  start = now = monotonic_time()
   params = {
     'cost_usd': cost_usd_hour * (now - task_start) / 60. / 60.,
     'id': task_details.bot_id,
@@ -238,32 +351,22 @@ def run_command(
     post_update(swarming_server, params, 1, stdout, 0)
     return 1
 
-  output_chunk_start = 0
-  stdout = ''
+  uploader = OutputUploader(swarming_server, params, cost_usd_hour, task_start)
   exit_code = None
   had_hard_timeout = False
   had_io_timeout = False
   timed_out = None
   try:
-    calc = lambda: calc_yield_wait(
-        task_details, start, last_io, timed_out, stdout)
-    maxsize = lambda: MAX_CHUNK_SIZE - len(stdout)
+    calc = lambda: calc_yield_wait(task_details, start, last_io, timed_out)
     last_io = monotonic_time()
-    for _, new_data in proc.yield_any(maxsize=maxsize, soft_timeout=calc):
+    for _, new_data in proc.yield_any(
+        maxsize=MAX_CHUNK_SIZE, soft_timeout=calc):
       now = monotonic_time()
       if new_data:
-        stdout += new_data
+        # Sending the packets is done asynchronously by the uploader.
+        uploader.add(new_data)
         last_io = now
 
-      # Post update if necessary.
-      if should_post_update(stdout, now, last_packet):
-        last_packet = monotonic_time()
-        params['cost_usd'] = (
-            cost_usd_hour * (last_packet - task_start) / 60. / 60.)
-        post_update(swarming_server, params, None, stdout, output_chunk_start)
-        output_chunk_start += len(stdout)
-        stdout = ''
-
       # Send signal on timeout if necessary. Both are failures, not
       # internal_failures.
       # Eventually kill but return 0 so bot_main.py doesn't cancel the task.
@@ -311,7 +414,9 @@ def run_command(
       exit_code = proc.wait()
       logging.info('Waiting for proces exit in finally - done')
 
-    # This is the very last packet for this command.
+    # This is the very last packet for this command. It includes the output
+    # that the uploader didn't send yet.
+    stdout, output_chunk_start = uploader.close()
     now = monotonic_time()
     params['cost_usd'] = cost_usd_hour * (now - task_start) / 60. / 60.
     params['duration'] = now - start
@@ -319,11 +424,8 @@ def run_command(
     params['hard_timeout'] = had_hard_timeout
     # At worst, it'll re-throw, which will be caught by bot_main.py.
     post_update(swarming_server, params, exit_code, stdout, output_chunk_start)
-    output_chunk_start += len(stdout)
-    stdout = ''
 
   logging.info('run_command() = %s', exit_code)
-  assert not stdout
   return exit_code
 
 
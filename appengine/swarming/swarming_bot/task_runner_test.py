@@ -14,9 +14,11 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
 import zipfile
+import zlib
 
 import test_env
 test_env.setup_test_env()
@@ -31,6 +33,11 @@ import task_runner
 import xsrf_client
 
 
+def decompress_output(data):
+  """Returns the output as sent by post_update()."""
+  return zlib.decompress(base64.b64decode(data))
+
+
 def compress_to_zip(files):
   out = StringIO.StringIO()
   with zipfile.ZipFile(out, 'w') as zip_file:
@@ -116,7 +123,7 @@ class TestTaskRunner(TestTaskRunnerBase):
   def get_check_final(self, exit_code=0, output='hi\n'):
     def check_final(kwargs):
       # It makes the diffing easier.
-      kwargs['data']['output'] = base64.b64decode(kwargs['data']['output'])
+      kwargs['data']['output'] = decompress_output(kwargs['data']['output'])
       self.assertEqual(
           {
             'data': {
@@ -128,6 +135,7 @@ class TestTaskRunner(TestTaskRunnerBase):
               'io_timeout': False,
               'output': output,
               'output_chunk_start': 0,
+              'output_compression': 'zlib',
               'task_id': 23,
             },
             'headers': {'X-XSRF-Token': 'token'},
@@ -326,7 +334,34 @@ class TestTaskRunner(TestTaskRunnerBase):
 
     self.mock(subprocess42, 'Popen', Popen)
 
+    # The output is sent by packets of MAX_CHUNK_SIZE, the rest is sent with
+    # the exit code.
+    output = 'hi!\n' * 100003
+    chunk_size = task_runner.MAX_CHUNK_SIZE
+    def check_packet(index):
+      def check(kwargs):
+        offset = index * chunk_size
+        self.assertEqual(
+            output[offset:offset+chunk_size],
+            decompress_output(kwargs['data'].pop('output')))
+        self.assertEqual(
+            {
+              'data': {
+                'cost_usd': 10.,
+                'id': 'localhost',
+                'output_chunk_start': offset,
+                'output_compression': 'zlib',
+                'task_id': 23,
+              },
+              'headers': {'X-XSRF-Token': 'token'},
+            },
+            kwargs)
+      return check
+
     def check_final(kwargs):
+      self.assertEqual(
+          output[3*chunk_size:],
+          decompress_output(kwargs['data'].pop('output')))
       self.assertEqual(
           {
             'data': {
@@ -338,8 +373,8 @@ class TestTaskRunner(TestTaskRunnerBase):
               'hard_timeout': False,
               'id': 'localhost',
               'io_timeout': False,
-              'output': base64.b64encode('hi!\n'),
-              'output_chunk_start': 100002*4,
+              'output_chunk_start': 3*chunk_size,
+              'output_compression': 'zlib',
               'task_id': 23,
             },
             'headers': {'X-XSRF-Token': 'token'},
@@ -364,20 +399,14 @@ class TestTaskRunner(TestTaskRunnerBase):
         },
         {},
       ),
+    ] + [
       (
         'https://localhost:1/swarming/api/v1/bot/task_update/23',
-        {
-          'data': {
-            'cost_usd': 10.,
-            'id': 'localhost',
-            'output': base64.b64encode('hi!\n' * 100002),
-            'output_chunk_start': 0,
-            'task_id': 23,
-          },
-          'headers': {'X-XSRF-Token': 'token'},
-        },
+        check_packet(i),
         {},
-      ),
+      )
+      for i in xrange(3)
+    ] + [
       (
         'https://localhost:1/swarming/api/v1/bot/task_update/23',
         check_final,
@@ -403,6 +432,52 @@ class TestTaskRunner(TestTaskRunnerBase):
         server, task_details, './', 3600., start)
     self.assertEqual(0, r)
 
+  def test_output_uploader(self):
+    # While a packet is in flight, the output is buffered and add() blocks once
+    # MAX_BUFFERED_OUTPUT is buffered.
+    self.mock(task_runner, 'MAX_CHUNK_SIZE', 4)
+    self.mock(task_runner, 'MAX_BUFFERED_OUTPUT', 8)
+    in_flight = threading.Event()
+    resume = threading.Event()
+    calls = []
+    def post_update(_server, params, exit_code, stdout, output_chunk_start):
+      self.assertEqual({'cost_usd': 0.}, params)
+      self.assertEqual(None, exit_code)
+      calls.append((stdout, output_chunk_start))
+      in_flight.set()
+      resume.wait()
+    self.mock(task_runner, 'post_update', post_update)
+
+    uploader = task_runner.OutputUploader(None, {}, 3600., time.time())
+    uploader.add('abcd')
+    in_flight.wait()
+    uploader.add('efgh')
+    t = threading.Thread(target=uploader.add, args=('ij',))
+    t.start()
+    t.join(0.1)
+    self.assertTrue(t.is_alive())
+    resume.set()
+    t.join()
+    self.assertEqual(('ij', 8), uploader.close())
+    self.assertEqual([('abcd', 0), ('efgh', 4)], calls)
+
+  def test_output_uploader_error(self):
+    # The output that failed to be sent is returned for the last packet.
+    self.mock(logging, 'exception', lambda *_: None)
+    self.mock(task_runner, 'MAX_CHUNK_SIZE', 4)
+    def post_update(*_):
+      raise ValueError('Oops')
+    self.mock(task_runner, 'post_update', post_update)
+
+    uploader = task_runner.OutputUploader(None, {}, 3600., time.time())
+    uploader.add('abcd')
+    with self.assertRaises(ValueError):
+      while True:
+        uploader.add('e')
+    stdout, output_chunk_start = uploader.close()
+    self.assertTrue(stdout.startswith('abcd'), stdout)
+    self.assertEqual(0, output_chunk_start)
+
   def test_main(self):
     def load_and_run(manifest, swarming_server, cost_usd_hour, start):
       self.assertEqual('foo', manifest)
@@ -494,7 +569,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
         self.assertLess(0., kwargs['data'].pop('cost_usd'))
         self.assertLess(0., kwargs['data'].pop('duration'))
       # It makes the diffing easier.
-      kwargs['data']['output'] = base64.b64decode(kwargs['data']['output'])
+      kwargs['data']['output'] = decompress_output(kwargs['data']['output'])
       self.assertEqual(
           {
             'data': {
@@ -504,6 +579,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
               'io_timeout': io_timeout,
               'output': output,
               'output_chunk_start': 0,
+              'output_compression': 'zlib',
               'task_id': 23,
             },
             'headers': {'X-XSRF-Token': 'token'},
@@ -758,7 +758,8 @@ def prepare_for_archival(options, cwd):
   return complete_state, infiles, isolated_hash
 
 
-def isolate_and_archive(trees, isolate_server, namespace):
+def isolate_and_archive(
+    trees, isolate_server, namespace, existence_cache=None):
   """Isolates and uploads a bunch of isolated trees.
 
   Args:
@@ -766,6 +767,8 @@ def isolate_and_archive(trees, isolate_server, namespace):
         to isolate. Options are processed by 'process_isolate_options'.
     isolate_server: URL of Isolate Server to upload to.
     namespace: namespace to upload to.
+    existence_cache: optional isolateserver.ExistenceCache to skip looking up
+        the files recently seen on the server.
 
   Returns a dict {target name -> isolate hash or None}, where target name is
   a name of *.isolated file without an extension (e.g. 'base_unittests').
@@ -813,7 +816,8 @@ def isolate_and_archive(trees, isolate_server, namespace):
       isolateserver.upload_tree(
           base_url=isolate_server,
           infiles=itertools.chain(*files_generators),
-          namespace=namespace)
+          namespace=namespace,
+          existence_cache=existence_cache)
     except Exception:
       logging.exception('Exception while uploading files')
       return None
@@ -848,6 +852,7 @@ def CMDarchive(parser, args):
   add_isolate_options(parser)
   add_subdir_option(parser)
   isolateserver.add_isolate_server_options(parser)
+  isolateserver.add_existence_cache_options(parser)
   auth.add_auth_options(parser)
   options, args = parser.parse_args(args)
   if args:
@@ -855,8 +860,14 @@ def CMDarchive(parser, args):
   process_isolate_options(parser, options)
   auth.process_auth_options(parser, options)
   isolateserver.process_isolate_server_options(parser, options, True)
-  result = isolate_and_archive(
-      [(options, os.getcwd())], options.isolate_server, options.namespace)
+  existence_cache = isolateserver.process_existence_cache_options(options)
+  try:
+    result = isolate_and_archive(
+        [(options, os.getcwd())], options.isolate_server, options.namespace,
+        existence_cache)
+  finally:
+    if existence_cache:
+      existence_cache.save()
   if result is None:
     return EXIT_CODE_UPLOAD_ERROR
   assert len(result) == 1, result
@@ -884,6 +895,7 @@ def CMDbatcharchive(parser, args):
   """
   isolateserver.add_isolate_server_options(parser)
   isolateserver.add_archive_options(parser)
+  isolateserver.add_existence_cache_options(parser)
   auth.add_auth_options(parser)
   parser.add_option(
       '--dump-json',
@@ -912,8 +924,13 @@ def CMDbatcharchive(parser, args):
     work_units.append((parse_archive_command_line(args, cwd), cwd))
 
   # Perform the archival, all at once.
-  isolated_hashes = isolate_and_archive(
-      work_units, options.isolate_server, options.namespace)
+  existence_cache = isolateserver.process_existence_cache_options(options)
+  try:
+    isolated_hashes = isolate_and_archive(
+        work_units, options.isolate_server, options.namespace, existence_cache)
+  finally:
+    if existence_cache:
+      existence_cache.save()
 
   # TODO(vadimsh): isolate_and_archive returns None on upload failure, there's
   # no way currently to figure out what *.isolated file from a batch were
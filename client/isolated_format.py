@@ -7,12 +7,15 @@
 import hashlib
 import json
 import logging
+import mmap
 import os
 import re
 import stat
 import sys
+import threading
 
 from utils import file_path
+from utils import lru
 from utils import tools
 
 
@@ -20,10 +23,45 @@ from utils import tools
 ISOLATED_FILE_VERSION = '1.4'
 
 
+# Version stored in .isolated files with files split in chunks, which older
+# clients can't fetch. See get_isolated_version().
+ISOLATED_FILE_VERSION_CHUNKED = '1.5'
+
+
 # Chunk size to use when doing disk I/O.
 DISK_FILE_CHUNK = 1024 * 1024
 
 
+# Files at least this large are hashed from a memory map instead of being read
+# in chunks, which saves copying their content into python strings. Only done
+# on 64 bits since it needs the address space.
+MMAP_MIN_SIZE = 16 * 1024 * 1024
+
+
+# Bounds of the content defined chunks a large file is split into, see
+# chunk_file().
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+
+# A chunk boundary is declared where the rolling hash has all these bits
+# cleared, which gives an average of ~1mb past CHUNK_MIN_SIZE. The high bits are
+# used since they depend on all the bytes in the window.
+_CHUNK_MASK = 0xFFFFF000
+
+
+# Number of bytes the rolling hash depends on. Each byte is shifted out of the
+# 32 bits hash after this many rounds.
+_CHUNK_WINDOW = 32
+
+
+# Random values per byte value for the gear rolling hash. They are derived from
+# md5 so they are stable across runs and platforms; changing them changes every
+# chunk boundary.
+_CHUNK_GEAR = tuple(
+    int(hashlib.md5(chr(i)).hexdigest()[:8], 16) for i in xrange(256))
+
+
 # Sadly, hashlib uses 'sha1' instead of the standard 'sha-1' so explicitly
 # specify the names here.
 SUPPORTED_ALGOS = {
@@ -68,15 +106,87 @@ def hash_file(filepath, algo):
   """Calculates the hash of a file without reading it all in memory at once.
 
   |algo| should be one of hashlib hashing algorithm.
+
+  hashlib releases the GIL while hashing, so multiple files can be hashed in
+  parallel on threads.
   """
   digest = algo()
+  with open(filepath, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if size >= MMAP_MIN_SIZE and sys.maxsize > 2**32:
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        digest.update(m)
+      finally:
+        m.close()
+    else:
+      while True:
+        chunk = f.read(DISK_FILE_CHUNK)
+        if not chunk:
+          break
+        digest.update(chunk)
+  return digest.hexdigest()
+
+
+def chunk_file(filepath, algo):
+  """Splits a file into content defined chunks and hashes them.
+
+  Boundaries are found with a gear rolling hash over the last _CHUNK_WINDOW
+  bytes, so inserting or removing data in a file only changes the chunks around
+  the modification. Chunks are between CHUNK_MIN_SIZE and CHUNK_MAX_SIZE
+  bytes, except the last one which can be smaller.
+
+  The file is read only once.
+
+  Arguments:
+    filepath: file to chunk.
+    algo: hashlib hashing algorithm class.
+
+  Returns:
+    tuple(hex digest of the whole file, list of [hex digest, size] per chunk).
+  """
+  whole = algo()
+  chunks = []
+  digest = algo()
+  # Size of the current chunk accumulated from the previous reads.
+  size = 0
+  h = 0
+  gear = _CHUNK_GEAR
+  skip_until = CHUNK_MIN_SIZE - _CHUNK_WINDOW
   with open(filepath, 'rb') as f:
     while True:
-      chunk = f.read(DISK_FILE_CHUNK)
-      if not chunk:
+      data = f.read(DISK_FILE_CHUNK)
+      if not data:
         break
-      digest.update(chunk)
-  return digest.hexdigest()
+      whole.update(data)
+      buf = bytearray(data)
+      end = len(buf)
+      # Start of the current chunk in |data|.
+      begin = 0
+      i = 0
+      while i < end:
+        length = size + i - begin
+        if length < skip_until:
+          # The bytes before the window can't influence the boundary.
+          i = min(end, i + skip_until - length)
+          h = 0
+          continue
+        h = ((h << 1) + gear[buf[i]]) & 0xFFFFFFFF
+        i += 1
+        length += 1
+        if ((length >= CHUNK_MIN_SIZE and not h & _CHUNK_MASK) or
+            length >= CHUNK_MAX_SIZE):
+          digest.update(data[begin:i])
+          chunks.append([digest.hexdigest(), length])
+          digest = algo()
+          size = 0
+          begin = i
+          h = 0
+      digest.update(data[begin:])
+      size += end - begin
+  if size:
+    chunks.append([digest.hexdigest(), size])
+  return whole.hexdigest(), chunks
 
 
 class IsolatedFile(object):
@@ -306,7 +416,7 @@ def expand_directories_and_symlinks(
 
 
 @tools.profile
-def file_to_metadata(filepath, prevdict, read_only, algo):
+def file_to_metadata(filepath, prevdict, read_only, algo, chunk_threshold=0):
   """Processes an input file, a dependency, and return meta data about it.
 
   Behaviors:
@@ -323,6 +433,8 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
                windows, mode is not set since all files are 'executable' by
                default.
     algo:      Hashing algorithm used.
+    chunk_threshold: if non-zero, files at least this large are split into
+               content defined chunks listed in 'c', see chunk_file().
 
   Returns:
     The necessary dict to create a entry in the 'files' section of an .isolated
@@ -370,8 +482,15 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
         prevdict.get('s') == out['s']):
       # Reuse the previous hash if available.
       out['h'] = prevdict.get('h')
-    if not out.get('h'):
-      out['h'] = hash_file(filepath, algo)
+      if prevdict.get('c'):
+        out['c'] = prevdict['c']
+    if chunk_threshold and out['s'] >= chunk_threshold:
+      if not out.get('h') or not out.get('c'):
+        out['h'], out['c'] = chunk_file(filepath, algo)
+    else:
+      out.pop('c', None)
+      if not out.get('h'):
+        out['h'] = hash_file(filepath, algo)
   else:
     # If the timestamp wasn't updated, carry on the link destination.
     if prevdict.get('t') == out['t']:
@@ -390,6 +509,120 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
   return out
 
 
+class HashCache(object):
+  """Persistent cache of file digests across runs, keyed by the file path.
+
+  An entry is only reused if the file inode, modification time and size didn't
+  change. It is meant to be used around file_to_metadata():
+
+    with HashCache(path) as hash_cache:
+      prevdict = hash_cache.get(filepath, algo)
+      meta = file_to_metadata(filepath, prevdict, read_only, algo)
+      hash_cache.update(filepath, algo, meta)
+
+  The least recently used entries are evicted past |max_items|.
+  """
+
+  def __init__(self, state_file, max_items=50000):
+    self.state_file = state_file
+    self.max_items = max_items
+    self._lock = threading.Lock()
+    self._lru = lru.LRUDict()
+    if os.path.isfile(state_file):
+      try:
+        self._lru = lru.LRUDict.load(state_file)
+      except ValueError as e:
+        logging.warning('Discarding the hash cache: %s', e)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.save()
+    return False
+
+  def get(self, filepath, algo):
+    """Returns a prevdict for file_to_metadata(), empty if |filepath| changed.
+    """
+    try:
+      filestats = os.lstat(filepath)
+    except OSError:
+      return {}
+    key = self._key(filepath, algo)
+    with self._lock:
+      value = self._lru.get(key)
+      if not value:
+        return {}
+      inode, mtime, size, digest, chunks = value
+      if (inode != filestats.st_ino or mtime != filestats.st_mtime or
+          size != filestats.st_size):
+        return {}
+      self._lru.touch(key)
+    out = {'h': digest, 's': size, 't': int(round(mtime))}
+    if chunks:
+      out['c'] = chunks
+    return out
+
+  def update(self, filepath, algo, metadata):
+    """Saves the digest in |metadata| as returned by file_to_metadata()."""
+    if 'h' not in metadata:
+      return
+    try:
+      filestats = os.lstat(filepath)
+    except OSError:
+      return
+    if (metadata.get('t') != int(round(filestats.st_mtime)) or
+        metadata.get('s') != filestats.st_size):
+      # The file was modified while being hashed.
+      return
+    value = [
+      filestats.st_ino, filestats.st_mtime, filestats.st_size, metadata['h'],
+      metadata.get('c'),
+    ]
+    with self._lock:
+      self._lru.add(self._key(filepath, algo), value)
+      while len(self._lru) > self.max_items:
+        self._lru.pop_oldest()
+
+  def hash_file(self, filepath, algo):
+    """Same as the module's hash_file() but reuses the cached digest."""
+    digest = self.get(filepath, algo).get('h')
+    if digest:
+      return digest
+    filestats = os.lstat(filepath)
+    digest = hash_file(filepath, algo)
+    if not stat.S_ISLNK(filestats.st_mode):
+      self.update(filepath, algo, {
+        'h': digest,
+        's': filestats.st_size,
+        't': int(round(filestats.st_mtime)),
+      })
+    return digest
+
+  def save(self):
+    """Saves the modifications to |state_file|."""
+    with self._lock:
+      try:
+        self._lru.save(self.state_file)
+      except (IOError, OSError) as e:
+        logging.warning('Failed to save the hash cache: %s', e)
+
+  @staticmethod
+  def _key(filepath, algo):
+    return '%s:%s' % (SUPPORTED_ALGOS_REVERSE[algo], os.path.abspath(filepath))
+
+
+def get_isolated_version(files):
+  """Returns the version to store in a .isolated file with these |files|.
+
+  The version is only bumped when a file is split in chunks, so the other
+  .isolated files can still be used by older clients.
+  """
+  if any('c' in props for props in files.itervalues()):
+    return ISOLATED_FILE_VERSION_CHUNKED
+  return ISOLATED_FILE_VERSION
+
+
 def save_isolated(isolated, data):
   """Writes one or multiple .isolated files.
 
@@ -486,6 +719,20 @@ def load_isolated(content, algo):
           elif subsubkey == 's':
             if not isinstance(subsubvalue, (int, long)):
               raise IsolatedError('Expected int or long, got %r' % subsubvalue)
+          elif subsubkey == 'c':
+            if version < (1, 5):
+              raise IsolatedError(
+                  'Key \'c\' is not allowed before version 1.5')
+            if not isinstance(subsubvalue, list) or not subsubvalue:
+              raise IsolatedError(
+                  'Expected non-empty list, got %r' % subsubvalue)
+            for chunk in subsubvalue:
+              if (not isinstance(chunk, list) or len(chunk) != 2 or
+                  not isinstance(chunk[0], basestring) or
+                  not is_valid_hash(chunk[0], algo) or
+                  not isinstance(chunk[1], (int, long))):
+                raise IsolatedError(
+                    'Expected [sha-1, size] chunk, got %r' % chunk)
           else:
             raise IsolatedError('Unknown subsubkey %s' % subsubkey)
         if bool('h' in subvalue) == bool('l' in subvalue):
@@ -504,6 +751,15 @@ def load_isolated(content, algo):
           raise IsolatedError(
               'Cannot use \'m\' (mode) and \'l\' (link), got: %r' %
               subvalue)
+        if 'c' in subvalue:
+          if 'h' not in subvalue:
+            raise IsolatedError(
+                'Cannot use \'c\' (chunks) without \'h\' (sha-1), got: %r' %
+                subvalue)
+          if sum(c[1] for c in subvalue['c']) != subvalue['s']:
+            raise IsolatedError(
+                'Chunks \'c\' must add up to \'s\' (size), got: %r' %
+                subvalue)
 
     elif key == 'includes':
       if not isinstance(value, list):
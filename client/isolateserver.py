@@ -5,9 +5,12 @@
 
 """Archives a set of files or directories to an Isolate Server."""
 
-__version__ = '0.4.3'
+__version__ = '0.4.5'
 
 import base64
+import bisect
+import collections
+import errno
 import functools
 import logging
 import optparse
@@ -18,7 +21,6 @@ import sys
 import tempfile
 import threading
 import time
-import types
 import urllib
 import urlparse
 import zlib
@@ -53,18 +55,28 @@ UNKNOWN_FILE_SIZE = None
 DEADLOCK_TIMEOUT = 5 * 60
 
 
-# The number of files to check the isolate server per /pre-upload query.
-# All files are sorted by likelihood of a change in the file content
-# (currently file size is used to estimate this: larger the file -> larger the
-# possibility it has changed). Then first ITEMS_PER_CONTAINS_QUERIES[0] files
-# are taken and send to '/pre-upload', then next ITEMS_PER_CONTAINS_QUERIES[1],
-# and so on. Numbers here is a trade-off; the more per request, the lower the
-# effect of HTTP round trip latency and TCP-level chattiness. On the other hand,
-# larger values cause longer lookups, increasing the initial latency to start
-# uploading, which is especially an issue for large files. This value is
-# optimized for the "few thousands files to look up with minimal number of large
-# files missing" case.
-ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
+# The number of files to check the isolate server per /pre-upload query is
+# adapted to the measured round trip times, see ContainsBatchSizer. All files
+# are sorted by likelihood of a change in the file content (currently file size
+# is used to estimate this: larger the file -> larger the possibility it has
+# changed). Then the first CONTAINS_MIN_BATCH_SIZE files are taken and send to
+# '/pre-upload', so the large files missing can start uploading early. The
+# following batches grow by CONTAINS_BATCH_SIZE_INCREMENT items per query
+# answered within CONTAINS_TARGET_LATENCY, up to CONTAINS_MAX_BATCH_SIZE, and
+# are halved when a query is slow or fails. The more per request, the lower the
+# effect of HTTP round trip latency and TCP-level chattiness; too large requests
+# hit the server deadline.
+CONTAINS_MIN_BATCH_SIZE = 20
+CONTAINS_MAX_BATCH_SIZE = 1000
+CONTAINS_BATCH_SIZE_INCREMENT = 20
+CONTAINS_TARGET_LATENCY = 5.
+
+# Number of concurrent /pre-upload queries to start with. Grows by one per round
+# of fast queries, up to the size of the network thread pool.
+CONTAINS_INITIAL_CONCURRENCY = 4
+
+# Upper bounds (in seconds) of the buckets of the /pre-upload latency histogram.
+CONTAINS_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1., 2., 5., 10., 30.)
 
 
 # A list of already compressed extension types that should not receive any
@@ -79,17 +91,64 @@ ALREADY_COMPRESSED_TYPES = [
 NET_IO_FILE_CHUNK = 16 * 1024
 
 
+# Maximum number of times a download interrupted by a network error is resumed
+# from the last received byte. A resume is only attempted after some progress
+# was made, so a dead server still fails fast.
+FETCH_MAX_RESUMES = 16
+
+
+# Uncompressed items at least RANGE_FETCH_MIN_SIZE large are downloaded as
+# byte ranges of RANGE_FETCH_SIZE over RANGE_FETCH_THREADS parallel
+# connections, directly into a preallocated file.
+RANGE_FETCH_MIN_SIZE = 64 * 1024 * 1024
+RANGE_FETCH_SIZE = 16 * 1024 * 1024
+RANGE_FETCH_THREADS = 4
+
+
+# Items of at most FETCH_MULTI_MAX_SIZE bytes are fetched in batches of up to
+# FETCH_MULTI_MAX_ITEMS in a single request, to amortize the per-request
+# overhead on trees with many small files.
+FETCH_MULTI_MAX_SIZE = 16 * 1024
+FETCH_MULTI_MAX_ITEMS = 200
+
+
+# Small items missing from the server are uploaded in batches of at most
+# PUSH_MULTI_MAX_ITEMS items or PUSH_MULTI_MAX_SIZE bytes in a single request.
+PUSH_MULTI_MAX_ITEMS = 200
+PUSH_MULTI_MAX_SIZE = 1024 * 1024
+
+
+# Default time (in seconds) an item confirmed to be on the server is assumed to
+# still be there by ExistenceCache, and maximum number of items it remembers.
+# The TTL must stay well below the server's expiration of unused items (30 days
+# by default) since the server is not told about the items skipped this way.
+EXISTENCE_CACHE_TTL = 24 * 60 * 60
+EXISTENCE_CACHE_MAX_ITEMS = 200000
+
+
 # Read timeout in seconds for downloads from isolate storage. If there's no
 # response from the server within this timeout whole download will be aborted.
 DOWNLOAD_READ_TIMEOUT = 60
 
 
+# HTTP status codes returned by a server that doesn't implement a batch
+# endpoint. Only these disable the endpoint; other errors are retried.
+UNSUPPORTED_ENDPOINT_HTTP_CODES = (404, 405)
+
+
 # The delay (in seconds) to wait between logging statements when retrieving
 # the required files. This is intended to let the user (or buildbot) know that
 # the program is still running.
 DELAY_BETWEEN_UPDATES_IN_SECS = 30
 
 
+# Number of threads used to map an isolated tree in the output directory and
+# number of files or directories handled per task. Mapping a warm cache is
+# bound by file system metadata operations, not by the CPU.
+MAPPING_THREADS = 16
+MAPPING_BATCH_SIZE = 64
+
+
 DEFAULT_BLACKLIST = (
   # Temporary vim or python files.
   r'^.+\.(?:pyc|swp)$',
@@ -122,15 +181,21 @@ def stream_read(stream, chunk_size):
     yield data
 
 
-def file_read(filepath, chunk_size=isolated_format.DISK_FILE_CHUNK, offset=0):
-  """Yields file content in chunks of |chunk_size| starting from |offset|."""
+def file_read(
+    filepath, chunk_size=isolated_format.DISK_FILE_CHUNK, offset=0, size=None):
+  """Yields file content in chunks of |chunk_size| starting from |offset|.
+
+  Stops after |size| bytes if specified.
+  """
   with open(filepath, 'rb') as f:
     if offset:
       f.seek(offset)
-    while True:
-      data = f.read(chunk_size)
+    while size is None or size > 0:
+      data = f.read(chunk_size if size is None else min(chunk_size, size))
       if not data:
         break
+      if size is not None:
+        size -= len(data)
       yield data
 
 
@@ -205,8 +270,14 @@ def get_zip_compression_level(filename):
   return 0 if file_ext in ALREADY_COMPRESSED_TYPES else 7
 
 
-def create_directories(base_directory, files):
-  """Creates the directory structure needed by the given list of files."""
+def create_directories(base_directory, files, pool=None):
+  """Creates the directory structure needed by the given list of files.
+
+  If |pool| is a ThreadPool, the directories of each depth are created in
+  parallel in batches.
+
+  Returns the number of directories created.
+  """
   logging.debug('create_directories(%s, %d)', base_directory, len(files))
   # Creates the tree of directories to create.
   directories = set(os.path.dirname(f) for f in files)
@@ -214,9 +285,26 @@ def create_directories(base_directory, files):
     while item:
       directories.add(item)
       item = os.path.dirname(item)
-  for d in sorted(directories):
-    if d:
+  directories.discard('')
+  if not pool:
+    for d in sorted(directories):
       os.mkdir(os.path.join(base_directory, d))
+    return len(directories)
+
+  def mkdirs(batch):
+    for d in batch:
+      os.mkdir(os.path.join(base_directory, d))
+
+  # Parents must exist before their children, so go one depth at a time.
+  by_depth = {}
+  for d in directories:
+    by_depth.setdefault(d.count(os.path.sep), []).append(d)
+  for depth in sorted(by_depth):
+    level = by_depth[depth]
+    for i in xrange(0, len(level), MAPPING_BATCH_SIZE):
+      pool.add_task(0, mkdirs, level[i:i+MAPPING_BATCH_SIZE])
+    pool.join()
+  return len(directories)
 
 
 def create_symlinks(base_directory, files):
@@ -236,11 +324,17 @@ def create_symlinks(base_directory, files):
 def is_valid_file(filepath, size):
   """Determines if the given files appears valid.
 
-  Currently it just checks the file's size.
+  Currently it just checks the file's size. A missing file is not valid.
   """
   if size == UNKNOWN_FILE_SIZE:
     return os.path.isfile(filepath)
-  actual_size = os.stat(filepath).st_size
+  try:
+    actual_size = os.stat(filepath).st_size
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    logging.warning('Missing item %s', os.path.basename(filepath))
+    return False
   if size != actual_size:
     logging.warning(
         'Found invalid item %s; %d != %d',
@@ -308,6 +402,46 @@ class FileItem(Item):
   def content(self):
     return file_read(self.path)
 
+  def prepare(self, hash_algo):
+    if self.digest is None:
+      self.digest = isolated_format.hash_file(self.path, hash_algo)
+
+
+class FileChunkItem(Item):
+  """A chunk of a large file to push to Storage, see isolated_format.chunk_file.
+  """
+
+  def __init__(self, path, offset, digest, size, high_priority=False):
+    super(FileChunkItem, self).__init__(digest, size, high_priority)
+    self.path = path
+    self.offset = offset
+    self.compression_level = get_zip_compression_level(path)
+
+  def content(self):
+    return file_read(self.path, offset=self.offset, size=self.size)
+
+
+def file_to_items(path, metadata, high_priority=False):
+  """Returns the Item list to push to Storage for a file entry.
+
+  Files that were split by isolated_format.chunk_file() are pushed as one item
+  per chunk, the other files as a single FileItem.
+  """
+  if 'c' not in metadata:
+    return [
+      FileItem(
+          path=path,
+          digest=metadata['h'],
+          size=metadata['s'],
+          high_priority=high_priority),
+    ]
+  items = []
+  offset = 0
+  for digest, size in metadata['c']:
+    items.append(FileChunkItem(path, offset, digest, size, high_priority))
+    offset += size
+  return items
+
 
 class BufferItem(Item):
   """A byte buffer to push to Storage."""
@@ -333,13 +467,16 @@ class Storage(object):
   signal handlers table to handle Ctrl+C.
   """
 
-  def __init__(self, storage_api):
+  def __init__(self, storage_api, existence_cache=None):
     self._storage_api = storage_api
+    self._existence_cache = existence_cache
     self._use_zip = isolated_format.is_namespace_with_compression(
         storage_api.namespace)
     self._hash_algo = isolated_format.get_hash_algo(storage_api.namespace)
     self._cpu_thread_pool = None
     self._net_thread_pool = None
+    self._contains_sizer = ContainsBatchSizer(
+        threading_utils.IOAutoRetryThreadPool.MAX_WORKERS)
     self._aborted = False
     self._prev_sig_handlers = {}
 
@@ -364,15 +501,21 @@ class Storage(object):
     """
     return self._storage_api.namespace
 
+  @property
+  def cpu_threads(self):
+    """Maximum number of threads of cpu_thread_pool."""
+    threads = max(threading_utils.num_processors(), 2)
+    if sys.maxsize <= 2L**32:
+      # On 32 bits userland, do not try to use more than 16 threads.
+      threads = min(threads, 16)
+    return threads
+
   @property
   def cpu_thread_pool(self):
-    """ThreadPool for CPU-bound tasks like zipping."""
+    """ThreadPool for CPU-bound tasks like hashing."""
     if self._cpu_thread_pool is None:
-      threads = max(threading_utils.num_processors(), 2)
-      if sys.maxsize <= 2L**32:
-        # On 32 bits userland, do not try to use more than 16 threads.
-        threads = min(threads, 16)
-      self._cpu_thread_pool = threading_utils.ThreadPool(2, threads, 0, 'zip')
+      self._cpu_thread_pool = threading_utils.ThreadPool(
+          2, self.cpu_threads, 0, 'zip')
     return self._cpu_thread_pool
 
   @property
@@ -382,6 +525,11 @@ class Storage(object):
       self._net_thread_pool = threading_utils.IOAutoRetryThreadPool()
     return self._net_thread_pool
 
+  @property
+  def contains_sizer(self):
+    """ContainsBatchSizer used to size and pace the 'contains' queries."""
+    return self._contains_sizer
+
   def close(self):
     """Waits for all pending tasks to finish."""
     logging.info('Waiting for all threads to die...')
@@ -433,29 +581,44 @@ class Storage(object):
     """
     logging.info('upload_items(items=%d)', len(items))
 
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
-
     # For each digest keep only first Item that matches it. All other items
     # are just indistinguishable copies from the point of view of isolate
     # server (it doesn't care about paths at all, only content and digests).
+    # Items without a digest yet are hashed by get_missing_items(), which skips
+    # their duplicates.
     seen = {}
+    unhashed = []
     duplicates = 0
     for item in items:
-      if seen.setdefault(item.digest, item) is not item:
+      if item.digest is None:
+        unhashed.append(item)
+      elif seen.setdefault(item.digest, item) is not item:
         duplicates += 1
-    items = seen.values()
+    items = seen.values() + unhashed
     if duplicates:
       logging.info('Skipped %d files with duplicated content', duplicates)
 
-    # Enqueue all upload tasks.
+    # Enqueue all upload tasks. Small items are packed in batches uploaded in a
+    # single request when the server supports it.
     missing = set()
     uploaded = []
     channel = threading_utils.TaskChannel()
+    batch = []
+    batch_size = 0
     for missing_item, push_state in self.get_missing_items(items):
       missing.add(missing_item)
-      self.async_push(channel, missing_item, push_state)
+      if not self._storage_api.can_push_multi(push_state):
+        self.async_push(channel, missing_item, push_state)
+        continue
+      batch.append((missing_item, push_state))
+      batch_size += missing_item.size
+      if (len(batch) >= PUSH_MULTI_MAX_ITEMS or
+          batch_size >= PUSH_MULTI_MAX_SIZE):
+        self.async_push_multi(channel, batch)
+        batch = []
+        batch_size = 0
+    if batch:
+      self.async_push_multi(channel, batch)
 
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
@@ -467,9 +630,14 @@ class Storage(object):
           uploaded.append(item)
           logging.debug(
               'Uploaded %d / %d: %s', len(uploaded), len(missing), item.digest)
+      if self._existence_cache:
+        self._existence_cache.add(
+            self.location, self.namespace, [i.digest for i in uploaded])
     logging.info('All files are uploaded')
 
-    # Print stats.
+    # Print stats. All the items are hashed by now, skip the duplicates that
+    # were not hashed before.
+    items = dict((item.digest, item) for item in reversed(items)).values()
     total = len(items)
     total_size = sum(f.size for f in items)
     logging.info(
@@ -530,36 +698,61 @@ class Storage(object):
         threading_utils.PRIORITY_HIGH if item.high_priority
         else threading_utils.PRIORITY_MED)
 
-    def push(content):
+    def push():
       """Pushes an Item and returns it to |channel|."""
       if self._aborted:
         raise Aborted()
       item.prepare(self._hash_algo)
+      # Content is streamed to the server, zipping it on the fly if necessary.
+      # The generator is recreated on each call so a retry by net_thread_pool
+      # restarts the stream from the beginning.
+      content = item.content()
+      if self._use_zip:
+        content = zip_compress(content, item.compression_level)
       self._storage_api.push(item, push_state, content)
       return item
 
-    # If zipping is not required, just start a push task.
-    if not self._use_zip:
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, item.content())
-      return
+    self.net_thread_pool.add_task_with_channel(channel, priority, push)
+
+  def async_push_multi(self, channel, items):
+    """Starts asynchronous push of many small items in a single request.
+
+    If the request fails, the items are pushed one by one with async_push().
 
-    # If zipping is enabled, zip in a separate thread.
-    def zip_and_push():
-      # TODO(vadimsh): Implement streaming uploads. Before it's done, assemble
-      # content right here. It will block until all file is zipped.
+    Arguments:
+      channel: TaskChannel that receives back each item when its upload ends.
+      items: list of (item, push_state) pairs, as returned by
+          'get_missing_items', for which StorageApi.can_push_multi() is True.
+    """
+    priority = (
+        threading_utils.PRIORITY_HIGH
+        if any(item.high_priority for item, _ in items)
+        else threading_utils.PRIORITY_MED)
+
+    def push_multi():
       try:
         if self._aborted:
           raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
-        data = ''.join(stream)
-      except Exception as exc:
-        logging.error('Failed to zip \'%s\': %s', item, exc)
+        batch = []
+        for item, push_state in items:
+          item.prepare(self._hash_algo)
+          content = item.content()
+          if self._use_zip:
+            content = zip_compress(content, item.compression_level)
+          batch.append((item, push_state, ''.join(content)))
+        self._storage_api.push_multi(batch)
+      except IOError as err:
+        logging.warning('Failed to push %d items at once: %s', len(items), err)
+        for item, push_state in items:
+          self.async_push(channel, item, push_state)
+        return
+      except Exception:
         channel.send_exception()
         return
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, [data])
-    self.cpu_thread_pool.add_task(priority, zip_and_push)
+      for item, _ in items:
+        channel.send_result(item)
+
+    self.net_thread_pool.add_task(priority, push_multi)
 
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
@@ -593,8 +786,14 @@ class Storage(object):
     """
     def fetch():
       try:
-        # Prepare reading pipeline.
-        stream = self._storage_api.fetch(digest)
+        if (not self._use_zip and size != UNKNOWN_FILE_SIZE and
+            size >= RANGE_FETCH_MIN_SIZE):
+          self._fetch_ranges(digest, size, sink)
+          return digest
+        # Prepare reading pipeline. The raw stream is resumed on network errors,
+        # which is transparent to the decompressor since the offset is in the
+        # stored, i.e. compressed, content.
+        stream = self._fetch_stream(digest)
         if self._use_zip:
           stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
         # Run |stream| through verifier that will assert its size.
@@ -610,10 +809,168 @@ class Storage(object):
     # really fast and most probably IO bound anyway.
     self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
 
+  def async_fetch_multi(self, channel, priority, items, sink):
+    """Starts asynchronous fetch of many small items in a single request.
+
+    The items that the server doesn't return inline are fetched one by one with
+    async_fetch().
+
+    Arguments:
+      channel: TaskChannel that receives back each digest when its download
+          ends.
+      priority: thread pool task priority for the fetch.
+      items: list of (digest, size) pairs of the items to download.
+      sink: function that will be called as sink(digest, generator).
+    """
+    def fetch_multi():
+      try:
+        contents = self._storage_api.fetch_multi([d for d, _ in items])
+      except IOError as err:
+        logging.warning('Failed to fetch %d items at once: %s', len(items), err)
+        contents = {}
+      except Exception as err:
+        logging.error('Failed to fetch %d items at once: %s', len(items), err)
+        channel.send_exception()
+        return
+      for digest, size in items:
+        content = contents.get(digest)
+        if content is not None:
+          try:
+            stream = [content]
+            if self._use_zip:
+              stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+            sink(digest, FetchStreamVerifier(stream, size).run())
+            channel.send_result(digest)
+            continue
+          except IOError as err:
+            logging.warning('Failed to fetch %s: %s', digest, err)
+          except Exception as err:
+            logging.error('Failed to fetch %s: %s', digest, err)
+            channel.send_exception()
+            continue
+        # Fetch it on its own, with retries.
+        self.async_fetch(
+            channel, priority, digest, size, functools.partial(sink, digest))
+
+    self.net_thread_pool.add_task(priority, fetch_multi)
+
+  def fetch_tree(self, root_digest):
+    """Fetches the .isolated files of the tree rooted at |root_digest| at once.
+
+    Arguments:
+      root_digest: hex digest of the root .isolated file.
+
+    Returns:
+      A dict digest -> content of the .isolated files the server returned. It
+      may be only part of the tree or empty, the missing ones are fetched with
+      async_fetch().
+    """
+    try:
+      contents = self._storage_api.fetch_tree(root_digest)
+    except IOError as err:
+      logging.warning('Failed to fetch the tree of %s: %s', root_digest, err)
+      return {}
+    out = {}
+    for digest, content in contents.iteritems():
+      if self._use_zip:
+        try:
+          content = ''.join(
+              zip_decompress([content], isolated_format.DISK_FILE_CHUNK))
+        except IOError as err:
+          logging.warning('Failed to fetch %s: %s', digest, err)
+          continue
+      # These bypass the size check done on regular fetches.
+      if self._hash_algo(content).hexdigest() != digest:
+        logging.warning('Failed to fetch %s: corrupted content', digest)
+        continue
+      out[digest] = content
+    return out
+
+  def _fetch_stream(self, digest, offset=0, size=None):
+    """Yields the stored content of |digest|, resuming on network errors.
+
+    When the connection drops, the fetch is restarted from the last received
+    byte. It gives up when an attempt didn't receive anything or after
+    FETCH_MAX_RESUMES resumes.
+
+    Arguments:
+      digest: hex digest of an item to download.
+      offset: offset in the stored content to start from.
+      size: number of bytes to fetch or None to fetch up to the end.
+    """
+    resumes = 0
+    while True:
+      if size is None:
+        stream = self._storage_api.fetch(digest, offset)
+      else:
+        stream = self._storage_api.fetch(digest, offset, size)
+      if isinstance(stream, basestring):
+        stream = [stream]
+      stream = iter(stream)
+      received = 0
+      while True:
+        try:
+          chunk = next(stream)
+        except StopIteration:
+          return
+        except IOError as err:
+          if not received or resumes >= FETCH_MAX_RESUMES:
+            raise
+          resumes += 1
+          logging.warning(
+              'Resuming fetch of %s at offset %d: %s', digest, offset, err)
+          break
+        received += len(chunk)
+        offset += len(chunk)
+        if size is not None:
+          size -= len(chunk)
+        yield chunk
+
+  def _fetch_ranges(self, digest, size, sink):
+    """Fetches an uncompressed item as byte ranges in parallel.
+
+    The ranges are written directly in a preallocated temporary file, which is
+    then passed to |sink|.
+    """
+    handle, path = tempfile.mkstemp(prefix=u'isolateserver_fetch')
+    try:
+      try:
+        os.ftruncate(handle, size)
+      finally:
+        os.close(handle)
+
+      def fetch_range(offset, length):
+        if self._aborted:
+          raise Aborted()
+        received = 0
+        with open(path, 'r+b') as f:
+          f.seek(offset)
+          for chunk in self._fetch_stream(digest, offset, length):
+            f.write(chunk)
+            received += len(chunk)
+        if received != length:
+          raise IOError(
+              'Incomplete range of %s at offset %d: expected %d, got %d' % (
+                  digest, offset, length, received))
+
+      with threading_utils.ThreadPool(
+          0, RANGE_FETCH_THREADS, 0, 'range') as pool:
+        for offset in xrange(0, size, RANGE_FETCH_SIZE):
+          pool.add_task(
+              0, fetch_range, offset, min(RANGE_FETCH_SIZE, size - offset))
+        pool.join()
+      sink(FetchStreamVerifier(file_read(path), size).run())
+    finally:
+      file_path.try_remove(path)
+
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
 
-    Issues multiple parallel queries via StorageApi's 'contains' method.
+    Issues multiple parallel queries via StorageApi's 'contains' method. The
+    items without a digest are hashed in parallel on the CPU thread pool and
+    each batch is looked up as soon as it is hashed. Only the first item of
+    each digest is looked up, and only if the existence cache doesn't know it
+    to be on the server already.
 
     Arguments:
       items: a list of Item objects to check.
@@ -626,31 +983,98 @@ class Storage(object):
             storage, it is signed upload URLs). It can later be passed to
             'async_push'.
     """
+    # Both tasks send a pair (missing items, hashed batch) to the channel.
     channel = threading_utils.TaskChannel()
-    pending = 0
+    sizer = self._contains_sizer
+    seen = set()
+    # Hashed batches waiting for a free lookup slot.
+    ready = collections.deque()
+    # Number of batches being hashed and being looked up.
+    hashing = [0]
+    looking_up = [0]
 
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    def prepare(batch):
+      if self._aborted:
+        raise Aborted()
+      for item in batch:
+        item.prepare(self._hash_algo)
+      return None, batch
 
     def contains(batch):
       if self._aborted:
         raise Aborted()
-      return self._storage_api.contains(batch)
-
-    # Enqueue all requests.
-    for batch in batch_items_for_check(items):
-      self.net_thread_pool.add_task_with_channel(
-          channel, threading_utils.PRIORITY_HIGH, contains, batch)
-      pending += 1
+      start = time.time()
+      try:
+        missing = self._storage_api.contains(batch)
+      except (IOError, isolated_format.MappingError):
+        sizer.record(start, time.time() - start, False)
+        raise
+      sizer.record(start, time.time() - start, True)
+      if self._existence_cache:
+        self._existence_cache.add(
+            self.location, self.namespace,
+            [i.digest for i in batch if i not in missing])
+      return missing, None
+
+    def check(batch):
+      """Enqueues a lookup of the new digests, if any."""
+      new_items = []
+      for item in batch:
+        if item.digest not in seen:
+          seen.add(item.digest)
+          new_items.append(item)
+      if new_items and self._existence_cache:
+        present = self._existence_cache.get_present(
+            self.location, self.namespace, [i.digest for i in new_items])
+        new_items = [i for i in new_items if i.digest not in present]
+      if new_items:
+        self.net_thread_pool.add_task_with_channel(
+            channel, threading_utils.PRIORITY_HIGH, contains, new_items)
+        looking_up[0] += 1
+
+    # Batches are cut lazily, so their size follows the latencies measured so
+    # far, and only as many lookups as the sizer allows are in flight at once.
+    # Hashing is bounded separately, by the number of CPU threads, and keeps
+    # going while the lookups are saturated.
+    batches = batch_items_for_check(items, sizer)
+    max_hashing = self.cpu_threads
+    exhausted = False
+    while True:
+      # Enough batches to fill the free lookup slots, plus up to max_hashing
+      # waiting for one.
+      max_ready = max_hashing + max(sizer.concurrency - looking_up[0], 0)
+      while (not exhausted and
+             hashing[0] < max_hashing and len(ready) < max_ready):
+        batch = next(batches, None)
+        if batch is None:
+          exhausted = True
+        elif all(i.digest is not None and i.size is not None for i in batch):
+          ready.append(batch)
+        else:
+          self.cpu_thread_pool.add_task(
+              threading_utils.PRIORITY_HIGH, channel.wrap_task(prepare), batch)
+          hashing[0] += 1
+      while ready and looking_up[0] < sizer.concurrency:
+        check(ready.popleft())
+      if not hashing[0] and not looking_up[0]:
+        if exhausted and not ready:
+          break
+        continue
 
-    # Yield results as they come in.
-    for _ in xrange(pending):
-      for missing_item, push_state in channel.pull().iteritems():
-        yield missing_item, push_state
+      # Yield results as they come in.
+      missing, hashed = channel.pull()
+      if hashed is not None:
+        hashing[0] -= 1
+        ready.append(hashed)
+      else:
+        looking_up[0] -= 1
+        for missing_item, push_state in missing.iteritems():
+          yield missing_item, push_state
+    logging.info(
+        '/preupload latencies: %s', sizer.format_histogram())
 
 
-def batch_items_for_check(items):
+def batch_items_for_check(items, sizer=None):
   """Splits list of items to check for existence on the server into batches.
 
   Each batch corresponds to a single 'exists?' query to the server via a call
@@ -658,26 +1082,184 @@ def batch_items_for_check(items):
 
   Arguments:
     items: a list of Item objects.
+    sizer: optional ContainsBatchSizer, its current batch size is read each
+        time a new batch is started. Defaults to CONTAINS_MIN_BATCH_SIZE.
 
   Yields:
     Batches of items to query for existence in a single operation,
     each batch is a list of Item objects.
   """
-  batch_count = 0
-  batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[0]
+  get_size = lambda: sizer.batch_size if sizer else CONTAINS_MIN_BATCH_SIZE
+  batch_size_limit = get_size()
   next_queries = []
   for item in sorted(items, key=lambda x: x.size, reverse=True):
     next_queries.append(item)
-    if len(next_queries) == batch_size_limit:
+    if len(next_queries) >= batch_size_limit:
       yield next_queries
       next_queries = []
-      batch_count += 1
-      batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[
-          min(batch_count, len(ITEMS_PER_CONTAINS_QUERIES) - 1)]
+      batch_size_limit = get_size()
   if next_queries:
     yield next_queries
 
 
+class ContainsBatchSizer(object):
+  """Adapts the size and number of concurrent 'contains' queries to latency.
+
+  Additive increase, multiplicative decrease: each query answered within
+  CONTAINS_TARGET_LATENCY grows the batch size by CONTAINS_BATCH_SIZE_INCREMENT
+  and each round of |concurrency| such queries allows one more concurrent
+  query. A slow or failed query halves both, at most once per round trip: the
+  queries started before the last decrease don't decrease them again.
+
+  Also keeps a histogram of the latencies of the queries. Thread safe.
+  """
+
+  def __init__(self, max_concurrency):
+    self._lock = threading.Lock()
+    self._max_concurrency = max_concurrency
+    self._batch_size = CONTAINS_MIN_BATCH_SIZE
+    self._concurrency = min(CONTAINS_INITIAL_CONCURRENCY, max_concurrency)
+    self._fast_queries = 0
+    self._last_decrease = 0
+    # One counter per bucket in CONTAINS_LATENCY_BUCKETS, plus one for the
+    # queries slower than the last bucket.
+    self._histogram = [0] * (len(CONTAINS_LATENCY_BUCKETS) + 1)
+    self._failures = 0
+
+  @property
+  def batch_size(self):
+    """Number of items to put in the next query."""
+    with self._lock:
+      return self._batch_size
+
+  @property
+  def concurrency(self):
+    """Maximum number of queries to have in flight."""
+    with self._lock:
+      return self._concurrency
+
+  def record(self, start, duration, success):
+    """Adapts the batch size and concurrency to a completed query.
+
+    Arguments:
+      start: time.time() when the query was started.
+      duration: duration of the query, in seconds.
+      success: False if the query failed.
+    """
+    with self._lock:
+      if success:
+        self._histogram[
+            bisect.bisect_left(CONTAINS_LATENCY_BUCKETS, duration)] += 1
+      else:
+        self._failures += 1
+      if success and duration <= CONTAINS_TARGET_LATENCY:
+        self._batch_size = min(
+            self._batch_size + CONTAINS_BATCH_SIZE_INCREMENT,
+            CONTAINS_MAX_BATCH_SIZE)
+        self._fast_queries += 1
+        if self._fast_queries >= self._concurrency:
+          self._fast_queries = 0
+          self._concurrency = min(
+              self._concurrency + 1, self._max_concurrency)
+      elif start >= self._last_decrease:
+        self._last_decrease = time.time()
+        self._fast_queries = 0
+        self._batch_size = max(
+            self._batch_size / 2, CONTAINS_MIN_BATCH_SIZE)
+        self._concurrency = max(self._concurrency / 2, 1)
+        logging.info(
+            '/preupload %s after %.1fs, batch size %d, concurrency %d',
+            'succeeded' if success else 'failed', duration,
+            self._batch_size, self._concurrency)
+
+  def histogram(self):
+    """Returns the latency histogram as a list of (upper bound, count).
+
+    The upper bound of the last bucket is None.
+    """
+    with self._lock:
+      return zip(CONTAINS_LATENCY_BUCKETS + (None,), self._histogram)
+
+  def format_histogram(self):
+    """Returns the latency histogram as a single line string."""
+    buckets = ', '.join(
+        '%s%s: %d' % (
+            '<=' if bound is not None else '>',
+            bound if bound is not None else CONTAINS_LATENCY_BUCKETS[-1],
+            count)
+        for bound, count in self.histogram() if count)
+    with self._lock:
+      return '%s; %d failed; batch size %d, concurrency %d' % (
+          buckets or 'none', self._failures, self._batch_size,
+          self._concurrency)
+
+
+class ExistenceCache(object):
+  """Persistent cache of the digests known to be present on isolate servers.
+
+  Keyed by (server, namespace, digest), so the successive archive invocations
+  can reuse the same state file whatever server they upload to. The state file
+  is not locked: it is loaded on creation and written back by save(), so
+  processes running concurrently must each use their own state file. An item is
+  only assumed to be on the server for |ttl| seconds after the server last
+  confirmed it. The least recently confirmed items are evicted past |max_items|.
+  """
+
+  def __init__(
+      self, state_file, ttl=EXISTENCE_CACHE_TTL,
+      max_items=EXISTENCE_CACHE_MAX_ITEMS):
+    self.state_file = state_file
+    self.ttl = ttl
+    self.max_items = max_items
+    self._lock = threading.Lock()
+    self._lru = lru.LRUDict()
+    if os.path.isfile(state_file):
+      try:
+        self._lru = lru.LRUDict.load(state_file)
+      except ValueError as e:
+        logging.warning('Discarding the existence cache: %s', e)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.save()
+    return False
+
+  def get_present(self, location, namespace, digests):
+    """Returns the set of |digests| known to be on the server."""
+    cutoff = time.time() - self.ttl
+    with self._lock:
+      return set(
+          d for d in digests
+          if self._lru.get(self._key(location, namespace, d), 0) > cutoff)
+
+  def add(self, location, namespace, digests):
+    """Records that the server confirmed |digests| are present."""
+    now = time.time()
+    with self._lock:
+      for digest in digests:
+        self._lru.add(self._key(location, namespace, digest), now)
+      while len(self._lru) > self.max_items:
+        self._lru.pop_oldest()
+
+  def save(self):
+    """Evicts the expired items and saves the modifications to |state_file|."""
+    cutoff = time.time() - self.ttl
+    with self._lock:
+      # Items are ordered by confirmation time, oldest first.
+      while self._lru and next(self._lru.itervalues()) <= cutoff:
+        self._lru.pop_oldest()
+      try:
+        self._lru.save(self.state_file)
+      except (IOError, OSError) as e:
+        logging.warning('Failed to save the existence cache: %s', e)
+
+  @staticmethod
+  def _key(location, namespace, digest):
+    return '%s:%s:%s' % (location, namespace, digest)
+
+
 class FetchQueue(object):
   """Fetches items from Storage and places them into LocalCache.
 
@@ -693,6 +1275,8 @@ class FetchQueue(object):
     self._pending = set()
     self._accessed = set()
     self._fetched = cache.cached_set()
+    # Small items not yet requested, priority -> list of (digest, size).
+    self._batches = {}
 
   def add(
       self,
@@ -725,12 +1309,23 @@ class FetchQueue(object):
     # - Make sure there's enough free disk space to fit all dependencies of
     #   this run! If not, abort early.
 
-    # Start fetching.
+    # Start fetching. Small items are grouped and fetched in a single request.
     self._pending.add(digest)
+    if size != UNKNOWN_FILE_SIZE and size <= FETCH_MULTI_MAX_SIZE:
+      batch = self._batches.setdefault(priority, [])
+      batch.append((digest, size))
+      if len(batch) >= FETCH_MULTI_MAX_ITEMS:
+        self._flush_batch(priority)
+      return
     self.storage.async_fetch(
         self._channel, priority, digest, size,
         functools.partial(self.cache.write, digest))
 
+  def _flush_batch(self, priority):
+    """Starts fetching the small items grouped at |priority|."""
+    self.storage.async_fetch_multi(
+        self._channel, priority, self._batches.pop(priority), self.cache.write)
+
   def wait(self, digests):
     """Starts a loop that waits for at least one of |digests| to be retrieved.
 
@@ -745,6 +1340,10 @@ class FetchQueue(object):
     assert all(digest in self._pending for digest in digests), (
         digests, self._pending)
 
+    # Send the partial batches before blocking on them.
+    for priority in self._batches.keys():
+      self._flush_batch(priority)
+
     # Wait for some requested item to finish fetching.
     while self._pending:
       digest = self._channel.pull()
@@ -756,6 +1355,19 @@ class FetchQueue(object):
     # Should never reach this point due to assert above.
     raise RuntimeError('Impossible state')
 
+  def prefetch_tree(self, root_digest):
+    """Adds the .isolated files of the tree rooted at |root_digest| to the cache
+    as if they were fetched from storage, using a single request.
+
+    Nothing is requested if the root .isolated file is already cached.
+    """
+    if root_digest in self._fetched or root_digest in self._pending:
+      return
+    for digest, content in self.storage.fetch_tree(root_digest).iteritems():
+      if digest not in self._fetched and digest not in self._pending:
+        self.cache.write(digest, [content])
+        self._fetched.add(digest)
+
   def inject_local_file(self, path, algo):
     """Adds local file to the cache as if it was fetched from storage."""
     with open(path, 'rb') as f:
@@ -857,18 +1469,48 @@ class StorageApi(object):
     """
     raise NotImplementedError()
 
-  def fetch(self, digest, offset=0):
+  def fetch(self, digest, offset=0, size=None):
     """Fetches an object and yields its content.
 
     Arguments:
       digest: hash digest of item to download.
       offset: offset (in bytes) from the start of the file to resume fetch from.
+      size: number of bytes to fetch from |offset|, or None to fetch up to the
+          end of the file.
 
     Yields:
       Chunks of downloaded item (as str objects).
     """
     raise NotImplementedError()
 
+  def fetch_multi(self, digests):
+    """Fetches the content of many small objects at once.
+
+    Objects that can't be returned that way are omitted and must be fetched
+    with fetch().
+
+    Arguments:
+      digests: list of hash digests of items to download.
+
+    Returns:
+      A dict digest -> stored content (as str).
+    """
+    return {}
+
+  def fetch_tree(self, root_digest):
+    """Fetches an .isolated file and the .isolated files it includes at once.
+
+    The server may return only part of the tree, or nothing at all. The other
+    .isolated files must be fetched with fetch().
+
+    Arguments:
+      root_digest: hash digest of the root .isolated file.
+
+    Returns:
+      A dict digest -> stored content (as str).
+    """
+    return {}
+
   def push(self, item, push_state, content=None):
     """Uploads an |item| with content generated by |content| generator.
 
@@ -896,6 +1538,23 @@ class StorageApi(object):
     """
     raise NotImplementedError()
 
+  def can_push_multi(self, push_state):
+    """Returns True if the item can be uploaded with push_multi()."""
+    return False
+
+  def push_multi(self, items):
+    """Uploads many small items at once.
+
+    Arguments:
+      items: list of (item, push_state, content) tuples, where |push_state|
+          was returned by 'contains' and can_push_multi() is True for it, and
+          |content| is the data to store as a str.
+
+    Returns:
+      None.
+    """
+    raise NotImplementedError()
+
   def contains(self, items):
     """Checks for |items| on the server, prepares missing ones for upload.
 
@@ -949,7 +1608,9 @@ class IsolateServer(StorageApi):
     }
     self._lock = threading.Lock()
     self._server_caps = None
-    self._memory_use = 0
+    self._fetch_multi_supported = True
+    self._fetch_tree_supported = True
+    self._push_multi_supported = True
 
   @property
   def _server_capabilities(self):
@@ -984,8 +1645,9 @@ class IsolateServer(StorageApi):
     return '%s/content-gs/retrieve/%s/%s' % (
         self._base_url, self._namespace, digest)
 
-  def fetch(self, digest, offset=0):
+  def fetch(self, digest, offset=0, size=None):
     assert offset >= 0
+    assert size is None or size > 0
     source_url = '%s/_ah/api/isolateservice/v1/retrieve' % (
         self._base_url)
     logging.debug('download_file(%s, %d)', source_url, offset)
@@ -997,13 +1659,21 @@ class IsolateServer(StorageApi):
     # for DB uploads
     content = response.get('content')
     if content is not None:
-      return base64.b64decode(content)
+      content = base64.b64decode(content)
+      return content if size is None else content[:size]
 
     # for GS entities
-    connection = net.url_open(response['url'])
+    headers = None
+    if size is not None:
+      headers = {'Range': 'bytes=%d-%d' % (offset, offset + size - 1)}
+    elif offset:
+      headers = {'Range': 'bytes=%d-' % offset}
+    connection = net.url_open(response['url'], headers=headers)
+    if not connection:
+      raise IOError('Failed to fetch %s' % response['url'])
 
     # If |offset|, verify server respects it by checking Content-Range.
-    if offset:
+    if headers:
       content_range = connection.get_header('Content-Range')
       if not content_range:
         raise IOError('Missing Content-Range header')
@@ -1017,7 +1687,7 @@ class IsolateServer(StorageApi):
           raise ValueError()
         content_offset = int(match.group(1))
         last_byte_index = int(match.group(2))
-        size = None if match.group(3) == '*' else int(match.group(3))
+        total_size = None if match.group(3) == '*' else int(match.group(3))
       except ValueError:
         raise IOError('Invalid Content-Range header: %s' % content_range)
 
@@ -1026,12 +1696,67 @@ class IsolateServer(StorageApi):
         raise IOError('Expecting offset %d, got %d (Content-Range is %s)' % (
             offset, content_offset, content_range))
 
-      # Ensure entire tail of the file is returned.
-      if size is not None and last_byte_index + 1 != size:
+      # Ensure the requested range or the entire tail of the file is returned.
+      if size is not None:
+        if last_byte_index + 1 != offset + size:
+          raise IOError(
+              'Incomplete response. Content-Range: %s' % content_range)
+      elif total_size is not None and last_byte_index + 1 != total_size:
         raise IOError('Incomplete response. Content-Range: %s' % content_range)
 
     return stream_read(connection, NET_IO_FILE_CHUNK)
 
+  def fetch_multi(self, digests):
+    if not self._fetch_multi_supported:
+      return {}
+    try:
+      response = net.url_read_json(
+          url='%s/_ah/api/isolateservice/v1/retrieve_multi' % self._base_url,
+          data={
+            'digests': [d.encode('utf-8') for d in digests],
+            'namespace': self._namespace_dict,
+          },
+          read_timeout=DOWNLOAD_READ_TIMEOUT,
+          raise_http_codes=UNSUPPORTED_ENDPOINT_HTTP_CODES)
+    except net.HttpError:
+      # An older server, don't bother retrying.
+      logging.warning('retrieve_multi unsupported, fetching items one by one')
+      self._fetch_multi_supported = False
+      return {}
+    if response is None:
+      # The items are fetched one by one, with their own retries.
+      logging.warning('retrieve_multi failed, fetching items one by one')
+      return {}
+    return dict(
+        (item['digest'], base64.b64decode(item.get('content', '')))
+        for item in response.get('items', []))
+
+  def fetch_tree(self, root_digest):
+    if not self._fetch_tree_supported:
+      return {}
+    try:
+      response = net.url_read_json(
+          url='%s/_ah/api/isolateservice/v1/resolve_tree' % self._base_url,
+          data={
+            'digest': root_digest.encode('utf-8'),
+            'namespace': self._namespace_dict,
+          },
+          read_timeout=DOWNLOAD_READ_TIMEOUT,
+          raise_http_codes=UNSUPPORTED_ENDPOINT_HTTP_CODES)
+    except net.HttpError:
+      # An older server, don't bother retrying.
+      logging.warning(
+          'resolve_tree unsupported, fetching .isolated one by one')
+      self._fetch_tree_supported = False
+      return {}
+    if response is None:
+      # The .isolated files are fetched one by one, with their own retries.
+      logging.warning('resolve_tree failed, fetching .isolated one by one')
+      return {}
+    return dict(
+        (item['digest'], base64.b64decode(item.get('content', '')))
+        for item in response.get('items', []))
+
   def push(self, item, push_state, content=None):
     assert isinstance(item, Item)
     assert item.digest is not None
@@ -1041,79 +1766,70 @@ class IsolateServer(StorageApi):
 
     # Default to item.content().
     content = item.content() if content is None else content
-    logging.info('Push state size: %d', push_state.size)
-    if isinstance(content, (basestring, list)):
-      # Memory is already used, too late.
-      with self._lock:
-        self._memory_use += push_state.size
-    else:
-      # TODO(vadimsh): Do not read from |content| generator when retrying push.
-      # If |content| is indeed a generator, it can not be re-winded back to the
-      # beginning of the stream. A retry will find it exhausted. A possible
-      # solution is to wrap |content| generator with some sort of caching
-      # restartable generator. It should be done alongside streaming support
-      # implementation.
-      #
-      # In theory, we should keep the generator, so that it is not serialized in
-      # memory. Sadly net.HttpService.request() requires the body to be
-      # serialized.
-      assert isinstance(content, types.GeneratorType), repr(content)
-      slept = False
-      # HACK HACK HACK. Please forgive me for my sins but OMG, it works!
-      # One byte less than 512mb. This is to cope with incompressible content.
-      max_size = int(sys.maxsize * 0.25)
-      while True:
-        with self._lock:
-          # This is due to 32 bits python when uploading very large files. The
-          # problem is that it's comparing uncompressed sizes, while we care
-          # about compressed sizes since it's what is serialized in memory.
-          # The first check assumes large files are compressible and that by
-          # throttling one upload at once, we can survive. Otherwise, kaboom.
-          memory_use = self._memory_use
-          if ((push_state.size >= max_size and not memory_use) or
-              (memory_use + push_state.size <= max_size)):
-            self._memory_use += push_state.size
-            memory_use = self._memory_use
-            break
-        time.sleep(0.1)
-        slept = True
-      if slept:
-        logging.info('Unblocked: %d %d', memory_use, push_state.size)
 
+    # This push operation may be a retry after failed finalization call below,
+    # no need to reupload contents in that case.
+    if not push_state.uploaded:
+      # PUT file to |upload_url|.
+      success = self.do_push(push_state, content)
+      if not success:
+        raise IOError('Failed to upload file with hash %s to URL %s' % (
+            item.digest, push_state.upload_url))
+      push_state.uploaded = True
+    else:
+      logging.info(
+          'A file %s already uploaded, retrying finalization only',
+          item.digest)
+
+    # Optionally notify the server that it's done.
+    if push_state.finalize_url:
+      # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
+      # send it to isolated server. That way isolate server can verify that
+      # the data safely reached Google Storage (GS provides MD5 and CRC32C of
+      # stored files).
+      # TODO(maruel): Fix the server to accept properly data={} so
+      # url_read_json() can be used.
+      response = net.url_read_json(
+          url='%s/%s' % (self._base_url, push_state.finalize_url),
+          data={
+              'upload_ticket': push_state.preupload_status['upload_ticket'],
+          })
+      if not response or not response['ok']:
+        raise IOError('Failed to finalize file with hash %s.' % item.digest)
+    push_state.finalized = True
+
+  def can_push_multi(self, push_state):
+    # Only the items stored inline in the datastore.
+    return self._push_multi_supported and not push_state.finalize_url
+
+  def push_multi(self, items):
+    assert all(
+        not push_state.finalize_url and not push_state.finalized
+        for _, push_state, _ in items)
     try:
-      # This push operation may be a retry after failed finalization call below,
-      # no need to reupload contents in that case.
-      if not push_state.uploaded:
-        # PUT file to |upload_url|.
-        success = self.do_push(push_state, content)
-        if not success:
-          raise IOError('Failed to upload file with hash %s to URL %s' % (
-              item.digest, push_state.upload_url))
-        push_state.uploaded = True
-      else:
-        logging.info(
-            'A file %s already uploaded, retrying finalization only',
-            item.digest)
-
-      # Optionally notify the server that it's done.
-      if push_state.finalize_url:
-        # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
-        # send it to isolated server. That way isolate server can verify that
-        # the data safely reached Google Storage (GS provides MD5 and CRC32C of
-        # stored files).
-        # TODO(maruel): Fix the server to accept properly data={} so
-        # url_read_json() can be used.
-        response = net.url_read_json(
-            url='%s/%s' % (self._base_url, push_state.finalize_url),
-            data={
+      response = net.url_read_json(
+          url='%s/_ah/api/isolateservice/v1/store_inline_multi' %
+              self._base_url,
+          data={
+            'items': [
+              {
                 'upload_ticket': push_state.preupload_status['upload_ticket'],
-            })
-        if not response or not response['ok']:
-          raise IOError('Failed to finalize file with hash %s.' % item.digest)
+                'content': base64.b64encode(content),
+              } for _, push_state, content in items
+            ],
+          },
+          raise_http_codes=UNSUPPORTED_ENDPOINT_HTTP_CODES)
+    except net.HttpError:
+      # An older server, don't bother retrying.
+      logging.warning(
+          'store_inline_multi unsupported, pushing items one by one')
+      self._push_multi_supported = False
+      response = None
+    if not response or not response['ok']:
+      raise IOError('Failed to upload %d items.' % len(items))
+    for _, push_state, _ in items:
+      push_state.uploaded = True
       push_state.finalized = True
-    finally:
-      with self._lock:
-        self._memory_use -= push_state.size
 
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
@@ -1192,15 +1908,13 @@ class IsolateServer(StorageApi):
       item: the original Item to be uploaded
       content: an iterable that yields 'str' chunks.
     """
-    # A cheezy way to avoid memcpy of (possibly huge) file, until streaming
-    # upload support is implemented.
-    if isinstance(content, list) and len(content) == 1:
-      content = content[0]
-    else:
-      content = ''.join(content)
-
-    # DB upload
+    # DB upload. Only small items are stored inline, so it is fine to assemble
+    # them in memory.
     if not push_state.finalize_url:
+      if isinstance(content, list) and len(content) == 1:
+        content = content[0]
+      else:
+        content = ''.join(content)
       url = '%s/%s' % (self._base_url, push_state.upload_url)
       content = base64.b64encode(content)
       data = {
@@ -1210,7 +1924,13 @@ class IsolateServer(StorageApi):
       response = net.url_read_json(url=url, data=data)
       return response is not None and response['ok']
 
-    # upload to GS
+    # Upload to GS. A generator is streamed with chunked transfer encoding so
+    # memory use is constant whatever the size of the item. A streamed body
+    # can't be replayed so it is not retried by net; Storage retries the whole
+    # push with a new generator instead.
+    if isinstance(content, list):
+      # Already in memory, send it as is so the request can be retried.
+      content = ''.join(content)
     url = push_state.upload_url
     response = net.url_read(
         content_type='application/octet-stream',
@@ -1333,9 +2053,11 @@ class CachePolicies(object):
 
 
 class DiskCache(LocalCache):
-  """Stateful LRU cache in a flat hash table in a directory.
+  """Stateful LRU cache in a hash table sharded in directories.
 
-  Saves its state as json file.
+  Saves its state as json file and a journal of the modifications since, see
+  lru.LRUDict. The directory is only scanned when the state is missing or
+  broken.
   """
   STATE_FILE = 'state.json'
 
@@ -1402,7 +2124,16 @@ class DiskCache(LocalCache):
     TODO(maruel): More stringent verification while keeping the check fast.
     """
     # Do the check outside the lock.
-    if not is_valid_file(self._path(digest), size):
+    path = self._path(digest)
+    if not is_valid_file(path, size):
+      if not os.path.exists(path):
+        # The state is out of sync with the files, e.g. the file was deleted
+        # externally or the process crashed before saving the state. Forget
+        # about it so it is fetched again.
+        with self._lock:
+          if digest in self._lru:
+            self._lru.pop(digest)
+            self._save()
       return False
 
     # Update it's LRU position.
@@ -1416,6 +2147,7 @@ class DiskCache(LocalCache):
     with self._lock:
       self._lru.pop(digest)
       self._delete_file(digest, UNKNOWN_FILE_SIZE)
+      self._save()
 
   def read(self, digest):
     with open(self._path(digest), 'rb') as f:
@@ -1427,6 +2159,14 @@ class DiskCache(LocalCache):
     # access bit removed which would cause the file_write() call to fail to open
     # in write mode. Take no chance here.
     file_path.try_remove(path)
+    shard_dir = os.path.dirname(path)
+    if not os.path.isdir(shard_dir):
+      try:
+        os.mkdir(shard_dir)
+      except OSError:
+        # Another thread may have created it concurrently.
+        if not os.path.isdir(shard_dir):
+          raise
     try:
       size = file_write(path, content)
     except:
@@ -1443,6 +2183,8 @@ class DiskCache(LocalCache):
     file_path.set_read_only(path, True)
     with self._lock:
       self._add(digest, size)
+      # Journal it right away, so the file is not leaked if the process dies.
+      self._save()
 
   def hardlink(self, digest, dest, file_mode):
     """Hardlinks the file to |dest|.
@@ -1459,51 +2201,62 @@ class DiskCache(LocalCache):
       os.chmod(dest, file_mode & 0500)
 
   def _load(self):
-    """Loads state of the cache from json file."""
+    """Loads state of the cache from json file and its journal.
+
+    Files are written read-only and journaled as they are added, so the cache
+    directory is only scanned when the state is missing or broken.
+    """
     self._lock.assert_locked()
 
     if not os.path.isdir(self.cache_dir):
       os.makedirs(self.cache_dir)
     else:
-      # Make sure the cache is read-only.
-      # TODO(maruel): Calculate the cost and optimize the performance
-      # accordingly.
-      file_path.make_tree_read_only(self.cache_dir)
+      # The top level only holds the state and up to 256 shards so it is cheap
+      # to list.
+      self._migrate_flat_layout()
 
     # Load state of the cache.
     if os.path.isfile(self.state_file):
       try:
         self._lru = lru.LRUDict.load(self.state_file)
+        self._trim()
+        return
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken state file.
         file_path.try_remove(self.state_file)
+        file_path.try_remove(self.state_file + lru.LRUDict.JOURNAL_SUFFIX)
+
+    # Make sure the cached files are read-only. The shards are kept writable so
+    # files can be added to them.
+    file_path.make_tree_files_read_only(self.cache_dir)
 
     # Ensure that all files listed in the state still exist and add new ones.
     previous = self._lru.keys_set()
     unknown = []
-    for filename in os.listdir(self.cache_dir):
-      if filename == self.STATE_FILE:
+    for shard in os.listdir(self.cache_dir):
+      if shard.startswith(self.STATE_FILE):
+        # The state file, its journal or a leftover temporary file.
         continue
-      if filename in previous:
-        previous.remove(filename)
+      shard_dir = os.path.join(self.cache_dir, shard)
+      if not self._is_shard(shard) or not os.path.isdir(shard_dir):
+        logging.warning('Removing unknown file %s from cache', shard)
+        self._remove_unknown(shard_dir)
         continue
-      # An untracked file.
-      if not isolated_format.is_valid_hash(filename, self.hash_algo):
-        logging.warning('Removing unknown file %s from cache', filename)
-        p = self._path(filename)
-        if os.path.isdir(p):
-          try:
-            file_path.rmtree(p)
-          except OSError:
-            pass
-        else:
-          file_path.try_remove(p)
-        continue
-      # File that's not referenced in 'state.json'.
-      # TODO(vadimsh): Verify its SHA1 matches file name.
-      logging.warning('Adding unknown file %s to cache', filename)
-      unknown.append(filename)
+      for filename in os.listdir(shard_dir):
+        digest = shard + filename
+        if digest in previous:
+          previous.remove(digest)
+          continue
+        # An untracked file.
+        if not isolated_format.is_valid_hash(digest, self.hash_algo):
+          logging.warning('Removing unknown file %s from cache', digest)
+          self._remove_unknown(os.path.join(shard_dir, filename))
+          continue
+        # File that's not referenced in 'state.json'.
+        # TODO(vadimsh): Verify its SHA1 matches file name.
+        logging.warning('Adding unknown file %s to cache', digest)
+        unknown.append(digest)
 
     if unknown:
       # Add as oldest files. They will be deleted eventually if not accessed.
@@ -1517,6 +2270,48 @@ class DiskCache(LocalCache):
         self._lru.pop(filename)
     self._trim()
 
+  def _migrate_flat_layout(self):
+    """Moves the files of the older flat layout, cache_dir/<digest>, to their
+    shard.
+    """
+    self._lock.assert_locked()
+    flat = [
+      f for f in os.listdir(self.cache_dir)
+      if isolated_format.is_valid_hash(f, self.hash_algo)
+    ]
+    if not flat:
+      return
+    logging.info('Moving %d files to the sharded cache layout', len(flat))
+    if sys.platform != 'win32':
+      # Older versions left the directory read-only.
+      file_path.set_read_only(self.cache_dir, False)
+    for digest in flat:
+      src = os.path.join(self.cache_dir, digest)
+      dst = self._path(digest)
+      shard_dir = os.path.dirname(dst)
+      if not os.path.isdir(shard_dir):
+        os.mkdir(shard_dir)
+      if os.path.exists(dst):
+        file_path.try_remove(src)
+      else:
+        os.rename(src, dst)
+
+  @staticmethod
+  def _is_shard(name):
+    """Returns True if |name| is a valid shard directory name."""
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+  @staticmethod
+  def _remove_unknown(path):
+    """Removes an unknown file or directory from the cache directory."""
+    if os.path.isdir(path):
+      try:
+        file_path.rmtree(path)
+      except OSError:
+        pass
+    else:
+      file_path.try_remove(path)
+
   def _save(self):
     """Saves the LRU ordering."""
     self._lock.assert_locked()
@@ -1525,8 +2320,10 @@ class DiskCache(LocalCache):
       if os.path.isdir(d):
         # Necessary otherwise the file can't be created.
         file_path.set_read_only(d, False)
-    if os.path.isfile(self.state_file):
-      file_path.set_read_only(self.state_file, False)
+    for path in (
+        self.state_file, self.state_file + lru.LRUDict.JOURNAL_SUFFIX):
+      if os.path.isfile(path):
+        file_path.set_read_only(path, False)
     self._lru.save(self.state_file)
 
   def _trim(self):
@@ -1568,8 +2365,13 @@ class DiskCache(LocalCache):
     self._save()
 
   def _path(self, digest):
-    """Returns the path to one item."""
-    return os.path.join(self.cache_dir, digest)
+    """Returns the path to one item.
+
+    Items are sharded on the first two hex digits of their digest, to keep the
+    directories small enough for the file system metadata operations to stay
+    fast.
+    """
+    return os.path.join(self.cache_dir, digest[:2], digest[2:])
 
   def _remove_lru_file(self):
     """Removes the last recently used file and returns its size."""
@@ -1660,6 +2462,10 @@ class IsolatedBundle(object):
       pending[h] = isolated_file
       fetch_queue.add(h, priority=threading_utils.PRIORITY_HIGH)
 
+    # Get as much of the include graph as possible in a single request, so the
+    # data files can be fetched without waiting for each level of includes.
+    fetch_queue.prefetch_tree(root_isolated_hash)
+
     # Start fetching root *.isolated file (single file, not the whole bundle).
     retrieve_async(self.root)
 
@@ -1705,7 +2511,12 @@ class IsolatedBundle(object):
       # overridden files must not be fetched.
       if filepath not in self.files:
         self.files[filepath] = properties
-        if 'h' in properties:
+        if 'c' in properties:
+          # Large files are fetched as their chunks, see write_chunked_file().
+          logging.debug('fetching %s', filepath)
+          for digest, size in properties['c']:
+            fetch_queue.add(digest, size, threading_utils.PRIORITY_MED)
+        elif 'h' in properties:
           # Preemptively request files.
           logging.debug('fetching %s', filepath)
           fetch_queue.add(
@@ -1759,7 +2570,7 @@ def get_storage_api(url, namespace):
   return cls(url, namespace)
 
 
-def get_storage(url, namespace):
+def get_storage(url, namespace, existence_cache=None):
   """Returns Storage class that can upload and download from |namespace|.
 
   Arguments:
@@ -1767,20 +2578,23 @@ def get_storage(url, namespace):
     namespace: isolate namespace to operate in, also defines hashing and
         compression scheme used, i.e. namespace names that end with '-gzip'
         store compressed data.
+    existence_cache: optional ExistenceCache to skip looking up the items
+        recently seen on the server.
 
   Returns:
     Instance of Storage.
   """
-  return Storage(get_storage_api(url, namespace))
+  return Storage(get_storage_api(url, namespace), existence_cache)
 
 
-def upload_tree(base_url, infiles, namespace):
+def upload_tree(base_url, infiles, namespace, existence_cache=None):
   """Uploads the given tree to the given url.
 
   Arguments:
     base_url:  The url of the isolate server to upload to.
     infiles:   iterable of pairs (absolute path, metadata dict) of files.
     namespace: The namespace to use on the server.
+    existence_cache: optional ExistenceCache, see get_storage().
   """
   # Convert |infiles| into a list of FileItem objects, skip duplicates.
   # Filter out symlinks, since they are not represented by items on isolate
@@ -1791,20 +2605,110 @@ def upload_tree(base_url, infiles, namespace):
   for filepath, metadata in infiles:
     if 'l' not in metadata and filepath not in seen:
       seen.add(filepath)
-      item = FileItem(
-          path=filepath,
-          digest=metadata['h'],
-          size=metadata['s'],
-          high_priority=metadata.get('priority') == '0')
-      items.append(item)
+      items.extend(
+          file_to_items(
+              filepath, metadata, metadata.get('priority') == '0'))
     else:
       skipped += 1
 
   logging.info('Skipped %d duplicated entries', skipped)
-  with get_storage(base_url, namespace) as storage:
+  with get_storage(base_url, namespace, existence_cache) as storage:
     storage.upload_items(items)
 
 
+def write_chunked_file(cache, dest, props, algo):
+  """Reassembles a file split with isolated_format.chunk_file() from |cache|.
+
+  The file is hashed while it is written. If it doesn't match the digest of the
+  whole file, |dest| is removed and isolated_format.MappingError is raised.
+
+  Arguments:
+    cache: LocalCache instance that holds all the chunks.
+    dest: path of the file to create.
+    props: file entry with the 'c' list of [digest, size] chunks, the 'h' digest
+        of the whole file and optionally its 'm' file mode.
+    algo: hashing algorithm used.
+  """
+  d = algo()
+  def read_chunks():
+    for digest, _ in props['c']:
+      content = cache.read(digest)
+      d.update(content)
+      yield content
+  file_write(dest, read_chunks())
+  if d.hexdigest() != props['h']:
+    if os.path.isfile(dest):
+      os.remove(dest)
+    raise isolated_format.MappingError(
+        'Reassembled %s doesn\'t match its digest: expected %s, got %s' %
+        (dest, props['h'], d.hexdigest()))
+  if props.get('m') is not None:
+    # Ignores all other bits, same as LocalCache.hardlink().
+    os.chmod(dest, props['m'] & 0500)
+
+
+class TreeMapper(object):
+  """Maps fetched files in an output directory using a thread pool.
+
+  Files are queued in batches of files of the same directory, so the threads
+  work on distinct directories most of the time.
+  """
+
+  def __init__(self, cache, outdir, pool, algo):
+    """
+    Arguments:
+      cache: LocalCache instance that holds the files.
+      outdir: output directory to map the files into.
+      pool: ThreadPool to run the batches on.
+      algo: hashing algorithm used, to verify the reassembled files.
+    """
+    self.cache = cache
+    self.outdir = outdir
+    self.algo = algo
+    self._pool = pool
+    # Files waiting for their batch to be full: directory -> list of
+    # (relative path, properties).
+    self._pending = {}
+    self._lock = threading.Lock()
+    # Number of files mapped and total time spent by the threads doing so.
+    self.count = 0
+    self.duration = 0.
+
+  def add(self, filepath, props):
+    """Queues the mapping of a file once it is in the cache.
+
+    A file split in chunks is reassembled, see write_chunked_file(). Otherwise
+    it is hardlinked from the cache.
+    """
+    d = os.path.dirname(filepath)
+    batch = self._pending.setdefault(d, [])
+    batch.append((filepath, props))
+    if len(batch) >= MAPPING_BATCH_SIZE:
+      self._pool.add_task(0, self._map_batch, self._pending.pop(d))
+
+  def join(self):
+    """Maps the remaining files and waits for all of them to be mapped.
+
+    Raises the first exception raised while mapping a file, if any.
+    """
+    for batch in self._pending.itervalues():
+      self._pool.add_task(0, self._map_batch, batch)
+    self._pending = {}
+    self._pool.join()
+
+  def _map_batch(self, batch):
+    start = time.time()
+    for filepath, props in batch:
+      dest = os.path.join(self.outdir, filepath)
+      if 'c' in props:
+        write_chunked_file(self.cache, dest, props, self.algo)
+      else:
+        self.cache.hardlink(props['h'], dest, props.get('m'))
+    with self._lock:
+      self.count += len(batch)
+      self.duration += time.time() - start
+
+
 def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
   """Aggressively downloads the .isolated file(s), then download all the files.
 
@@ -1845,12 +2749,18 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
         # easy way to cancel them.
         raise isolated_format.IsolatedError('No command to run')
 
-    with tools.Profiler('GetRest'):
+    with tools.Profiler('GetRest'), threading_utils.ThreadPool(
+        0, MAPPING_THREADS, 0, 'map') as pool:
       # Create file system hierarchy.
+      start = time.time()
       if not os.path.isdir(outdir):
         os.makedirs(outdir)
-      create_directories(outdir, bundle.files)
+      dir_count = create_directories(outdir, bundle.files, pool)
+      mkdir_duration = time.time() - start
+      start = time.time()
       create_symlinks(outdir, bundle.files.iteritems())
+      symlink_duration = time.time() - start
+      mapper = TreeMapper(cache, outdir, pool, algo)
 
       # Ensure working directory exists.
       cwd = os.path.normpath(os.path.join(outdir, bundle.relative_cwd))
@@ -1859,8 +2769,14 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
 
       # Multimap: digest -> list of pairs (path, props).
       remaining = {}
+      # Chunked files: path -> set of chunk digests not yet fetched.
+      missing_chunks = {}
       for filepath, props in bundle.files.iteritems():
-        if 'h' in props:
+        if 'c' in props:
+          missing_chunks[filepath] = set(digest for digest, _ in props['c'])
+          for digest in missing_chunks[filepath]:
+            remaining.setdefault(digest, []).append((filepath, props))
+        elif 'h' in props:
           remaining.setdefault(props['h'], []).append((filepath, props))
 
       # Now block on the remaining files to be downloaded and mapped.
@@ -1876,8 +2792,13 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
 
           # Link corresponding files to a fetched item in cache.
           for filepath, props in remaining.pop(digest):
-            cache.hardlink(
-                digest, os.path.join(outdir, filepath), props.get('m'))
+            if filepath in missing_chunks:
+              # Only write a chunked file once all its chunks are in cache.
+              missing_chunks[filepath].discard(digest)
+              if missing_chunks[filepath]:
+                continue
+              del missing_chunks[filepath]
+            mapper.add(filepath, props)
 
           # Report progress.
           duration = time.time() - last_update
@@ -1887,6 +2808,14 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
             logging.info(msg)
             last_update = time.time()
 
+      start = time.time()
+      mapper.join()
+      logging.info(
+          'Mapping: %d directories in %.3fs, symlinks in %.3fs, %d files in '
+          '%.3fs of threads time; waited %.3fs for the last files',
+          dir_count, mkdir_duration, symlink_duration, mapper.count,
+          mapper.duration, time.time() - start)
+
   # Cache could evict some items we just tried to fetch, it's a fatal error.
   if not fetch_queue.verify_all_cached():
     raise isolated_format.MappingError(
@@ -1894,30 +2823,47 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
   return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
-  """Returns the FileItem list and .isolated metadata for a directory."""
+def directory_to_metadata(
+    root, algo, blacklist, chunk_threshold=0, hash_cache=None):
+  """Returns the Item list and .isolated metadata for a directory.
+
+  Files at least |chunk_threshold| bytes large are uploaded as content defined
+  chunks if |chunk_threshold| is non-zero. The digests of the files unmodified
+  since they were saved in |hash_cache|, an isolated_format.HashCache, are not
+  recalculated.
+  """
   root = file_path.get_native_path_case(root)
   paths = isolated_format.expand_directory_and_symlink(
       root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
-  metadata = {
-    relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo)
-    for relpath in paths
-  }
+
+  def to_metadata(relpath):
+    filepath = os.path.join(root, relpath)
+    prevdict = hash_cache.get(filepath, algo) if hash_cache else {}
+    meta = isolated_format.file_to_metadata(
+        filepath, prevdict, 0, algo, chunk_threshold)
+    if hash_cache:
+      hash_cache.update(filepath, algo, meta)
+    return relpath, meta
+
+  # hashlib releases the GIL, so the files are hashed in parallel.
+  threads = max(threading_utils.num_processors(), 2)
+  with threading_utils.ThreadPool(0, threads, 0, 'hash') as pool:
+    for relpath in paths:
+      pool.add_task(0, to_metadata, relpath)
+    metadata = dict(pool.join())
   for v in metadata.itervalues():
     v.pop('t')
-  items = [
-      FileItem(
-          path=os.path.join(root, relpath),
-          digest=meta['h'],
-          size=meta['s'],
-          high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
-  ]
+  items = []
+  for relpath, meta in metadata.iteritems():
+    if 'h' in meta:
+      items.extend(
+          file_to_items(
+              os.path.join(root, relpath), meta, relpath.endswith('.isolated')))
   return items, metadata
 
 
-def archive_files_to_storage(storage, files, blacklist):
+def archive_files_to_storage(
+    storage, files, blacklist, chunk_threshold=0, hash_cache=None):
   """Stores every entries and returns the relevant data.
 
   Arguments:
@@ -1925,6 +2871,10 @@ def archive_files_to_storage(storage, files, blacklist):
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    chunk_threshold: if non-zero, files in directories at least this large are
+           uploaded as content defined chunks.
+    hash_cache: optional isolated_format.HashCache to skip hashing the files
+           that were not modified since the last archival.
   """
   assert all(isinstance(i, unicode) for i in files), files
   if len(files) != len(set(map(os.path.abspath, files))):
@@ -1942,7 +2892,8 @@ def archive_files_to_storage(storage, files, blacklist):
         if os.path.isdir(filepath):
           # Uploading a whole directory.
           items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+              filepath, storage.hash_algo, blacklist, chunk_threshold,
+              hash_cache)
 
           # Create the .isolated file.
           if not tempdir:
@@ -1953,7 +2904,7 @@ def archive_files_to_storage(storage, files, blacklist):
               'algo':
                   isolated_format.SUPPORTED_ALGOS_REVERSE[storage.hash_algo],
               'files': metadata,
-              'version': isolated_format.ISOLATED_FILE_VERSION,
+              'version': isolated_format.get_isolated_version(metadata),
           }
           isolated_format.save_isolated(isolated, data)
           h = isolated_format.hash_file(isolated, storage.hash_algo)
@@ -1967,7 +2918,10 @@ def archive_files_to_storage(storage, files, blacklist):
           results.append((h, f))
 
         elif os.path.isfile(filepath):
-          h = isolated_format.hash_file(filepath, storage.hash_algo)
+          if hash_cache:
+            h = hash_cache.hash_file(filepath, storage.hash_algo)
+          else:
+            h = isolated_format.hash_file(filepath, storage.hash_algo)
           items_to_upload.append(
             FileItem(
                 path=filepath,
@@ -1988,7 +2942,9 @@ def archive_files_to_storage(storage, files, blacklist):
       file_path.rmtree(tempdir)
 
 
-def archive(out, namespace, files, blacklist):
+def archive(
+    out, namespace, files, blacklist, chunk_threshold=0, hash_cache=None,
+    existence_cache=None):
   if files == ['-']:
     files = sys.stdin.readlines()
 
@@ -1997,8 +2953,9 @@ def archive(out, namespace, files, blacklist):
 
   files = [f.decode('utf-8') for f in files]
   blacklist = tools.gen_blacklist(blacklist)
-  with get_storage(out, namespace) as storage:
-    results = archive_files_to_storage(storage, files, blacklist)
+  with get_storage(out, namespace, existence_cache) as storage:
+    results = archive_files_to_storage(
+        storage, files, blacklist, chunk_threshold, hash_cache)
   print('\n'.join('%s %s' % (r[0], r[1]) for r in results))
 
 
@@ -2016,12 +2973,35 @@ def CMDarchive(parser, args):
   """
   add_isolate_server_options(parser)
   add_archive_options(parser)
+  add_existence_cache_options(parser)
+  parser.add_option(
+      '--chunk-threshold', type='int', default=0, metavar='BYTES',
+      help='Files in directories at least this large are split in content '
+           'defined chunks, so only the modified parts of large files are '
+           'uploaded again. Disabled by default since older clients can\'t '
+           'fetch chunked files.')
+  parser.add_option(
+      '--hash-cache', metavar='FILE',
+      help='File to keep the digests of the archived files in, so the files '
+           'that were not modified are not hashed again on the next run.')
   options, files = parser.parse_args(args)
   process_isolate_server_options(parser, options, True)
+  hash_cache = None
+  if options.hash_cache:
+    hash_cache = isolated_format.HashCache(
+        os.path.abspath(options.hash_cache).decode('utf-8'))
+  existence_cache = process_existence_cache_options(options)
   try:
-    archive(options.isolate_server, options.namespace, files, options.blacklist)
+    archive(
+        options.isolate_server, options.namespace, files, options.blacklist,
+        options.chunk_threshold, hash_cache, existence_cache)
   except Error as e:
     parser.error(e.args[0])
+  finally:
+    if hash_cache:
+      hash_cache.save()
+    if existence_cache:
+      existence_cache.save()
   return 0
 
 
@@ -2103,6 +3083,30 @@ def add_archive_options(parser):
            'directories')
 
 
+def add_existence_cache_options(parser):
+  parser.add_option(
+      '--existence-cache', metavar='FILE',
+      help='File to keep the digests of the items seen on the server in, so '
+           'they are not looked up again by the next runs for a while. It is '
+           'not locked, concurrent runs must use different files.')
+  parser.add_option(
+      '--existence-cache-ttl',
+      type='int',
+      metavar='SECS',
+      default=EXISTENCE_CACHE_TTL,
+      help='Time an item seen on the server is assumed to be still there, '
+           'must be well below the server expiration. default=%default')
+
+
+def process_existence_cache_options(options):
+  """Returns an ExistenceCache or None if --existence-cache is not used."""
+  if not options.existence_cache:
+    return None
+  return ExistenceCache(
+      os.path.abspath(options.existence_cache).decode('utf-8'),
+      options.existence_cache_ttl)
+
+
 def add_isolate_server_options(parser):
   """Adds --isolate-server and --namespace options to parser."""
   parser.add_option(
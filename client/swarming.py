@@ -583,10 +583,69 @@ def now():
   return time.time()
 
 
+class OutputFollower(object):
+  """Prints the output of the shards as it is streamed by retrieve_results().
+
+  Partial lines are held until completed so lines of different shards are not
+  mixed. Each line is prefixed with its shard index when there is more than one
+  shard.
+  """
+
+  def __init__(self, shard_count):
+    self._lock = threading.Lock()
+    self._shard_count = shard_count
+    self._pending = {}
+
+  def __call__(self, shard_index, output):
+    with self._lock:
+      lines = (self._pending.pop(shard_index, u'') + output).split('\n')
+      if lines[-1]:
+        self._pending[shard_index] = lines[-1]
+      for line in lines[:-1]:
+        self._print(shard_index, line)
+
+  def flush(self, shard_index):
+    """Prints the last line of a shard if it was not terminated."""
+    with self._lock:
+      if shard_index in self._pending:
+        self._print(shard_index, self._pending.pop(shard_index))
+
+  def _print(self, shard_index, line):
+    if self._shard_count > 1:
+      line = u'%d: %s' % (shard_index, line)
+    print(line)
+
+
+def follow_output(output_url, offset, drain):
+  """Yields (output, next offset) for the output appended after offset.
+
+  Only one read is done unless drain is True, in which case it reads until the
+  end of the output, since the server caps the size of each read.
+
+  Yields (None, offset) and stops if a read failed.
+  """
+  while True:
+    out = net.url_read_json('%s?offset=%d' % (output_url, offset))
+    if out is None:
+      yield None, offset
+      return
+    if out.get('next_offset', offset) <= offset:
+      return
+    offset = out['next_offset']
+    yield out['output'] or u'', offset
+    if not drain:
+      return
+
+
 def retrieve_results(
-    base_url, shard_index, task_id, timeout, should_stop, output_collector):
+    base_url, shard_index, task_id, timeout, should_stop, output_collector,
+    follow=None):
   """Retrieves results for a single task ID.
 
+  If follow is set, it is called with (shard_index, output) for each new piece
+  of output while the task runs. Only the bytes appended since the last poll
+  are fetched.
+
   Returns:
     <result dict> on success.
     None on failure.
@@ -595,6 +654,10 @@ def retrieve_results(
   result_url = '%s/swarming/api/v1/client/task/%s' % (base_url, task_id)
   output_url = '%s/swarming/api/v1/client/task/%s/output/all' % (
       base_url, task_id)
+  follow_url = '%s/swarming/api/v1/client/task/%s/output/0' % (
+      base_url, task_id)
+  followed = []
+  offset = 0
   started = now()
   deadline = started + timeout if timeout else None
   attempt = 0
@@ -627,9 +690,30 @@ def retrieve_results(
     result = net.url_read_json(result_url, retry_50x=False)
     if not result:
       continue
-    if result['state'] in State.STATES_NOT_RUNNING:
-      out = net.url_read_json(output_url)
-      result['outputs'] = (out or {}).get('outputs', [])
+    completed = result['state'] in State.STATES_NOT_RUNNING
+    drained = True
+    if follow and result['state'] != State.PENDING:
+      for output, offset in follow_output(follow_url, offset, completed):
+        if output is None:
+          drained = False
+          break
+        followed.append(output)
+        follow(shard_index, output)
+    if completed:
+      if followed and drained:
+        result['outputs'] = [u''.join(followed)]
+      else:
+        if followed:
+          logging.warning(
+              'Failed to read the end of the output of task %s, fetching it '
+              'all', task_id)
+        out = net.url_read_json(output_url)
+        result['outputs'] = (out or {}).get('outputs', [])
+        seen = u''.join(followed)
+        if followed and result['outputs'] and (
+            (result['outputs'][0] or u'').startswith(seen)):
+          # Stream what couldn't be read.
+          follow(shard_index, result['outputs'][0][len(seen):])
       if not result['outputs']:
         logging.error('No output found for task %s', task_id)
       # Record the result, try to fetch attached output files (if any).
@@ -641,7 +725,7 @@ def retrieve_results(
 
 def yield_results(
     swarm_base_url, task_ids, timeout, max_threads, print_status_updates,
-    output_collector):
+    output_collector, follow=None):
   """Yields swarming task results from the swarming server as (index, result).
 
   Duplicate shards are ignored. Shards are yielded in order of completion.
@@ -655,6 +739,9 @@ def yield_results(
   output_collector is an optional instance of TaskOutputCollector that will be
   used to fetch files produced by a task from isolate server to the local disk.
 
+  follow is an optional callback to stream the output of the tasks, see
+  retrieve_results().
+
   Yields:
     (index, result). In particular, 'result' is defined as the
     GetRunnerResults() function in services/swarming/server/test_runner.py.
@@ -672,7 +759,7 @@ def yield_results(
         task_fn = lambda *args: (shard_index, retrieve_results(*args))
         pool.add_task(
             0, results_channel.wrap_task(task_fn), swarm_base_url, shard_index,
-            task_id, timeout, should_stop, output_collector)
+            task_id, timeout, should_stop, output_collector, follow)
 
       # Enqueue 'retrieve_results' calls for each shard key to run in parallel.
       for shard_index, task_id in enumerate(task_ids):
@@ -712,7 +799,7 @@ def yield_results(
       should_stop.set()
 
 
-def decorate_shard_output(swarming, shard_index, metadata):
+def decorate_shard_output(swarming, shard_index, metadata, include_output=True):
   """Returns wrapped output for swarming task shard."""
   def t(d):
     return datetime.datetime.strptime(d, '%Y-%m-%d %H:%M:%S')
@@ -747,17 +834,24 @@ def decorate_shard_output(swarming, shard_index, metadata):
 
   header = dash_pad + tag_header + dash_pad
   footer = dash_pad + tag_footer + dash_pad[:-1]
+  if not include_output:
+    return header + footer
   output = '\n'.join(o for o in metadata['outputs'] if o).rstrip() + '\n'
   return header + output + footer
 
 
 def collect(
     swarming, task_name, task_ids, timeout, decorate, print_status_updates,
-    task_summary_json, task_output_dir):
-  """Retrieves results of a Swarming task."""
+    task_summary_json, task_output_dir, follow=False):
+  """Retrieves results of a Swarming task.
+
+  If follow is True, the output is printed as the tasks run instead of once
+  they completed.
+  """
   # Collect summary JSON and output files (if task_output_dir is not None).
   output_collector = TaskOutputCollector(
       task_output_dir, task_name, len(task_ids))
+  follower = OutputFollower(len(task_ids)) if follow else None
 
   seen_shards = set()
   exit_code = 0
@@ -765,8 +859,10 @@ def collect(
   try:
     for index, metadata in yield_results(
         swarming, task_ids, timeout, None, print_status_updates,
-        output_collector):
+        output_collector, follower):
       seen_shards.add(index)
+      if follower:
+        follower.flush(index)
 
       # Default to failure if there was no process that even started.
       shard_exit_code = 1
@@ -778,7 +874,7 @@ def collect(
         total_duration += metadata['durations'][0]
 
       if decorate:
-        print(decorate_shard_output(swarming, index, metadata))
+        print(decorate_shard_output(swarming, index, metadata, not follow))
         if len(seen_shards) < len(task_ids):
           print('')
       else:
@@ -788,6 +884,8 @@ def collect(
           exit_code = 'N/A'
         print('%s: %s %d' %
             (metadata.get('bot_id') or 'N/A', metadata['id'], exit_code))
+        if follow:
+          continue
         for output in metadata['outputs']:
           if not output:
             continue
@@ -947,6 +1045,10 @@ def add_collect_options(parser):
   parser.group_logging.add_option(
       '--print-status-updates', action='store_true',
       help='Print periodic status updates')
+  parser.group_logging.add_option(
+      '--follow', action='store_true',
+      help='Print the output of the tasks as they run. Only the new output is '
+           'fetched on each poll')
   parser.task_output_group = tools.optparse.OptionGroup(parser, 'Task output')
   parser.task_output_group.add_option(
       '--task-summary-json',
@@ -1096,7 +1198,8 @@ def CMDcollect(parser, args):
         options.decorate,
         options.print_status_updates,
         options.task_summary_json,
-        options.task_output_dir)
+        options.task_output_dir,
+        options.follow)
   except Failure:
     on_error.report(None)
     return 1
@@ -1205,7 +1308,8 @@ def CMDrun(parser, args):
         options.decorate,
         options.print_status_updates,
         options.task_summary_json,
-        options.task_output_dir)
+        options.task_output_dir,
+        options.follow)
   except Failure:
     on_error.report(None)
     return 1
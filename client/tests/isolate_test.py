@@ -1236,7 +1236,7 @@ class IsolateCommand(IsolateBase):
   def test_CMDarchive(self):
     actual = []
 
-    def mocked_upload_tree(base_url, infiles, namespace):
+    def mocked_upload_tree(base_url, infiles, namespace, existence_cache):
       # |infiles| may be a generator of pair, materialize it into a list.
       actual.append({
         'base_url': base_url,
@@ -1300,7 +1300,7 @@ class IsolateCommand(IsolateBase):
     # Same as test_CMDarchive but via code path that parses *.gen.json files.
     actual = []
 
-    def mocked_upload_tree(base_url, infiles, namespace):
+    def mocked_upload_tree(base_url, infiles, namespace, existence_cache):
       # |infiles| may be a generator of pair, materialize it into a list.
       actual.append({
         'base_url': base_url,
@@ -144,6 +144,150 @@ class SymlinkTest(unittest.TestCase):
       self.assertEqual((u'out/foo/bar.txt', []), actual)
 
 
+class ChunkTest(unittest.TestCase):
+  def setUp(self):
+    super(ChunkTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+
+  def tearDown(self):
+    try:
+      shutil.rmtree(self.tempdir)
+    finally:
+      super(ChunkTest, self).tearDown()
+
+  def _write(self, name, content):
+    path = os.path.join(self.tempdir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def test_hash_file(self):
+    content = 'content' * 1000
+    path = self._write('a', content)
+    expected = ALGO(content).hexdigest()
+    self.assertEqual(expected, isolated_format.hash_file(path, ALGO))
+    # Large files are hashed from a memory map.
+    old = isolated_format.MMAP_MIN_SIZE
+    isolated_format.MMAP_MIN_SIZE = 1
+    try:
+      self.assertEqual(expected, isolated_format.hash_file(path, ALGO))
+    finally:
+      isolated_format.MMAP_MIN_SIZE = old
+
+  def _verify_chunks(self, content, chunks):
+    offset = 0
+    for i, (digest, size) in enumerate(chunks):
+      if i != len(chunks) - 1:
+        self.assertTrue(size >= isolated_format.CHUNK_MIN_SIZE, size)
+      self.assertTrue(size <= isolated_format.CHUNK_MAX_SIZE, size)
+      self.assertEqual(
+          ALGO(content[offset:offset+size]).hexdigest(), digest)
+      offset += size
+    self.assertEqual(len(content), offset)
+
+  def test_chunk_file(self):
+    # Deterministic pseudo random content.
+    content = ''.join(ALGO(str(i)).digest() for i in xrange(150000))
+    path = self._write('a', content)
+    digest, chunks = isolated_format.chunk_file(path, ALGO)
+    self.assertEqual(ALGO(content).hexdigest(), digest)
+    self.assertTrue(len(chunks) > 1, chunks)
+    self._verify_chunks(content, chunks)
+
+    # Boundaries only depend on the content, so the chunks following a
+    # modification at the start of the file are preserved.
+    modified = 'prefix' + content
+    path = self._write('b', modified)
+    digest, modified_chunks = isolated_format.chunk_file(path, ALGO)
+    self.assertEqual(ALGO(modified).hexdigest(), digest)
+    self._verify_chunks(modified, modified_chunks)
+    self.assertEqual(chunks[1:], modified_chunks[1:])
+
+  def test_chunk_file_small(self):
+    path = self._write('a', 'small')
+    expected = (ALGO('small').hexdigest(), [[ALGO('small').hexdigest(), 5]])
+    self.assertEqual(expected, isolated_format.chunk_file(path, ALGO))
+
+  def test_chunk_file_max_size(self):
+    # Content that never triggers a boundary is cut at CHUNK_MAX_SIZE.
+    content = '\0' * (isolated_format.CHUNK_MAX_SIZE + 10)
+    path = self._write('a', content)
+    _, chunks = isolated_format.chunk_file(path, ALGO)
+    self.assertEqual(
+        [isolated_format.CHUNK_MAX_SIZE, 10], [size for _, size in chunks])
+
+  def test_file_to_metadata_chunk_threshold(self):
+    path = self._write('a', 'content')
+    actual = isolated_format.file_to_metadata(path, {}, 0, ALGO, 8)
+    self.assertNotIn('c', actual)
+    actual = isolated_format.file_to_metadata(path, {}, 0, ALGO, 7)
+    digest = ALGO('content').hexdigest()
+    self.assertEqual(digest, actual['h'])
+    self.assertEqual([[digest, 7]], actual['c'])
+
+
+class HashCacheTest(auto_stub.TestCase):
+  def setUp(self):
+    super(HashCacheTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    self.state_file = os.path.join(self.tempdir, u'hash_cache.json')
+
+  def tearDown(self):
+    try:
+      shutil.rmtree(self.tempdir)
+    finally:
+      super(HashCacheTest, self).tearDown()
+
+  def _write(self, name, content):
+    path = os.path.join(self.tempdir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def _metadata(self, hash_cache, path):
+    meta = isolated_format.file_to_metadata(
+        path, hash_cache.get(path, ALGO), 0, ALGO)
+    hash_cache.update(path, ALGO, meta)
+    return meta
+
+  def test_reuse(self):
+    path = self._write('a', 'content')
+    with isolated_format.HashCache(self.state_file) as hash_cache:
+      self.assertEqual({}, hash_cache.get(path, ALGO))
+      meta = self._metadata(hash_cache, path)
+    self.assertEqual(ALGO('content').hexdigest(), meta['h'])
+
+    # The digest is reused across instances, without reading the file.
+    calls = []
+    hash_file = isolated_format.hash_file
+    self.mock(
+        isolated_format, 'hash_file',
+        lambda *args: calls.append(args) or hash_file(*args))
+    with isolated_format.HashCache(self.state_file) as hash_cache:
+      expected = {'h': meta['h'], 's': meta['s'], 't': meta['t']}
+      self.assertEqual(expected, hash_cache.get(path, ALGO))
+      self.assertEqual(meta, self._metadata(hash_cache, path))
+      self.assertEqual(meta['h'], hash_cache.hash_file(path, ALGO))
+    self.assertEqual([], calls)
+
+    # A modified file is not reused.
+    os.utime(path, (meta['t'] + 10, meta['t'] + 10))
+    with isolated_format.HashCache(self.state_file) as hash_cache:
+      self.assertEqual({}, hash_cache.get(path, ALGO))
+      # Another algorithm doesn't match either.
+      self.assertEqual({}, hash_cache.get(path, hashlib.md5))
+
+  def test_evict(self):
+    with isolated_format.HashCache(self.state_file, 2) as hash_cache:
+      paths = [self._write(str(i), str(i)) for i in xrange(3)]
+      for path in paths:
+        hash_cache.hash_file(path, ALGO)
+    with isolated_format.HashCache(self.state_file, 2) as hash_cache:
+      self.assertEqual({}, hash_cache.get(paths[0], ALGO))
+      self.assertEqual(
+          ALGO('2').hexdigest(), hash_cache.get(paths[2], ALGO)['h'])
+
+
 class TestIsolated(auto_stub.TestCase):
   def test_load_isolated_empty(self):
     m = isolated_format.load_isolated('{}', isolateserver_mock.ALGO)
@@ -183,6 +327,60 @@ class TestIsolated(auto_stub.TestCase):
     with self.assertRaises(isolated_format.IsolatedError):
       isolated_format.load_isolated(json.dumps(data), isolateserver_mock.ALGO)
 
+  def test_load_isolated_chunks(self):
+    data = {
+      u'files': {
+        u'a': {
+          u'h': u'0123456789abcdef0123456789abcdef01234567',
+          u's': 3,
+          u'c': [
+            [u'0123456789abcdef0123456789abcdef01234567', 1],
+            [u'89abcdef0123456789abcdef0123456789abcdef', 2],
+          ],
+        },
+      },
+      u'version': isolated_format.ISOLATED_FILE_VERSION_CHUNKED,
+    }
+    m = isolated_format.load_isolated(json.dumps(data), isolateserver_mock.ALGO)
+    self.assertEqual(data, m)
+
+  def test_load_isolated_chunks_bad(self):
+    def gen_data(
+        chunks, version=isolated_format.ISOLATED_FILE_VERSION_CHUNKED):
+      return {
+        u'files': {
+          u'a': {
+            u'h': u'0123456789abcdef0123456789abcdef01234567',
+            u's': 3,
+            u'c': chunks,
+          },
+        },
+        u'version': version,
+      }
+    good = [[u'0123456789abcdef0123456789abcdef01234567', 3]]
+    bad = [
+      gen_data(good, '1.4'),
+      gen_data([]),
+      gen_data([[u'0123456789abcdef0123456789abcdef01234567', 2]]),
+      gen_data([[u'invalid', 3]]),
+      gen_data([[u'0123456789abcdef0123456789abcdef01234567']]),
+    ]
+    for data in bad:
+      with self.assertRaises(isolated_format.IsolatedError):
+        isolated_format.load_isolated(
+            json.dumps(data), isolateserver_mock.ALGO)
+
+  def test_get_isolated_version(self):
+    h = u'0123456789abcdef0123456789abcdef01234567'
+    files = {u'a': {u'h': h, u's': 3}, u'b': {u'l': u'a'}}
+    self.assertEqual(
+        isolated_format.ISOLATED_FILE_VERSION,
+        isolated_format.get_isolated_version(files))
+    files[u'c'] = {u'h': h, u's': 3, u'c': [[h, 3]]}
+    self.assertEqual(
+        isolated_format.ISOLATED_FILE_VERSION_CHUNKED,
+        isolated_format.get_isolated_version(files))
+
   def test_load_isolated_os_only(self):
     # Tolerate 'os' on older version.
     data = {
@@ -54,10 +54,28 @@ class IsolateServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def _read_body(self):
     """Reads the request body."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      return ''.join(self._read_chunks())
     return self.rfile.read(int(self.headers['Content-Length']))
 
+  def _read_chunks(self):
+    """Yields the chunks of a request body sent with chunked encoding."""
+    while True:
+      size = int(self.rfile.readline().split(';', 1)[0], 16)
+      if not size:
+        # Skip the trailer.
+        while self.rfile.readline().strip():
+          pass
+        return
+      yield self.rfile.read(size)
+      self.rfile.readline()
+
   def _drop_body(self):
     """Reads the request body."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      for _ in self._read_chunks():
+        pass
+      return
     size = int(self.headers['Content-Length'])
     while size:
       chunk = min(4096, size)
@@ -149,10 +167,32 @@ class IsolateServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         }, index, response['items'])
       logging.info('Returning %s' % response)
       self._json(response)
+    elif self.path.startswith('/_ah/api/isolateservice/v1/store_inline_multi'):
+      for item in json.loads(body)['items']:
+        embedded = FakeSigner.validate(item['upload_ticket'], 'datastore')
+        self.server.contents.setdefault(
+            embedded['n'], {})[embedded['d']] = item['content']
+      self._json({'ok': True})
     elif self.path.startswith('/_ah/api/isolateservice/v1/store_inline'):
       self._storage_helper(body)
     elif self.path.startswith('/_ah/api/isolateservice/v1/finalize_gs_upload'):
       self._storage_helper(body, True)
+    elif self.path.startswith('/_ah/api/isolateservice/v1/resolve_tree'):
+      request = json.loads(body)
+      contents = self.server.contents.get(request['namespace']['namespace'], {})
+      # Only returns the root .isolated file, the client fetches the includes.
+      root = contents.get(request['digest'])
+      self._json({'items': [
+        {'digest': request['digest'], 'content': root}
+      ] if root is not None else []})
+    elif self.path.startswith('/_ah/api/isolateservice/v1/retrieve_multi'):
+      request = json.loads(body)
+      contents = self.server.contents.get(request['namespace']['namespace'], {})
+      # Content of items uploaded to GS is None.
+      self._json({'items': [
+        {'digest': d, 'content': contents[d]}
+        for d in request['digests'] if contents.get(d) is not None
+      ]})
     elif self.path.startswith('/_ah/api/isolateservice/v1/retrieve'):
       request = json.loads(body)
       namespace = request['namespace']['namespace']
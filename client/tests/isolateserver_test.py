@@ -13,6 +13,8 @@ import os
 import StringIO
 import sys
 import tempfile
+import threading
+import time
 import unittest
 import urllib
 import zlib
@@ -26,6 +28,7 @@ import isolateserver
 import test_utils
 from depot_tools import auto_stub
 from utils import file_path
+from utils import net
 from utils import threading_utils
 
 import isolateserver_mock
@@ -121,17 +124,40 @@ class FakeItem(isolateserver.Item):
 
 class MockedStorageApi(isolateserver.StorageApi):
   def __init__(
-      self, missing_hashes, push_side_effect=None, namespace='default'):
+      self, missing_hashes, push_side_effect=None, namespace='default',
+      contents=None, fetch_failures=0):
     self.missing_hashes = missing_hashes
     self.push_side_effect = push_side_effect
     self.push_calls = []
     self.contains_calls = []
+    self.contents = contents or {}
+    # Number of fetches that drop the connection after the first chunk.
+    self.fetch_failures = fetch_failures
+    self.fetch_calls = []
     self._namespace = namespace
+    self._lock = threading.Lock()
+
+  @property
+  def location(self):
+    return 'http://mocked'
 
   @property
   def namespace(self):
     return self._namespace
 
+  def fetch(self, digest, offset=0, size=None):
+    with self._lock:
+      self.fetch_calls.append((digest, offset, size))
+      fail = self.fetch_failures > 0
+      self.fetch_failures -= 1
+    data = self.contents[digest][offset:]
+    if size is not None:
+      data = data[:size]
+    for i in xrange(0, len(data), 2):
+      if fail and i:
+        raise IOError('Connection reset')
+      yield data[i:i+2]
+
   def push(self, item, push_state, content=None):
     content = ''.join(item.content() if content is None else content)
     self.push_calls.append((item, push_state, content))
@@ -147,6 +173,23 @@ class MockedStorageApi(isolateserver.StorageApi):
     return missing
 
 
+class MockedMultiStorageApi(MockedStorageApi):
+  """Supports push_multi() for the items whose push state is 'inline'."""
+  def __init__(self, *args, **kwargs):
+    self.push_multi_side_effect = kwargs.pop('push_multi_side_effect', None)
+    super(MockedMultiStorageApi, self).__init__(*args, **kwargs)
+    self.push_multi_calls = []
+
+  def can_push_multi(self, push_state):
+    return push_state == 'inline'
+
+  def push_multi(self, items):
+    self.push_multi_calls.append(
+        [(item, push_state, content) for item, push_state, content in items])
+    if self.push_multi_side_effect:
+      self.push_multi_side_effect()
+
+
 class StorageTest(TestCase):
   """Tests for Storage methods."""
 
@@ -174,6 +217,47 @@ class StorageTest(TestCase):
     batches = list(isolateserver.batch_items_for_check(items))
     self.assertEqual(batches, expected)
 
+  def test_contains_batch_sizer(self):
+    sizer = isolateserver.ContainsBatchSizer(16)
+    self.assertEqual(isolateserver.CONTAINS_MIN_BATCH_SIZE, sizer.batch_size)
+    self.assertEqual(
+        isolateserver.CONTAINS_INITIAL_CONCURRENCY, sizer.concurrency)
+
+    # A round of fast queries grows the batch size and the concurrency.
+    for _ in xrange(sizer.concurrency):
+      sizer.record(time.time(), 0.3, True)
+    self.assertEqual(
+        isolateserver.CONTAINS_MIN_BATCH_SIZE +
+            4 * isolateserver.CONTAINS_BATCH_SIZE_INCREMENT,
+        sizer.batch_size)
+    self.assertEqual(
+        isolateserver.CONTAINS_INITIAL_CONCURRENCY + 1, sizer.concurrency)
+
+    # A slow query halves them, only once for the queries started before.
+    start = time.time() - 10
+    sizer.record(start, 10, True)
+    sizer.record(start, 10, False)
+    self.assertEqual(50, sizer.batch_size)
+    self.assertEqual(2, sizer.concurrency)
+
+    self.assertEqual(
+        [(0.1, 0), (0.25, 0), (0.5, 4), (1., 0), (2., 0), (5., 0), (10., 1),
+         (30., 0), (None, 0)],
+        sizer.histogram())
+    self.assertEqual(
+        '<=0.5: 4, <=10.0: 1; 1 failed; batch size 50, concurrency 2',
+        sizer.format_histogram())
+
+  def test_get_missing_items_batch_grows(self):
+    items = [isolateserver.Item(str(i), i) for i in xrange(1000)]
+    storage_api = MockedStorageApi({})
+    storage = isolateserver.Storage(storage_api)
+    self.assertEqual({}, dict(storage.get_missing_items(items)))
+    sizes = [len(i) for i in storage_api.contains_calls]
+    self.assertEqual(1000, sum(sizes))
+    self.assertEqual(isolateserver.CONTAINS_MIN_BATCH_SIZE, max(sizes[:4]))
+    self.assertLess(len(sizes), 1000 / isolateserver.CONTAINS_MIN_BATCH_SIZE)
+
   def test_get_missing_items(self):
     items = [
       isolateserver.Item('foo', 12),
@@ -195,6 +279,87 @@ class StorageTest(TestCase):
     result = dict(storage.get_missing_items(items))
     self.assertEqual(missing, result)
 
+  def test_get_missing_items_unhashed(self):
+    # Items without digest are hashed before being looked up, only the first
+    # item of each digest is looked up.
+    items = [
+      isolateserver.BufferItem('foo'),
+      isolateserver.BufferItem('bar'),
+      isolateserver.BufferItem('foo'),
+    ]
+    storage_api = MockedStorageApi(
+        {isolateserver_mock.hash_content('foo'): 'push foo'})
+    storage = isolateserver.Storage(storage_api)
+    result = dict(storage.get_missing_items(items))
+    self.assertEqual({items[0]: 'push foo'}, result)
+    self.assertEqual(
+        [isolateserver_mock.hash_content(c) for c in ('foo', 'bar', 'foo')],
+        [i.digest for i in items])
+    self.assertEqual(
+        [items[0], items[1]], sum(storage_api.contains_calls, []))
+
+  def test_get_missing_items_hashing_concurrency(self):
+    # Hashing runs on all the CPU threads, not limited by the lookups.
+    self.mock(isolateserver.threading_utils, 'num_processors', lambda: 8)
+    lock = threading.Lock()
+    active = [0]
+    peak = [0]
+    reached = threading.Event()
+
+    class SlowItem(isolateserver.BufferItem):
+      def prepare(self, hash_algo):
+        with lock:
+          active[0] += 1
+          peak[0] = max(peak[0], active[0])
+          if active[0] > isolateserver.CONTAINS_INITIAL_CONCURRENCY:
+            reached.set()
+        # Wait for the other batches to be hashed concurrently, only once.
+        reached.wait(5)
+        reached.set()
+        super(SlowItem, self).prepare(hash_algo)
+        with lock:
+          active[0] -= 1
+
+    count = 8 * isolateserver.CONTAINS_MIN_BATCH_SIZE
+    items = [SlowItem(str(i)) for i in xrange(count)]
+    storage_api = MockedStorageApi({})
+    storage = isolateserver.Storage(storage_api)
+    self.assertEqual({}, dict(storage.get_missing_items(items)))
+    self.assertEqual(count, sum(len(i) for i in storage_api.contains_calls))
+    self.assertGreater(peak[0], isolateserver.CONTAINS_INITIAL_CONCURRENCY)
+
+  def test_get_missing_items_existence_cache(self):
+    # The items seen on the server are not looked up again by the next runs,
+    # until their TTL expires.
+    items = [FakeItem('foo'), FakeItem('bar')]
+    state_file = os.path.join(self.tempdir, u'existence_cache.json')
+    with isolateserver.ExistenceCache(state_file) as cache:
+      storage_api = MockedStorageApi({items[1].digest: 'push bar'})
+      storage = isolateserver.Storage(storage_api, cache)
+      self.assertEqual(
+          {items[1]: 'push bar'}, dict(storage.get_missing_items(items)))
+
+    cache = isolateserver.ExistenceCache(state_file)
+    storage_api = MockedStorageApi({items[1].digest: 'push bar'})
+    storage = isolateserver.Storage(storage_api, cache)
+    self.assertEqual(
+        {items[1]: 'push bar'}, dict(storage.get_missing_items(items)))
+    self.assertEqual([[items[1]]], storage_api.contains_calls)
+
+    # Another namespace doesn't know about it.
+    storage_api = MockedStorageApi({}, namespace='default-gzip')
+    storage = isolateserver.Storage(storage_api, cache)
+    self.assertEqual({}, dict(storage.get_missing_items(items)))
+    self.assertEqual(1, len(storage_api.contains_calls))
+
+    # Once expired, it is looked up again.
+    now = time.time()
+    self.mock(time, 'time', lambda: now + isolateserver.EXISTENCE_CACHE_TTL)
+    storage_api = MockedStorageApi({})
+    storage = isolateserver.Storage(storage_api, cache)
+    self.assertEqual({}, dict(storage.get_missing_items(items)))
+    self.assertEqual(2, len(sum(storage_api.contains_calls, [])))
+
   def test_async_push(self):
     for use_zip in (False, True):
       item = FakeItem('1234567')
@@ -243,10 +408,8 @@ class StorageTest(TestCase):
     def push_side_effect():
       raise IOError('Nope')
 
-    # TODO(vadimsh): Retrying push when fetching data from a generator is
-    # broken now (it reuses same generator instance when retrying).
     content_sources = (
-        # generator(),
+        _generator,
         lambda: [chunk],
     )
 
@@ -272,6 +435,39 @@ class StorageTest(TestCase):
         self.assertEqual(
             [expected_push] * attempts, storage_api.push_calls)
 
+  def test_upload_items_multi(self):
+    self.mock(isolateserver, 'PUSH_MULTI_MAX_ITEMS', 2)
+    items = [FakeItem('item %d' % i) for i in xrange(3)]
+    items.append(FakeItem('large'))
+    storage_api = MockedMultiStorageApi(dict(
+        [(i.digest, 'inline') for i in items[:3]] +
+        [(items[3].digest, 'gs')]))
+    storage = isolateserver.Storage(storage_api)
+    uploaded = storage.upload_items(items)
+    self.assertEqualIgnoringOrder(items, uploaded)
+    # The small items are pushed in batches, the other one on its own.
+    self.assertEqualIgnoringOrder(
+        [2, 1], [len(batch) for batch in storage_api.push_multi_calls])
+    self.assertEqualIgnoringOrder(
+        [(i, 'inline', i.data) for i in items[:3]],
+        sum(storage_api.push_multi_calls, []))
+    self.assertEqual(
+        [(items[3], 'gs', 'large')], storage_api.push_calls)
+
+  def test_upload_items_multi_failure(self):
+    def push_multi_side_effect():
+      raise IOError('Nope')
+    items = [FakeItem('item %d' % i) for i in xrange(3)]
+    storage_api = MockedMultiStorageApi(
+        dict((i.digest, 'inline') for i in items),
+        push_multi_side_effect=push_multi_side_effect)
+    storage = isolateserver.Storage(storage_api)
+    uploaded = storage.upload_items(items)
+    self.assertEqualIgnoringOrder(items, uploaded)
+    # Falls back to pushing them one by one.
+    self.assertEqualIgnoringOrder(
+        [(i, 'inline', i.data) for i in items], storage_api.push_calls)
+
   def test_upload_tree(self):
     files = {
       '/a': {
@@ -306,7 +502,7 @@ class StorageTest(TestCase):
 
     storage_api = MockedStorageApi(missing_hashes)
     storage = isolateserver.Storage(storage_api)
-    def mock_get_storage(base_url, namespace):
+    def mock_get_storage(base_url, namespace, existence_cache=None):
       self.assertEqual('base_url', base_url)
       self.assertEqual('some-namespace', namespace)
       return storage
@@ -339,6 +535,82 @@ class StorageTest(TestCase):
       self.assertEqual(files_data[filename], pushed_content)
       self.assertEqual(missing_hashes[pushed_item.digest], push_state)
 
+  def test_upload_tree_chunked(self):
+    path = os.path.join(self.tempdir, 'a')
+    with open(path, 'wb') as f:
+      f.write('abcdefgh')
+    hash_abc = isolateserver_mock.hash_content('abc')
+    hash_defgh = isolateserver_mock.hash_content('defgh')
+    metadata = {
+      'h': isolateserver_mock.hash_content('abcdefgh'),
+      's': 8,
+      'c': [[hash_abc, 3], [hash_defgh, 5]],
+    }
+    storage_api = MockedStorageApi({hash_defgh: 'push defgh'})
+    storage = isolateserver.Storage(storage_api)
+    self.mock(isolateserver, 'get_storage', lambda *_: storage)
+
+    isolateserver.upload_tree('base_url', [(path, metadata)], 'some-namespace')
+
+    # Only the chunks are looked up, not the whole file.
+    self.assertEqualIgnoringOrder(
+        [hash_abc, hash_defgh],
+        [i.digest for i in sum(storage_api.contains_calls, [])])
+    # Only the missing chunk is read and pushed.
+    self.assertEqual(
+        [(hash_defgh, 'push defgh', 'defgh')],
+        [(i.digest, state, content)
+         for i, state, content in storage_api.push_calls])
+
+
+  def fetch_item(self, storage, digest, size):
+    fetched = []
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, 0, digest, size, lambda content: fetched.extend(content))
+    self.assertEqual(digest, channel.pull())
+    storage.close()
+    return ''.join(fetched)
+
+  def test_async_fetch_resume(self):
+    data = 'abcdefgh'
+    digest = isolateserver_mock.hash_content(data)
+    storage_api = MockedStorageApi(
+        {}, contents={digest: data}, fetch_failures=2)
+    storage = isolateserver.Storage(storage_api)
+    self.assertEqual(data, self.fetch_item(storage, digest, len(data)))
+    # Each fetch is resumed from the last received byte.
+    self.assertEqual(
+        [(digest, 0, None), (digest, 2, None), (digest, 4, None)],
+        storage_api.fetch_calls)
+
+  def test_async_fetch_resume_compressed(self):
+    data = 'abcdefgh' * 10
+    digest = isolateserver_mock.hash_content(data)
+    compressed = zlib.compress(data)
+    storage_api = MockedStorageApi(
+        {}, namespace='default-gzip', contents={digest: compressed},
+        fetch_failures=1)
+    storage = isolateserver.Storage(storage_api)
+    self.assertEqual(data, self.fetch_item(storage, digest, len(data)))
+    # The offset is in the compressed stream.
+    self.assertEqual(
+        [(digest, 0, None), (digest, 2, None)], storage_api.fetch_calls)
+
+  def test_async_fetch_ranges(self):
+    self.mock(isolateserver, 'RANGE_FETCH_MIN_SIZE', 8)
+    self.mock(isolateserver, 'RANGE_FETCH_SIZE', 3)
+    self.mock(isolateserver, 'RANGE_FETCH_THREADS', 1)
+    data = 'abcdefgh'
+    digest = isolateserver_mock.hash_content(data)
+    storage_api = MockedStorageApi(
+        {}, contents={digest: data}, fetch_failures=1)
+    storage = isolateserver.Storage(storage_api)
+    self.assertEqual(data, self.fetch_item(storage, digest, len(data)))
+    # The first range dropped the connection and was resumed.
+    expected = [(digest, 0, 3), (digest, 2, 1), (digest, 3, 3), (digest, 6, 2)]
+    self.assertEqual(expected, storage_api.fetch_calls)
+
 
 class IsolateServerStorageApiTest(TestCase):
   @staticmethod
@@ -379,7 +651,7 @@ class IsolateServerStorageApiTest(TestCase):
     response = data
     return (
         server + '/some/gs/url/%s/%s' % (namespace, item),
-        {},
+        {'headers': request_headers},
         response,
         response_headers,
     )
@@ -484,6 +756,132 @@ class IsolateServerStorageApiTest(TestCase):
       with self.assertRaises(IOError):
         _ = ''.join(storage.fetch(item, offset))
 
+  def test_fetch_range(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    offset = 200
+    size = 100
+    self.expected_requests([
+        self.mock_fetch_request(server, namespace, item, offset=offset),
+        self.mock_gs_request(
+            server, namespace, item, data[offset:offset+size], offset=offset,
+            request_headers={'Range': 'bytes=200-299'},
+            response_headers={'Content-Range': 'bytes 200-299/%d' % len(data)}),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    fetched = ''.join(storage.fetch(item, offset, size))
+    self.assertEqual(data[offset:offset+size], fetched)
+
+  def test_fetch_multi(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    item = isolateserver_mock.hash_content('Hi')
+    missing = isolateserver_mock.hash_content('Bye')
+    request = (
+      server + '/_ah/api/isolateservice/v1/retrieve_multi',
+      {
+          'data': {
+              'digests': [item, missing],
+              'namespace': {
+                  'compression': '',
+                  'digest_hash': 'sha-1',
+                  'namespace': namespace,
+              },
+          },
+          'read_timeout': 60,
+          'raise_http_codes': (404, 405),
+      },
+    )
+    self.expected_requests([
+        request + ({'items': [{'digest': item, 'content': 'SGk='}]},),
+        request + (None,),
+        request + ({'items': [{'digest': item, 'content': 'SGk='}]},),
+        request + (net.HttpError(404),),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    self.assertEqual({item: 'Hi'}, storage.fetch_multi([item, missing]))
+    # A transient failure is not fatal.
+    self.assertEqual({}, storage.fetch_multi([item, missing]))
+    self.assertEqual({item: 'Hi'}, storage.fetch_multi([item, missing]))
+    # Once the server said it doesn't support it, it's not tried anymore.
+    self.assertEqual({}, storage.fetch_multi([item, missing]))
+    self.assertEqual({}, storage.fetch_multi([item, missing]))
+
+  def test_fetch_tree(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    root = isolateserver_mock.hash_content('Hi')
+    request = (
+      server + '/_ah/api/isolateservice/v1/resolve_tree',
+      {
+          'data': {
+              'digest': root,
+              'namespace': {
+                  'compression': '',
+                  'digest_hash': 'sha-1',
+                  'namespace': namespace,
+              },
+          },
+          'read_timeout': 60,
+          'raise_http_codes': (404, 405),
+      },
+    )
+    self.expected_requests([
+        request + ({'items': [{'digest': root, 'content': 'SGk='}]},),
+        request + (None,),
+        request + ({'items': [{'digest': root, 'content': 'SGk='}]},),
+        request + (net.HttpError(404),),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    self.assertEqual({root: 'Hi'}, storage.fetch_tree(root))
+    # A transient failure is not fatal.
+    self.assertEqual({}, storage.fetch_tree(root))
+    self.assertEqual({root: 'Hi'}, storage.fetch_tree(root))
+    # Once the server said it doesn't support it, it's not tried anymore.
+    self.assertEqual({}, storage.fetch_tree(root))
+    self.assertEqual({}, storage.fetch_tree(root))
+
+  def test_push_multi(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    items = [FakeItem('a'), FakeItem('b')]
+    push_states = [
+      isolateserver._IsolateServerPushState(
+          {'upload_ticket': 'ticket %d' % i}, item.size)
+      for i, item in enumerate(items)
+    ]
+    request = {'items': [
+      {'upload_ticket': 'ticket 0', 'content': base64.b64encode('a')},
+      {'upload_ticket': 'ticket 1', 'content': base64.b64encode('b')},
+    ]}
+    url = server + '/_ah/api/isolateservice/v1/store_inline_multi'
+    kwargs = {'data': request, 'raise_http_codes': (404, 405)}
+    self.expected_requests([
+        (url, kwargs, {'ok': True}),
+        (url, kwargs, None),
+        (url, kwargs, net.HttpError(405)),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    self.assertTrue(all(storage.can_push_multi(s) for s in push_states))
+    storage.push_multi(
+        [(i, s, i.data) for i, s in zip(items, push_states)])
+    self.assertTrue(all(s.finalized for s in push_states))
+
+    # A transient failure is not fatal.
+    for s in push_states:
+      s.uploaded = s.finalized = False
+    with self.assertRaises(IOError):
+      storage.push_multi(
+          [(i, s, i.data) for i, s in zip(items, push_states)])
+    self.assertTrue(all(storage.can_push_multi(s) for s in push_states))
+    # Once the server said it doesn't support it, it's not tried anymore.
+    with self.assertRaises(IOError):
+      storage.push_multi(
+          [(i, s, i.data) for i, s in zip(items, push_states)])
+    self.assertFalse(any(storage.can_push_multi(s) for s in push_states))
+
   def test_push_success(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -778,15 +1176,70 @@ class IsolateServerDownloadTest(TestCase):
       # Ignore 'stream' argument, it's not important for these tests.
       kwargs.pop('stream', None)
       for i, (new_url, expected_kwargs, result) in enumerate(self._requests):
-        if new_url == url and expected_kwargs == kwargs:
-          self._flagged_requests[i] = 1
-          return result
+        if new_url != url:
+          continue
+        if callable(expected_kwargs):
+          expected_kwargs(kwargs)
+        elif expected_kwargs != kwargs:
+          continue
+        self._flagged_requests[i] = 1
+        return result
     self.fail('Unknown request %s' % url)
 
   def setUp(self):
     super(IsolateServerDownloadTest, self).setUp()
     self._flagged_requests = []
 
+  @staticmethod
+  def mock_retrieve_multi_request(server, contents, returned):
+    """Returns a request for all the |contents|, only |returned| are inline."""
+    def check(kwargs):
+      # Items are grouped in any order.
+      expected = sorted(h.encode('utf-8') for h in contents)
+      assert expected == sorted(kwargs['data'].pop('digests')), kwargs
+      assert kwargs == {
+          'data': {
+              'namespace': {
+                  'namespace': 'default-gzip',
+                  'digest_hash': 'sha-1',
+                  'compression': 'flate',
+              },
+          },
+          'read_timeout': 60,
+          'raise_http_codes': (404, 405),
+      }, kwargs
+    return (
+      server + '/_ah/api/isolateservice/v1/retrieve_multi',
+      check,
+      {'items': [
+        {'digest': h, 'content': base64.b64encode(zlib.compress(contents[h]))}
+        for h in returned
+      ]},
+    )
+
+  @staticmethod
+  def mock_resolve_tree_request(server, root, contents):
+    """Returns a request for the tree of |root|, returning |contents|."""
+    return (
+      server + '/_ah/api/isolateservice/v1/resolve_tree',
+      {
+          'data': {
+              'digest': root.encode('utf-8'),
+              'namespace': {
+                  'namespace': 'default-gzip',
+                  'digest_hash': 'sha-1',
+                  'compression': 'flate',
+              },
+          },
+          'read_timeout': 60,
+          'raise_http_codes': (404, 405),
+      },
+      {'items': [
+        {'digest': h, 'content': base64.b64encode(zlib.compress(v))}
+        for h, v in contents
+      ]},
+    )
+
   def tearDown(self):
     if all(self._flagged_requests):
       self._requests = []
@@ -854,7 +1307,57 @@ class IsolateServerDownloadTest(TestCase):
     }
     isolated_data = json.dumps(isolated, sort_keys=True, separators=(',',':'))
     isolated_hash = isolateserver_mock.hash_content(isolated_data)
-    requests = [(v['h'], files[k]) for k, v in isolated['files'].iteritems()]
+    # The .isolated file is returned by resolve_tree and the small files are
+    # fetched in a single request.
+    contents = dict(
+        (v['h'], files[k]) for k, v in isolated['files'].iteritems())
+    requests = [
+      self.mock_resolve_tree_request(
+          server, isolated_hash, [(isolated_hash, isolated_data)]),
+      self.mock_retrieve_multi_request(server, contents, sorted(contents)),
+    ]
+    cmd = [
+      'download',
+      '--isolate-server', server,
+      '--target', self.tempdir,
+      '--isolated', isolated_hash,
+    ]
+    self.expected_requests(requests)
+    self.assertEqual(0, isolateserver.main(cmd))
+    expected = dict(
+        (os.path.join(self.tempdir, k), v) for k, v in files.iteritems())
+    self.assertEqual(expected, actual)
+    expected_stdout = (
+        'To run this test please run from the directory %s:\n  Absurb command\n'
+        % os.path.join(self.tempdir, 'a'))
+    self.checkOutput(expected_stdout, '')
+
+  def test_download_isolated_chunked(self):
+    # Test downloading an isolated tree with a file split in chunks.
+    actual = {}
+    def file_write_mock(key, generator):
+      actual[key] = ''.join(generator)
+    self.mock(isolateserver, 'file_write', file_write_mock)
+    self.mock(os, 'makedirs', lambda _: None)
+    server = 'http://example.com'
+    chunks = ['Large ', 'content']
+    isolated = {
+      'files': {
+        'a': {
+          'h': isolateserver_mock.hash_content(''.join(chunks)),
+          's': len(''.join(chunks)),
+          'c': [[isolateserver_mock.hash_content(c), len(c)] for c in chunks],
+        },
+      },
+      'version': isolated_format.ISOLATED_FILE_VERSION_CHUNKED,
+    }
+    isolated_data = json.dumps(isolated, sort_keys=True, separators=(',',':'))
+    isolated_hash = isolateserver_mock.hash_content(isolated_data)
+    # Only the chunks are fetched, not the whole file. They are fetched in a
+    # single request and the one not returned inline is fetched on its own.
+    contents = dict((isolateserver_mock.hash_content(c), c) for c in chunks)
+    inline = isolateserver_mock.hash_content(chunks[0])
+    requests = [(isolateserver_mock.hash_content(chunks[1]), chunks[1])]
     requests.append((isolated_hash, isolated_data))
     requests = [
       (
@@ -874,6 +1377,10 @@ class IsolateServerDownloadTest(TestCase):
         {'content': base64.b64encode(zlib.compress(v))},
       ) for h, v in requests
     ]
+    requests.append(
+        self.mock_retrieve_multi_request(server, contents, [inline]))
+    # The server doesn't have the .isolated file in memcache.
+    requests.append(self.mock_resolve_tree_request(server, isolated_hash, []))
     cmd = [
       'download',
       '--isolate-server', server,
@@ -882,16 +1389,130 @@ class IsolateServerDownloadTest(TestCase):
     ]
     self.expected_requests(requests)
     self.assertEqual(0, isolateserver.main(cmd))
-    expected = dict(
-        (os.path.join(self.tempdir, k), v) for k, v in files.iteritems())
+    expected = {os.path.join(self.tempdir, 'a'): 'Large content'}
     self.assertEqual(expected, actual)
-    expected_stdout = (
-        'To run this test please run from the directory %s:\n  Absurb command\n'
-        % os.path.join(self.tempdir, 'a'))
-    self.checkOutput(expected_stdout, '')
 
 
-def get_storage(_isolate_server, namespace):
+class TreeMapperTest(TestCase):
+  def test_create_directories_pool(self):
+    files = [
+      os.path.join('a', 'b', 'c', 'file'),
+      os.path.join('a', 'd', 'file'),
+      os.path.join('e', 'file'),
+      'file',
+    ]
+    with threading_utils.ThreadPool(0, 4, 0) as pool:
+      self.assertEqual(
+          5, isolateserver.create_directories(self.tempdir, files, pool))
+    for d in (os.path.join('a', 'b', 'c'), os.path.join('a', 'd'), 'e'):
+      self.assertTrue(os.path.isdir(os.path.join(self.tempdir, d)), d)
+
+  def test_map(self):
+    self.mock(isolateserver, 'MAPPING_BATCH_SIZE', 2)
+    cache = isolateserver.MemoryCache()
+    files = {}
+    for i in xrange(5):
+      content = 'content %d' % i
+      digest = isolateserver_mock.hash_content(content)
+      cache.write(digest, [content])
+      files[os.path.join('d%d' % (i % 2), 'f%d' % i)] = {
+        'h': digest, 's': len(content),
+      }
+    with threading_utils.ThreadPool(0, 4, 0) as pool:
+      isolateserver.create_directories(self.tempdir, files, pool)
+      mapper = isolateserver.TreeMapper(
+          cache, self.tempdir, pool, isolateserver_mock.ALGO)
+      for filepath, props in sorted(files.iteritems()):
+        mapper.add(filepath, props)
+      mapper.join()
+    self.assertEqual(5, mapper.count)
+    for i in xrange(5):
+      path = os.path.join(self.tempdir, 'd%d' % (i % 2), 'f%d' % i)
+      with open(path, 'rb') as f:
+        self.assertEqual('content %d' % i, f.read())
+
+
+  def test_write_chunked_file(self):
+    cache = isolateserver.MemoryCache()
+    chunks = ['Large ', 'content']
+    for c in chunks:
+      cache.write(isolateserver_mock.hash_content(c), [c])
+    props = {
+      'h': isolateserver_mock.hash_content('Large content'),
+      's': len('Large content'),
+      'c': [[isolateserver_mock.hash_content(c), len(c)] for c in chunks],
+    }
+    dest = os.path.join(self.tempdir, 'a')
+    isolateserver.write_chunked_file(
+        cache, dest, props, isolateserver_mock.ALGO)
+    with open(dest, 'rb') as f:
+      self.assertEqual('Large content', f.read())
+    os.remove(dest)
+
+    # A reassembled file that doesn't match the whole file digest is removed.
+    props['h'] = isolateserver_mock.hash_content('Other content')
+    with self.assertRaises(isolated_format.MappingError):
+      isolateserver.write_chunked_file(
+          cache, dest, props, isolateserver_mock.ALGO)
+    self.assertFalse(os.path.exists(dest))
+
+
+class DiskCacheTest(TestCase):
+  def setUp(self):
+    super(DiskCacheTest, self).setUp()
+    self.cache_dir = os.path.join(self.tempdir, u'cache')
+    self.policies = isolateserver.CachePolicies(0, 0, 0)
+
+  def get_cache(self):
+    return isolateserver.DiskCache(self.cache_dir, self.policies, hashlib.sha1)
+
+  def test_write_sharded(self):
+    digest = hashlib.sha1('content').hexdigest()
+    with self.get_cache() as cache:
+      cache.write(digest, ['content'])
+    self.assertEqual(
+        sorted([digest[:2], 'state.json', 'state.json.journal']),
+        sorted(os.listdir(self.cache_dir)))
+    self.assertEqual(
+        [digest[2:]], os.listdir(os.path.join(self.cache_dir, digest[:2])))
+    with self.get_cache() as cache:
+      self.assertEqual(set([digest]), cache.cached_set())
+      self.assertEqual('content', cache.read(digest))
+
+  def test_touch_missing_file(self):
+    # A file deleted behind the cache's back is evicted from the state.
+    self.mock(logging, 'warning', lambda *_: None)
+    digest = hashlib.sha1('content').hexdigest()
+    with self.get_cache() as cache:
+      cache.write(digest, ['content'])
+    os.remove(os.path.join(self.cache_dir, digest[:2], digest[2:]))
+    with self.get_cache() as cache:
+      self.assertEqual(set([digest]), cache.cached_set())
+      self.assertFalse(cache.touch(digest, 7))
+      self.assertEqual(set(), cache.cached_set())
+    with self.get_cache() as cache:
+      self.assertEqual(set(), cache.cached_set())
+
+  def test_migrate_flat_layout(self):
+    # Files of the older flat layout are moved to their shard, whether the
+    # state is loaded or the directory is scanned.
+    for with_state in (True, False):
+      file_path.rmtree(self.tempdir)
+      os.makedirs(self.cache_dir)
+      digest = hashlib.sha1('content').hexdigest()
+      with open(os.path.join(self.cache_dir, digest), 'wb') as f:
+        f.write('content')
+      if with_state:
+        with open(os.path.join(self.cache_dir, 'state.json'), 'wb') as f:
+          json.dump([[digest, 7]], f)
+      with self.get_cache() as cache:
+        self.assertEqual(set([digest]), cache.cached_set())
+        self.assertEqual('content', cache.read(digest))
+      self.assertFalse(
+          os.path.exists(os.path.join(self.cache_dir, digest)), with_state)
+
+
+def get_storage(_isolate_server, namespace, _existence_cache=None):
   class StorageFake(object):
     def __enter__(self, *_):
       return self
@@ -3,9 +3,11 @@
 # Use of this source code is governed under the Apache License, Version 2.0 that
 # can be found in the LICENSE file.
 
+import hashlib
 import json
 import logging
 import os
+import shutil
 import sys
 import tempfile
 import unittest
@@ -221,6 +223,88 @@ class LRUDictTest(unittest.TestCase):
           ['key', 'another_value'],
       ]))
 
+  def test_journal(self):
+    tempdir = tempfile.mkdtemp(prefix=u'lru_test')
+    try:
+      state_file = os.path.join(tempdir, 'state.json')
+      journal = state_file + lru.LRUDict.JOURNAL_SUFFIX
+
+      # The first save writes the whole state.
+      lru_dict = self.prepare_lru_dict([1, 2, 3])
+      self.assertTrue(lru_dict.save(state_file))
+      self.assertFalse(os.path.isfile(journal))
+      self.assertFalse(lru_dict.save(state_file))
+
+      # Following modifications are only appended to the journal.
+      with open(state_file, 'rb') as f:
+        state = f.read()
+      lru_dict.add(4, 4)
+      lru_dict.touch(1)
+      lru_dict.pop(2)
+      lru_dict.batch_insert_oldest([(5, 5)])
+      self.assertTrue(lru_dict.save(state_file))
+      with open(state_file, 'rb') as f:
+        self.assertEqual(state, f.read())
+      # The header and the 4 modifications.
+      with open(journal, 'rb') as f:
+        self.assertEqual(5, len(f.readlines()))
+      self.assert_order(lru.LRUDict.load(state_file), [5, 3, 4, 1])
+
+      # A crash before the compacted state replaces the old one keeps the old
+      # state and its journal.
+      self.mock_compact_min(0)
+      lru_dict = lru.LRUDict.load(state_file)
+      lru_dict.pop(4)
+      def crash(*_):
+        raise OSError('Crash')
+      old_rename = os.rename
+      os.rename = crash
+      try:
+        with self.assertRaises(OSError):
+          lru_dict.save(state_file)
+      finally:
+        os.rename = old_rename
+      self.assert_order(lru.LRUDict.load(state_file), [5, 3, 4, 1])
+
+      # A crash before the journal is deleted leaves a journal that doesn't
+      # match the new state, so it is ignored instead of being replayed over
+      # the new state.
+      old_remove = os.remove
+      os.remove = crash
+      try:
+        with self.assertRaises(OSError):
+          lru_dict.save(state_file)
+      finally:
+        os.remove = old_remove
+      self.assertTrue(os.path.isfile(journal))
+      self.assert_order(lru.LRUDict.load(state_file), [5, 3, 1])
+
+      # The ignored journal is started over on the next save.
+      self.mock_compact_min(10)
+      lru_dict = lru.LRUDict.load(state_file)
+      lru_dict.add(4, 4)
+      lru_dict.pop(3)
+      self.assertTrue(lru_dict.save(state_file))
+      with open(journal, 'rb') as f:
+        self.assertEqual(
+            ['h', hashlib.sha1(open(state_file, 'rb').read()).hexdigest()],
+            json.loads(f.readline()))
+        self.assertEqual(2, len(f.readlines()))
+      self.assert_order(lru.LRUDict.load(state_file), [5, 1, 4])
+
+      # A partially written journal is detected.
+      with open(journal, 'ab') as f:
+        f.write('["a",6')
+      with self.assertRaises(ValueError):
+        lru.LRUDict.load(state_file)
+    finally:
+      shutil.rmtree(tempdir)
+
+  def mock_compact_min(self, value):
+    old = lru.LRUDict.JOURNAL_COMPACT_MIN
+    lru.LRUDict.JOURNAL_COMPACT_MIN = value
+    self.addCleanup(setattr, lru.LRUDict, 'JOURNAL_COMPACT_MIN', old)
+
 
 if __name__ == '__main__':
   VERBOSE = '-v' in sys.argv
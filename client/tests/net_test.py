@@ -157,6 +157,28 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(response.read(), response_body)
     self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
 
+  def test_request_PUT_generator(self):
+    attempts = []
+
+    def mock_perform_request(request):
+      attempts.append(request)
+      self.assertNotIn('Content-Length', request.headers)
+      self.assertEqual('data_body', ''.join(request.body))
+      raise net.ConnectionError()
+
+    def body():
+      yield 'data_'
+      yield 'body'
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    response = service.request(
+        '/some_request', data=body(),
+        content_type='application/octet-stream', method='PUT')
+    self.assertEqual(None, response)
+    # A streamed body can't be replayed so the request is not retried.
+    self.assertEqual(1, len(attempts))
+    self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
+
   def test_request_success_after_failure(self):
     response = 'True'
     attempts = []
@@ -225,6 +247,16 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(result.read(), response)
     self.assertAttempts(2, net.URL_OPEN_TIMEOUT)
 
+  def test_request_HTTP_error_raise_http_codes(self):
+    def mock_perform_request(_request):
+      raise net.HttpError(405)
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    with self.assertRaises(net.HttpError) as ctx:
+      service.request('/', data={}, raise_http_codes=(404, 405))
+    self.assertEqual(405, ctx.exception.code)
+    self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
+
   def test_request_HTTP_error_with_retry(self):
     response = 'response'
     attempts = []
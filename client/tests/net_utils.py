@@ -40,7 +40,8 @@ class TestCase(auto_stub.TestCase):
       request: list of tuple(url, kwargs, response, headers) for normal requests
           and tuple(url, kwargs, response) for json requests. kwargs can be a
           callable. In that case, it's called with the actual kwargs. It's
-          useful when the kwargs values are not deterministic.
+          useful when the kwargs values are not deterministic. A json response
+          can be an exception instance, which is then raised.
     """
     requests = requests[:]
     for request in requests:
@@ -92,6 +93,8 @@ class TestCase(auto_stub.TestCase):
             expected_kwargs(kwargs)
           else:
             self.assertEqual(expected_kwargs, kwargs)
+          if isinstance(result, Exception):
+            raise result
           if result is not None:
             return result
           return None
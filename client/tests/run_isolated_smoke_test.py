@@ -129,6 +129,11 @@ def list_files_tree(directory):
   return sorted(actual)
 
 
+def cache_path(digest):
+  """Returns the relative path of |digest| in the sharded cache."""
+  return os.path.join(digest[:2], digest[2:])
+
+
 def read_content(filepath):
   with open(filepath, 'rb') as f:
     return f.read()
@@ -240,9 +245,10 @@ class RunIsolatedTest(unittest.TestCase):
     isolated_hash = self._store('repeated_files.isolated')
     expected = [
       'state.json',
-      isolated_hash,
-      self._store('file1.txt'),
-      self._store('repeated_files.py'),
+      'state.json.journal',
+      cache_path(isolated_hash),
+      cache_path(self._store('file1.txt')),
+      cache_path(self._store('repeated_files.py')),
     ]
 
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
@@ -254,7 +260,9 @@ class RunIsolatedTest(unittest.TestCase):
 
   def test_fail_empty_isolated(self):
     isolated_hash = self._store_isolated({})
-    expected = ['state.json', isolated_hash]
+    expected = [
+      'state.json', 'state.json.journal', cache_path(isolated_hash),
+    ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', out)
     self.assertIn('No command to run\n', err)
@@ -270,16 +278,17 @@ class RunIsolatedTest(unittest.TestCase):
     isolated_hash = self._store('check_files.isolated')
     expected = [
       'state.json',
-      isolated_hash,
-      self._store('check_files.py'),
-      self._store('file1.txt'),
-      self._store('file3.txt'),
+      'state.json.journal',
+      cache_path(isolated_hash),
+      cache_path(self._store('check_files.py')),
+      cache_path(self._store('file1.txt')),
+      cache_path(self._store('file3.txt')),
       # Maps file1.txt.
-      self._store('manifest1.isolated'),
+      cache_path(self._store('manifest1.isolated')),
       # References manifest1.isolated. Maps file2.txt but it is overriden.
-      self._store('manifest2.isolated'),
-      self._store('repeated_files.py'),
-      self._store('repeated_files.isolated'),
+      cache_path(self._store('manifest2.isolated')),
+      cache_path(self._store('repeated_files.py')),
+      cache_path(self._store('repeated_files.isolated')),
     ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', err)
@@ -297,17 +306,20 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(0, returncode)
     expected = {
       '.': (040707, 040707, 040777),
+      file1_hash[:2]: (040707, 040707, 040777),
+      isolated_hash[:2]: (040707, 040707, 040777),
       'state.json': (0100606, 0100606, 0100666),
+      'state.json.journal': (0100606, 0100606, 0100666),
       # The reason for 0100666 on Windows is that the file node had to be
       # modified to delete the hardlinked node. The read only bit is reset on
       # load.
-      file1_hash: (0100400, 0100400, 0100666),
-      isolated_hash: (0100400, 0100400, 0100444),
+      cache_path(file1_hash): (0100400, 0100400, 0100666),
+      cache_path(isolated_hash): (0100400, 0100400, 0100444),
     }
     self.assertTreeModes(self.cache, expected)
 
     # Modify one of the files in the cache to be invalid.
-    cached_file_path = os.path.join(self.cache, file1_hash)
+    cached_file_path = os.path.join(self.cache, cache_path(file1_hash))
     previous_mode = os.stat(cached_file_path).st_mode
     os.chmod(cached_file_path, 0600)
     write_content(cached_file_path, new_content)
@@ -320,10 +332,13 @@ class RunIsolatedTest(unittest.TestCase):
     _out, _err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual(0, returncode)
     expected = {
-      '.': (040700, 040700, 040777),
-      'state.json': (0100600, 0100600, 0100666),
-      file1_hash: (0100400, 0100400, 0100666),
-      isolated_hash: (0100400, 0100400, 0100444),
+      '.': (040707, 040707, 040777),
+      file1_hash[:2]: (040707, 040707, 040777),
+      isolated_hash[:2]: (040707, 040707, 040777),
+      'state.json': (0100606, 0100606, 0100666),
+      'state.json.journal': (0100606, 0100606, 0100666),
+      cache_path(file1_hash): (0100400, 0100400, 0100666),
+      cache_path(isolated_hash): (0100400, 0100400, 0100444),
     }
     self.assertTreeModes(self.cache, expected)
     return cached_file_path
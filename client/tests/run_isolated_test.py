@@ -58,6 +58,14 @@ class StorageFake(object):
     sink([self._files[digest]])
     channel.send_result(digest)
 
+  def async_fetch_multi(self, channel, _priority, items, sink):
+    for digest, _size in items:
+      sink(digest, [self._files[digest]])
+      channel.send_result(digest)
+
+  def fetch_tree(self, _root_digest):
+    return {}
+
 
 class RunIsolatedTestBase(auto_stub.TestCase):
   def setUp(self):
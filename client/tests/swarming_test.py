@@ -58,7 +58,7 @@ def get_results(keys, output_collector=None):
           'https://host:9001', keys, 10., None, True, output_collector))
 
 
-def collect(url, task_name, task_ids):
+def collect(url, task_name, task_ids, follow=False):
   """Simplifies the call to swarming.collect()."""
   return swarming.collect(
     swarming=url,
@@ -68,7 +68,8 @@ def collect(url, task_name, task_ids):
     decorate=True,
     print_status_updates=True,
     task_summary_json=None,
-    task_output_dir=None)
+    task_output_dir=None,
+    follow=follow)
 
 
 def main(args):
@@ -459,6 +460,61 @@ class TestSwarmingCollection(NetTestCase):
     actual = get_results(['10100'])
     self.assertEqual(expected, actual)
 
+  def test_follow(self):
+    # Only the new output is fetched on each poll, then what is left once the
+    # task completed.
+    url = 'https://host:9001/swarming/api/v1/client/task/10100'
+    out = url + '/output/0?offset=%d'
+    self.expected_requests(
+        [
+          (url, {'retry_50x': False}, gen_result_response(state=0x20)),
+          (url, {'retry_50x': False}, gen_result_response(state=0x10)),
+          (out % 0, {}, {'next_offset': 4, 'output': 'Foo\n'}),
+          (url, {'retry_50x': False}, gen_result_response(state=0x10)),
+          (out % 4, {}, {'next_offset': 4, 'output': ''}),
+          (url, {'retry_50x': False}, gen_result_response()),
+          (out % 4, {}, {'next_offset': 7, 'output': 'Bar'}),
+          (out % 7, {}, {'next_offset': 9, 'output': '\n!'}),
+          (out % 9, {}, {'next_offset': 9, 'output': None}),
+        ])
+    calls = []
+    actual = list(
+        swarming.yield_results(
+            'https://host:9001', ['10100'], 10., None, False, None,
+            lambda *args: calls.append(args)))
+    self.assertEqual([gen_yielded_data(0, outputs=['Foo\nBar\n!'])], actual)
+    self.assertEqual([(0, 'Foo\n'), (0, 'Bar'), (0, '\n!')], calls)
+
+  def test_follow_drain_failure(self):
+    # When the end of the output can't be read, the whole output is fetched.
+    url = 'https://host:9001/swarming/api/v1/client/task/10100'
+    out = url + '/output/0?offset=%d'
+    self.expected_requests(
+        [
+          (url, {'retry_50x': False}, gen_result_response(state=0x10)),
+          (out % 0, {}, {'next_offset': 4, 'output': 'Foo\n'}),
+          (url, {'retry_50x': False}, gen_result_response()),
+          (out % 4, {}, {'next_offset': 7, 'output': 'Bar'}),
+          (out % 7, {}, None),
+          (url + '/output/all', {}, {'outputs': ['Foo\nBar\n!']}),
+        ])
+    calls = []
+    actual = list(
+        swarming.yield_results(
+            'https://host:9001', ['10100'], 10., None, False, None,
+            lambda *args: calls.append(args)))
+    self.assertEqual([gen_yielded_data(0, outputs=['Foo\nBar\n!'])], actual)
+    self.assertEqual([(0, 'Foo\n'), (0, 'Bar'), (0, '\n!')], calls)
+
+  def test_output_follower(self):
+    follower = swarming.OutputFollower(2)
+    follower(0, u'Foo\nBa')
+    follower(1, u'Hi')
+    follower(0, u'r\n')
+    follower.flush(0)
+    follower.flush(1)
+    self._check_output('0: Foo\n0: Bar\n1: Hi\n', '')
+
   def test_no_ids(self):
     actual = get_results([])
     self.assertEqual([], actual)
@@ -607,6 +663,26 @@ class TestSwarmingCollection(NetTestCase):
       ''))
     self._check_output(expected, '')
 
+  def test_collect_follow(self):
+    data = gen_result_response(outputs=['Foo'])
+    def yield_results(*args):
+      args[-1](0, u'Foo')
+      return [(0, data)]
+    self.mock(swarming, 'yield_results', yield_results)
+    self.assertEqual(
+        0, collect('https://localhost:1', 'name', ['10100'], follow=True))
+    expected = '\n'.join((
+      'Foo',
+      '+---------------------------------------------------------------------+',
+      '| Shard 0  https://localhost:1/user/task/10100                        |',
+      '+---------------------------------------------------------------------+',
+      '+---------------------------------------------------------------------+',
+      '| End of shard 0  Pending: 6.0s  Duration: 1.0s  Bot: swarm6  Exit: 0 |',
+      '+---------------------------------------------------------------------+',
+      'Total duration: 1.0s',
+      ''))
+    self._check_output(expected, '')
+
   def test_collect_fail(self):
     data = gen_result_response(outputs=['Foo'], exit_codes=[-9])
     data['outputs'] = ['Foo']
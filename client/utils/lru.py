@@ -5,7 +5,10 @@
 """Defines a dictionary that can evict least recently used items."""
 
 import collections
+import hashlib
 import json
+import os
+import sys
 
 
 class LRUDict(object):
@@ -15,14 +18,36 @@ class LRUDict(object):
   (key, value) pairs in order they are inserted and can effectively pop oldest
   items.
 
-  Can also store its state as *.json file on disk.
+  Can also store its state as *.json file on disk. Once saved or loaded, the
+  following modifications are appended to a journal file next to it, so saving
+  costs O(changes) instead of rewriting the whole state. The journal is folded
+  back into the *.json file once it grows larger than the dict itself.
+
+  The journal starts with the digest of the state file it applies to, so a
+  journal left behind by a crash while the state file was rewritten is ignored.
+  Loading still parses the whole *.json file.
   """
 
+  # Suffix of the journal file appended to the state file path.
+  JOURNAL_SUFFIX = '.journal'
+
+  # Minimum number of journal entries before it is compacted.
+  JOURNAL_COMPACT_MIN = 1000
+
   def __init__(self):
     # Ordered key -> value mapping, newest items at the bottom.
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # Journal entries of the modifications not saved yet.
+    self._pending = []
+    # State file this dict was loaded from or last fully saved to. |_pending|
+    # can only be appended to the journal of this state file.
+    self._state_file = None
+    # Number of entries in the journal of |_state_file|.
+    self._journal_len = 0
+    # SHA-1 of the content of |_state_file|, written as the journal header.
+    self._state_digest = None
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -43,7 +68,9 @@ class LRUDict(object):
     Raises ValueError if state file is corrupted.
     """
     try:
-      state = json.load(open(state_file, 'r'))
+      with open(state_file, 'rb') as f:
+        content = f.read()
+      state = json.loads(content)
     except (IOError, ValueError) as e:
       raise ValueError('Broken state file %s: %s' % (state_file, e))
 
@@ -64,18 +91,56 @@ class LRUDict(object):
       raise ValueError(
           'Broken state file %s, found duplicate keys' % (state_file,))
 
+    lru._state_digest = hashlib.sha1(content).hexdigest()
+    lru._journal_len = lru._replay(
+        state_file + cls.JOURNAL_SUFFIX, lru._state_digest)
+
     # Now state from the file corresponds to state in the memory.
     lru._dirty = False
+    lru._pending = []
+    lru._state_file = state_file
     return lru
 
   def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
+    """Saves cache state to a file if it was modified.
+
+    Only appends the modifications to the journal when possible.
+    """
     if not self._dirty:
       return False
 
-    with open(state_file, 'wb') as f:
-      json.dump(self._items.items(), f, separators=(',',':'))
-
+    journal = state_file + self.JOURNAL_SUFFIX
+    journal_len = self._journal_len + len(self._pending)
+    if (self._state_file == state_file and
+        journal_len <= max(self.JOURNAL_COMPACT_MIN, len(self._items))):
+      # An empty or ignored journal is started over with the header.
+      entries = self._pending
+      if not self._journal_len:
+        entries = [['h', self._state_digest]] + entries
+      with open(journal, 'ab' if self._journal_len else 'wb') as f:
+        f.write(''.join(
+            json.dumps(entry, separators=(',',':')) + '\n'
+            for entry in entries))
+      self._journal_len = journal_len
+    else:
+      # Write the new state aside first so a crash never leaves a partial state
+      # file. The old journal is only deleted once the new state is in place; if
+      # a crash leaves it behind, its header doesn't match the new state and it
+      # is ignored.
+      content = json.dumps(self._items.items(), separators=(',',':'))
+      tmp = state_file + '.tmp'
+      with open(tmp, 'wb') as f:
+        f.write(content)
+      if sys.platform == 'win32' and os.path.isfile(state_file):
+        os.remove(state_file)
+      os.rename(tmp, state_file)
+      self._state_file = state_file
+      self._state_digest = hashlib.sha1(content).hexdigest()
+      self._journal_len = 0
+      if os.path.isfile(journal):
+        os.remove(journal)
+
+    self._pending = []
     self._dirty = False
     return True
 
@@ -83,7 +148,7 @@ class LRUDict(object):
     """Adds or replaces a |value| for |key|, marks it as most recently used."""
     self._items.pop(key, None)
     self._items[key] = value
-    self._dirty = True
+    self._log(['a', key, value])
 
   def batch_insert_oldest(self, items):
     """Prepends list of |items| to the dict, marks them as least recently used.
@@ -104,7 +169,7 @@ class LRUDict(object):
         new_items[key] = value
 
     self._items = new_items
-    self._dirty = True
+    self._log(['o', items])
 
   def keys_set(self):
     """Set of keys of items in this dict."""
@@ -120,7 +185,7 @@ class LRUDict(object):
     Raises KeyError if |key| is not in the dict.
     """
     self._items[key] = self._items.pop(key)
-    self._dirty = True
+    self._log(['t', key])
 
   def pop(self, key):
     """Removes item from the dict, returns its value.
@@ -128,7 +193,7 @@ class LRUDict(object):
     Raises KeyError if |key| is not in the dict.
     """
     value = self._items.pop(key)
-    self._dirty = True
+    self._log(['p', key])
     return value
 
   def pop_oldest(self):
@@ -137,9 +202,55 @@ class LRUDict(object):
     Raises KeyError if dict is empty.
     """
     pair = self._items.popitem(last=False)
-    self._dirty = True
+    self._log(['p', pair[0]])
     return pair
 
   def itervalues(self):
     """Iterator over stored values in arbitrary order."""
     return self._items.itervalues()
+
+  def _log(self, entry):
+    """Records a modification to be appended to the journal on next save."""
+    self._pending.append(entry)
+    self._dirty = True
+
+  def _replay(self, journal, state_digest):
+    """Applies the modifications saved in |journal| and returns their number.
+
+    The journal is ignored if its header doesn't match |state_digest|, the
+    digest of the state file it is replayed over. Touching or popping a missing
+    key is ignored.
+
+    Raises ValueError if the journal is corrupted, e.g. partially written.
+    """
+    if not os.path.isfile(journal):
+      return 0
+    count = 0
+    try:
+      with open(journal, 'rb') as f:
+        try:
+          header = json.loads(f.readline())
+        except ValueError:
+          header = None
+        if header != ['h', state_digest]:
+          return 0
+        for line in f:
+          entry = json.loads(line)
+          if not isinstance(entry, list) or not entry:
+            raise ValueError('expecting a list: %r' % (entry,))
+          if entry[0] == 'a' and len(entry) == 3:
+            self.add(entry[1], entry[2])
+          elif entry[0] == 'o' and len(entry) == 2:
+            self.batch_insert_oldest(entry[1])
+          elif entry[0] in ('p', 't') and len(entry) == 2:
+            if entry[1] in self._items:
+              if entry[0] == 'p':
+                self.pop(entry[1])
+              else:
+                self.touch(entry[1])
+          else:
+            raise ValueError('unknown entry: %r' % (entry,))
+          count += 1
+    except (IOError, TypeError, ValueError) as e:
+      raise ValueError('Broken journal file %s: %s' % (journal, e))
+    return count
@@ -19,6 +19,7 @@ import socket
 import ssl
 import threading
 import time
+import types
 import urllib
 import urlparse
 
@@ -139,6 +140,7 @@ def url_open(url, **kwargs):  # pylint: disable=W0621
   |data| can be either:
     - None for a GET request
     - str for pre-encoded data
+    - generator of str chunks for pre-encoded data to stream
     - list for data to be encoded
     - dict for data to be encoded
 
@@ -320,8 +322,8 @@ class HttpService(object):
   @staticmethod
   def encode_request_body(body, content_type):
     """Returns request body encoded according to its content type."""
-    # No body or it is already encoded.
-    if body is None or isinstance(body, str):
+    # No body, it is already encoded or it is streamed.
+    if body is None or isinstance(body, (str, types.GeneratorType)):
       return body
     # Any body should have content type set.
     assert content_type, 'Request has body, but no content type'
@@ -366,7 +368,8 @@ class HttpService(object):
       stream=True,
       method=None,
       headers=None,
-      follow_redirects=True):
+      follow_redirects=True,
+      raise_http_codes=None):
     """Attempts to open the given url multiple times.
 
     |urlpath| is relative to the server root, i.e. '/some/request?param=1'.
@@ -374,9 +377,14 @@ class HttpService(object):
     |data| can be either:
       - None for a GET request
       - str for pre-encoded data
+      - generator of str chunks for pre-encoded data to stream
       - list for data to be form-encoded
       - dict for data to be form-encoded
 
+    A generator is sent with chunked transfer encoding. Since it can't be
+    rewound, such a request is attempted only once and the caller is
+    responsible for retries.
+
     - Optionally retries HTTP 404 and 50x.
     - Retries up to |max_attempts| times. If None or 0, there's no limit in the
       number of retries.
@@ -402,6 +410,11 @@ class HttpService(object):
     operation so once you pass non-None |read_timeout| be prepared to handle
     these exceptions in subsequent reads from the stream.
 
+    If |raise_http_codes| is given, it is a list of HTTP status codes that are
+    not retried and for which HttpError is raised instead of returning None, so
+    the caller can tell a definitive answer from the server apart from a
+    failure to reach it.
+
     Returns a file-like object, where the response may be read from, or None
     if it was unable to connect. If |stream| is False will read whole response
     into memory buffer before returning file-like object that reads from this
@@ -414,6 +427,8 @@ class HttpService(object):
       method = method or 'POST'
       content_type = content_type or DEFAULT_CONTENT_TYPE
       body = self.encode_request_body(data, content_type)
+      if isinstance(body, types.GeneratorType):
+        max_attempts = 1
     else:
       assert method in (None, 'DELETE', 'GET')
       method = method or 'GET'
@@ -428,7 +443,8 @@ class HttpService(object):
     # Prepare headers.
     headers = get_case_insensitive_dict(headers or {})
     if body is not None:
-      headers['Content-Length'] = len(body)
+      if isinstance(body, str):
+        headers['Content-Length'] = len(body)
       if content_type:
         headers['Content-Type'] = content_type
 
@@ -488,6 +504,9 @@ class HttpService(object):
                 self.urlhost)
           return None
 
+        if raise_http_codes and e.code in raise_http_codes:
+          raise
+
         # Hit a error that can not be retried -> stop retry loop.
         if not self.is_transient_http_error(e.code, retry_404, retry_50x):
           # This HttpError means we reached the server and there was a problem
@@ -573,7 +592,7 @@ class HttpRequest(object):
       |method| - HTTP method to use
       |url| - relative URL to the resource, without query parameters
       |params| - list of (key, value) pairs to put into GET parameters
-      |body| - encoded body of the request (None or str)
+      |body| - encoded body of the request (None, str or generator)
       |headers| - dict with request headers
       |timeout| - socket read timeout (None to disable)
       |stream| - True to stream response from socket